@@ -0,0 +1,309 @@
+'''
+This file contains utility functions & classes for caching the results of
+expensive tasks on disk, so that reruns only compute what is missing
+'''
+
+import os
+import uuid
+import pickle
+import hashlib
+import functools
+import numpy as np
+from pathlib import Path
+
+def _update_hash(h, obj) -> None:
+    '''
+    Recursively feed a canonical, type-tagged encoding of obj to the hasher
+    '''
+
+    if obj is None or isinstance(obj, (bool, int, float, complex, str)):
+        h.update(f'{type(obj).__name__}:{obj!r};'.encode())
+    elif isinstance(obj, bytes):
+        h.update(b'bytes:%d:' % len(obj))
+        h.update(obj)
+    elif isinstance(obj, np.generic):
+        # numpy scalars hash the same as the equivalent python scalar
+        _update_hash(h, obj.item())
+    elif isinstance(obj, np.ndarray):
+        if obj.dtype.hasobject:
+            h.update(f'objarray:{obj.shape};'.encode())
+            for item in obj.ravel():
+                _update_hash(h, item)
+        else:
+            h.update(f'ndarray:{obj.dtype.str}:{obj.shape};'.encode())
+            h.update(np.ascontiguousarray(obj).data)
+    elif isinstance(obj, dict):
+        # sorted, so that key order (e.g. of a parsed config) doesn't matter
+        items = sorted(obj.items(), key=lambda item: repr(item[0]))
+        h.update(f'dict:{len(items)};'.encode())
+        for key, value in items:
+            _update_hash(h, key)
+            _update_hash(h, value)
+    elif isinstance(obj, (list, tuple)):
+        h.update(f'{type(obj).__name__}:{len(obj)};'.encode())
+        for item in obj:
+            _update_hash(h, item)
+    elif isinstance(obj, (set, frozenset)):
+        h.update(f'set:{len(obj)};'.encode())
+        for digest in sorted(fingerprint(item) for item in obj):
+            h.update(digest.encode())
+    elif isinstance(obj, Path):
+        h.update(f'path:{obj};'.encode())
+    elif hasattr(obj, 'colnames') and hasattr(obj, 'columns'):
+        # astropy Tables, without importing astropy
+        h.update(f'table:{obj.colnames};'.encode())
+        for name in obj.colnames:
+            col = obj[name]
+            _update_hash(h, str(getattr(col, 'unit', None)))
+            _update_hash(h, np.ma.getdata(col))
+            mask = getattr(col, 'mask', None)
+            if mask is not None:
+                _update_hash(h, np.ma.getmaskarray(col))
+    elif hasattr(obj, 'items') and hasattr(obj, 'keys'):
+        # other mappings, e.g. a LayeredConfig
+        _update_hash(h, dict(obj.items()))
+    else:
+        h.update(b'pickle:')
+        h.update(pickle.dumps(obj, protocol=4))
+
+    return
+
+def fingerprint(*args, **kwargs) -> str:
+    '''
+    Compute a canonical hash of the passed args, e.g. a config dict as
+    returned by parse_config(), a seed from generate_seeds(), and any numpy
+    array or astropy Table inputs. Dicts are hashed independently of their
+    key order, arrays by their dtype, shape & data, and objects of other
+    types by their pickle
+
+    returns:
+    digest: str
+        The hex digest
+    '''
+
+    h = hashlib.blake2b(digest_size=20)
+    _update_hash(h, args)
+    _update_hash(h, kwargs)
+
+    return h.hexdigest()
+
+class ResultCache(object):
+    '''
+    A directory of pickled task results, keyed by a fingerprint of the task
+    inputs. Writes are atomic, so a crash never leaves a corrupt result
+    behind, and the cache can be shared by many worker processes
+
+    e.g.:
+    cache = ResultCache('cache/', max_size=50 * 1024**3)
+
+    @cache.memoize(version=2)
+    def measure(obj_config, seed=None, image=None):
+        ...
+
+    # rerunning after a crash or a config change only computes the tasks
+    # whose config, seed or image changed
+    results = parallel_map(measure, configs, master_seed=42)
+
+    The least recently used results are evicted once the cache grows beyond
+    max_size, down to EVICT_FRACTION of it. Hit, miss & write counts are kept per process in stats
+    '''
+
+    SUFFIX = '.pkl'
+
+    # a full cache is evicted down to this fraction of max_size
+    EVICT_FRACTION = 0.9
+
+    def __init__(self, root: str | Path, max_size: int | None = None):
+        '''
+        root: str, Path
+            The cache directory. Created if it does not exist
+        max_size: int
+            The maximum total size of the stored results in bytes. Defaults to
+            None, i.e. no eviction
+        '''
+
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+
+        self.stats = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0}
+
+        # updated on writes, and refreshed from disk when evicting
+        self._size = None
+
+        return
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / f'{key}{self.SUFFIX}'
+
+    def __contains__(self, key: str) -> bool:
+        return self._path(key).exists()
+
+    def get(self, key: str, default=None):
+        '''
+        Return the stored result for key, or default if there is none
+        '''
+
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            self.stats['misses'] += 1
+            return default
+
+        self.stats['hits'] += 1
+
+        # mark as recently used for the eviction order
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return value
+
+    def set(self, key: str, value) -> None:
+        '''
+        Atomically store the result for key
+        '''
+
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+
+        tmp_file = path.with_name(f'.{path.name}.{uuid.uuid4().hex}.tmp')
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, path)
+
+        self.stats['writes'] += 1
+
+        if self.max_size is not None:
+            if self._size is None:
+                self._size = self.size
+            else:
+                self._size += path.stat().st_size
+            if self._size > self.max_size:
+                # down to a low-water mark, so that a full cache isn't
+                # rescanned on every write
+                self.evict(int(self.max_size * self.EVICT_FRACTION))
+
+        return
+
+    def _entries(self) -> list:
+        entries = []
+        for subdir in os.scandir(self.root):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.endswith(self.SUFFIX) and \
+                   not entry.name.startswith('.'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        return entries
+
+    @property
+    def size(self) -> int:
+        '''
+        The total size of the stored results in bytes
+        '''
+        return sum(size for _, size, _ in self._entries())
+
+    def __len__(self):
+        return len(self._entries())
+
+    def evict(self, max_size: int) -> int:
+        '''
+        Remove the least recently used results until the cache is no larger
+        than max_size. Returns the number of bytes freed
+        '''
+
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+
+        freed = 0
+        for _, size, path in entries:
+            if total - freed <= max_size:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            freed += size
+            self.stats['evictions'] += 1
+
+        self._size = total - freed
+
+        return freed
+
+    def clear(self) -> None:
+        '''
+        Remove all stored results
+        '''
+
+        for _, _, path in self._entries():
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+        self._size = 0
+
+        return
+
+    def key(self, func, args: tuple, kwargs: dict, version=None) -> str:
+        '''
+        The cache key of a call of func with the given args
+        '''
+
+        name = f'{func.__module__}.{func.__qualname__}'
+
+        return fingerprint(name, version, args, kwargs)
+
+    def memoize(self, func=None, version=None, ignore: tuple = ()):
+        '''
+        Decorator that stores the results of func in the cache, keyed by its
+        name, version & a fingerprint of its args. Can be used as @memoize or
+        @memoize(version=..., ignore=...)
+
+        func: callable
+            The function to memoize
+        version: any
+            Bump to invalidate the stored results, e.g. after changing func
+        ignore: tuple of str
+            Names of kwargs that don't affect the result (e.g. logprint), and
+            so are left out of the fingerprint
+        '''
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                key_kwargs = {
+                    k: v for k, v in kwargs.items() if k not in ignore
+                    }
+                key = self.key(func, args, key_kwargs, version=version)
+
+                missing = object()
+                result = self.get(key, default=missing)
+                if result is not missing:
+                    return result
+
+                result = func(*args, **kwargs)
+                self.set(key, result)
+
+                return result
+
+            wrapper.cache = self
+
+            return wrapper
+
+        if func is not None:
+            return decorator(func)
+
+        return decorator
+
+    def __repr__(self):
+        return f'ResultCache(root={str(self.root)!r}, stats={self.stats})'
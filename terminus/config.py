@@ -1,33 +1,169 @@
 import yaml
 import re
+import os
+import pickle
+import time
+import itertools
+import copy
+from collections.abc import Mapping
+from numpy.random import SeedSequence, default_rng
 from pathlib import Path
 
-def read_yaml(yaml_file):
+# current package has a problem reading scientific notation as floats; see
+# https://stackoverflow.com/questions/30458977/yaml-loads-5e-6-as-string-and-not-a-number
+_SCI_FLOAT_REGEX = re.compile(u'''^(?:
+    [-+]?(?:[0-9][0-9_]*)\\.[0-9_]*(?:[eE][-+]?[0-9]+)?
+    |[-+]?(?:[0-9][0-9_]*)(?:[eE][-+]?[0-9]+)
+    |\\.[0-9_]+(?:[eE][-+][0-9]+)?
+    |[-+]?[0-9][0-9_]*(?::[0-5]?[0-9])+\\.[0-9_]*
+    |[-+]?\\.(?:inf|Inf|INF)
+    |\\.(?:nan|NaN|NAN))$''', re.X)
+
+# bump if the sidecar payload format changes
+_SIDECAR_VERSION = 1
+_SIDECAR_SUFFIX = '.pkl'
+
+# parse cache of {resolved path: (mtime_ns, size, pickled config)}
+_YAML_CACHE = {}
+
+def _build_yaml_loader():
     '''
-    current package has a problem reading scientific notation as
-    floats; see
-    https://stackoverflow.com/questions/30458977/yaml-loads-5e-6-as-string-and-not-a-number
+    Build the yaml loader used by read_yaml. This is done once at import, as
+    adding the implicit resolver to the shared yaml.SafeLoader on every read
+    grows its resolver list without bound. Uses the libyaml-backed CSafeLoader
+    if available
     '''
 
-    loader = yaml.SafeLoader
-    loader.add_implicit_resolver(
+    base = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+    # subclassing ensures add_implicit_resolver() copies the resolver table
+    # instead of mutating the one on the base loader
+    class TerminusLoader(base):
+        pass
+
+    TerminusLoader.add_implicit_resolver(
         u'tag:yaml.org,2002:float',
-        re.compile(u'''^(?:
-        [-+]?(?:[0-9][0-9_]*)\\.[0-9_]*(?:[eE][-+]?[0-9]+)?
-        |[-+]?(?:[0-9][0-9_]*)(?:[eE][-+]?[0-9]+)
-        |\\.[0-9_]+(?:[eE][-+][0-9]+)?
-        |[-+]?[0-9][0-9_]*(?::[0-5]?[0-9])+\\.[0-9_]*
-        |[-+]?\\.(?:inf|Inf|INF)
-        |\\.(?:nan|NaN|NAN))$''', re.X),
-        list(u'-+0123456789.'))
-
-    with open(yaml_file, 'r') as stream:
-        # return yaml.safe_load(stream) # see above issue
-        return yaml.load(stream, Loader=loader)
+        _SCI_FLOAT_REGEX,
+        list(u'-+0123456789.')
+        )
+
+    return TerminusLoader
+
+YAML_LOADER = _build_yaml_loader()
+
+def _sidecar_file(yaml_file: Path) -> Path:
+    return yaml_file.with_name(yaml_file.name + _SIDECAR_SUFFIX)
+
+def _read_sidecar(yaml_file: Path, mtime_ns: int, size: int) -> bytes | None:
+    '''
+    Return the pickled config stored in the sidecar of yaml_file if it
+    matches the passed mtime & size, and None otherwise
+    '''
+
+    try:
+        with open(_sidecar_file(yaml_file), 'rb') as f:
+            sidecar = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+
+    if (not isinstance(sidecar, dict)) or \
+       (sidecar.get('version') != _SIDECAR_VERSION) or \
+       (sidecar.get('mtime_ns') != mtime_ns) or \
+       (sidecar.get('size') != size):
+        return None
+
+    return sidecar.get('data')
+
+def _write_sidecar(yaml_file: Path, mtime_ns: int, size: int, data: bytes):
+    '''
+    Atomically write the pickled config to the sidecar of yaml_file. Failures
+    (e.g. a read-only config dir) are ignored, as the sidecar is only a cache
+    '''
+
+    sidecar_file = _sidecar_file(yaml_file)
+    tmp_file = sidecar_file.with_name(f'{sidecar_file.name}.{os.getpid()}.tmp')
+
+    sidecar = {
+        'version': _SIDECAR_VERSION,
+        'mtime_ns': mtime_ns,
+        'size': size,
+        'data': data,
+        }
+
+    try:
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(sidecar, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, sidecar_file)
+    except OSError:
+        try:
+            tmp_file.unlink()
+        except OSError:
+            pass
+
+    return
+
+def read_yaml(yaml_file, cache: bool=True, sidecar: bool=False):
+    '''
+    Read a yaml file, correctly parsing scientific notation as floats (see
+    _SCI_FLOAT_REGEX above)
+
+    yaml_file: str, Path
+        The path of the yaml file to read
+    cache: bool
+        Whether to cache the parsed file in memory, keyed on its path, mtime
+        and size. Each call still returns an independent copy, so the result
+        is safe to modify
+    sidecar: bool
+        Whether to also store the parsed file in a pickled sidecar next to it
+        ({yaml_file}.pkl), so that unchanged files load quickly in new
+        processes as well
+    '''
+
+    if (cache is False) and (sidecar is False):
+        with open(yaml_file, 'r') as stream:
+            return yaml.load(stream, Loader=YAML_LOADER)
+
+    yaml_file = Path(yaml_file).resolve()
+    stat = yaml_file.stat()
+    mtime_ns, size = stat.st_mtime_ns, stat.st_size
+
+    data = None
+    if cache is True:
+        cached = _YAML_CACHE.get(yaml_file)
+        if (cached is not None) and (cached[0:2] == (mtime_ns, size)):
+            data = cached[2]
+
+    if (data is None) and (sidecar is True):
+        data = _read_sidecar(yaml_file, mtime_ns, size)
+
+    if data is None:
+        with open(yaml_file, 'r') as stream:
+            config = yaml.load(stream, Loader=YAML_LOADER)
+        data = pickle.dumps(config, protocol=pickle.HIGHEST_PROTOCOL)
+
+        if sidecar is True:
+            _write_sidecar(yaml_file, mtime_ns, size, data)
+    else:
+        # a fresh copy for each caller, as the config is often modified
+        config = pickle.loads(data)
+
+    if cache is True:
+        _YAML_CACHE[yaml_file] = (mtime_ns, size, data)
+
+    return config
+
+def clear_yaml_cache():
+    '''
+    Clear the in-memory read_yaml parse cache. Sidecar files are left as-is
+    '''
+
+    _YAML_CACHE.clear()
+
+    return
 
 def write_yaml(yaml_dict: dict, yaml_outfile: str, clobber: bool=False):
     '''
-    yaml_dict: dict
+    yaml_dict: dict, LayeredConfig
         The dictionary to save to a yaml config file
     yaml_outfile: str
         The path of the output config file
@@ -35,6 +171,9 @@ def write_yaml(yaml_dict: dict, yaml_outfile: str, clobber: bool=False):
         Whether to overwrite the file if it already exists
     '''
 
+    if isinstance(yaml_dict, LayeredConfig):
+        yaml_dict = yaml_dict.to_dict()
+
     yaml_outfile = Path(yaml_outfile)
     if yaml_outfile.exists():
         if clobber is False:
@@ -45,12 +184,18 @@ def write_yaml(yaml_dict: dict, yaml_outfile: str, clobber: bool=False):
     with open(yaml_outfile, 'w') as yaml_file:
         yaml.dump(yaml_dict, yaml_file, default_flow_style=False)
 
+    # don't rely on the mtime resolution to invalidate a cached parse
+    _YAML_CACHE.pop(yaml_outfile.resolve(), None)
+
     return
 
 def recursive_update(d: dict, u: dict) -> dict:
     '''
     Recursively update a dictionary with another dictionary, similarly to dict.update()
 
+    NOTE: d is modified in place. To build many variants of a base config
+    without copying it, see LayeredConfig
+
     d: dict
         The dictionary to update
     u: dict
@@ -69,6 +214,380 @@ def recursive_update(d: dict, u: dict) -> dict:
 
     return d
 
+class LayeredConfig(Mapping):
+    '''
+    A read-only, layered view of a base config and any number of override
+    dicts, similar to a nested collections.ChainMap. Overrides are applied
+    with the same precedence as successive calls to recursive_update(), but
+    nothing is copied or modified; nested keys are resolved lazily on access
+
+    e.g.:
+    base = read_yaml('pipeline.yaml')
+    variant = LayeredConfig(base, {'psf': {'fwhm': 0.8}})
+    variant['psf']['fwhm'] # 0.8
+    variant['psf']['model'] # from base
+    variant.to_dict() # plain nested dict, e.g. for write_yaml()
+
+    Later layers take precedence. Where a layer has a dict value for a key, it
+    is merged with the dict values of the layers below it; any other value
+    replaces the values of all layers below it. Nested dicts are returned as
+    LayeredConfig views, so the underlying layers can't be modified through
+    the view. Non-dict values are returned as-is and are shared with the
+    layers, so mutable leaves (e.g. lists) should not be modified in place
+    '''
+
+    __slots__ = ('_layers',)
+
+    def __init__(self, base: dict, *overrides: dict):
+        '''
+        base: dict
+            The base config
+        overrides: dicts
+            Override dicts, in increasing order of precedence
+        '''
+
+        layers = []
+        for layer in (base, *overrides):
+            if isinstance(layer, LayeredConfig):
+                layers.extend(layer._layers)
+            elif isinstance(layer, Mapping):
+                layers.append(layer)
+            else:
+                raise TypeError('LayeredConfig layers must be dicts')
+
+        self._layers = tuple(layers)
+
+        return
+
+    @classmethod
+    def _from_layers(cls, layers):
+        view = cls.__new__(cls)
+        view._layers = tuple(layers)
+
+        return view
+
+    @property
+    def layers(self) -> tuple:
+        '''
+        The underlying layers, in increasing order of precedence
+        '''
+        return self._layers
+
+    def new_layer(self, override: dict) -> 'LayeredConfig':
+        '''
+        Return a new view with override stacked on top of the current layers
+        '''
+
+        if not isinstance(override, Mapping):
+            raise TypeError('LayeredConfig layers must be dicts')
+
+        return LayeredConfig._from_layers(self._layers + (override,))
+
+    def __getitem__(self, key):
+        # only the layers above the topmost non-dict value are merged
+        sub_layers = []
+        for layer in reversed(self._layers):
+            if key not in layer:
+                continue
+            value = layer[key]
+            if not isinstance(value, Mapping):
+                if len(sub_layers) == 0:
+                    return value
+                break
+            sub_layers.append(value)
+
+        if len(sub_layers) == 0:
+            raise KeyError(key)
+
+        sub_layers.reverse()
+
+        return LayeredConfig._from_layers(sub_layers)
+
+    def __contains__(self, key):
+        for layer in self._layers:
+            if key in layer:
+                return True
+
+        return False
+
+    def __iter__(self):
+        if len(self._layers) == 1:
+            return iter(self._layers[0])
+
+        keys = {}
+        for layer in self._layers:
+            keys.update(dict.fromkeys(layer))
+
+        return iter(keys)
+
+    def __len__(self):
+        if len(self._layers) == 1:
+            return len(self._layers[0])
+
+        return len(set().union(*self._layers))
+
+    def to_dict(self) -> dict:
+        '''
+        Materialize the view as a plain nested dict. Nested dicts are new
+        objects, while all other values are shared with the layers
+        '''
+
+        config = {}
+        for key in self:
+            value = self[key]
+            if isinstance(value, LayeredConfig):
+                value = value.to_dict()
+            config[key] = value
+
+        return config
+
+    def __repr__(self):
+        return f'LayeredConfig({self.to_dict()!r})'
+
+def expand_dotted(d: dict) -> dict:
+    '''
+    Expand a dictionary with dotted keys into a nested dictionary, e.g.
+    {'psf.fwhm': 0.8, 'psf.model': 'moffat'} -> {'psf': {'fwhm': 0.8, 'model': 'moffat'}}
+
+    d: dict
+        The dictionary with (possibly) dotted str keys
+    '''
+
+    nested = {}
+    for key, value in d.items():
+        *parents, leaf = key.split('.')
+        sub = nested
+        for parent in parents:
+            sub = sub.setdefault(parent, {})
+            if not isinstance(sub, dict):
+                raise ValueError(f'{key} conflicts with a non-dict value of another key')
+        if isinstance(value, dict):
+            # copied, so that merging later keys never mutates the caller's
+            # dicts (e.g. the grid values of a ParameterSweep)
+            value = copy.deepcopy(value)
+        if isinstance(sub.get(leaf), dict) and isinstance(value, dict):
+            recursive_update(sub[leaf], value)
+        else:
+            sub[leaf] = value
+
+    return nested
+
+class ParameterSweep(object):
+    '''
+    A lazily-evaluated sweep of variants of a base config. Variants are never
+    all held in memory; each one is a LayeredConfig of the base config and a
+    small override dict, built on demand from its index
+
+    e.g.:
+    sweep = ParameterSweep(
+        read_yaml('pipeline.yaml'),
+        grid={'psf.fwhm': [0.6, 0.8, 1.0], 'noise.sigma': [1e-3, 1e-2]},
+        zipped=[{'shear.g1': [0.02, -0.02], 'shear.g2': [0.0, 0.0]}],
+        random={'galaxy.hlr': ('uniform', 0.3, 1.5)},
+        nrandom=10,
+        seed=42
+        )
+    for index, config in sweep:
+        ...
+    sweep.write('sweep_configs/')
+
+    The sweep spec is made up of the following axes, and the variants are
+    their Cartesian product in this order (the last axis varying fastest):
+      - grid: each dotted key is its own axis over the listed values
+      - zipped: each dict of dotted keys is a single axis, whose lists of
+        values (all of the same length) are stepped through together
+      - random: an axis of nrandom draws of each dotted key. A draw is either
+        a (method, *args) tuple of a numpy Generator method, e.g.
+        ('normal', 0, 1), or a callable that takes the Generator
+
+    The index of each variant is stable for a given spec, and the random
+    draws of each variant only depend on the seed & its index, so any variant
+    can be regenerated on its own (e.g. sweep[index])
+    '''
+
+    def __init__(self, base: dict, grid: dict=None, zipped: list=None, random: dict=None, nrandom: int=None, seed: int=None):
+        '''
+        base: dict, LayeredConfig
+            The base config that all variants override
+        grid: dict
+            A dictionary in the format of {'dotted.key': [values]}
+        zipped: list of dicts
+            A list of dictionaries in the format of {'dotted.key': [values]},
+            each of which is a single sweep axis
+        random: dict
+            A dictionary in the format of {'dotted.key': (method, *args)} or
+            {'dotted.key': callable(rng)}
+        nrandom: int
+            The number of random draws for each point of the grid & zipped axes.
+            Defaults to 1 if random is set
+        seed: int
+            The master seed for the random draws. If not set, one is generated
+            from the current time & is stored as the seed attribute
+        '''
+
+        if not isinstance(base, Mapping):
+            raise TypeError('base must be a dict')
+        if (grid is not None) and (not isinstance(grid, dict)):
+            raise TypeError('grid must be a dict')
+        if (zipped is not None) and (not isinstance(zipped, list)):
+            raise TypeError('zipped must be a list of dicts')
+        if (random is not None) and (not isinstance(random, dict)):
+            raise TypeError('random must be a dict')
+
+        if grid is None:
+            grid = {}
+        if zipped is None:
+            zipped = []
+        if random is None:
+            random = {}
+
+        self.base = base
+
+        # each axis is a list of override dicts with dotted keys
+        self._axes = []
+
+        for key, values in grid.items():
+            values = list(values)
+            if len(values) == 0:
+                raise ValueError(f'grid values for {key} must not be empty')
+            self._axes.append([{key: value} for value in values])
+
+        for group in zipped:
+            if not isinstance(group, dict):
+                raise TypeError('zipped must be a list of dicts')
+            lengths = {key: len(values) for key, values in group.items()}
+            if len(set(lengths.values())) != 1:
+                raise ValueError(f'zipped values must all have the same length; got {lengths}')
+            columns = [list(values) for values in group.values()]
+            self._axes.append([
+                dict(zip(group.keys(), row)) for row in zip(*columns)
+                ])
+
+        for key, draw in random.items():
+            if callable(draw):
+                continue
+            if (not isinstance(draw, tuple)) or (not isinstance(draw[0], str)):
+                raise TypeError(f'random draw for {key} must be a (method, *args) tuple or a callable')
+
+        self._random = random
+
+        if len(random) > 0:
+            if nrandom is None:
+                nrandom = 1
+            if (not isinstance(nrandom, int)) or (nrandom < 1):
+                raise ValueError('nrandom must be a positive int!')
+        else:
+            if nrandom is not None:
+                raise ValueError('nrandom requires random to be set')
+            nrandom = 1
+
+        self.nrandom = nrandom
+
+        if seed is None:
+            # local time in microseconds, as in seeds.generate_seeds()
+            seed = int(time.time()*1e6)
+        self.seed = seed
+
+        # the random axis is always last, so it varies fastest
+        self._shape = tuple(len(axis) for axis in self._axes) + (nrandom,)
+
+        return
+
+    def __len__(self):
+        n = 1
+        for size in self._shape:
+            n *= size
+
+        return n
+
+    def _draw(self, index: int) -> dict:
+        if len(self._random) == 0:
+            return {}
+
+        rng = default_rng(SeedSequence(self.seed, spawn_key=(index,)))
+
+        draws = {}
+        for key, draw in self._random.items():
+            if callable(draw):
+                value = draw(rng)
+            else:
+                value = getattr(rng, draw[0])(*draw[1:])
+            # numpy scalars can't be written to yaml with a SafeDumper
+            if hasattr(value, 'item') and getattr(value, 'ndim', None) == 0:
+                value = value.item()
+            draws[key] = value
+
+        return draws
+
+    def _overrides(self, index: int, axis_indices) -> dict:
+        overrides = {}
+        for axis, i in zip(self._axes, axis_indices):
+            overrides.update(axis[i])
+        overrides.update(self._draw(index))
+
+        return expand_dotted(overrides)
+
+    def overrides(self, index: int) -> dict:
+        '''
+        Return the nested override dict of the variant with the given index
+        '''
+
+        if index < 0:
+            index += len(self)
+        if (index < 0) or (index >= len(self)):
+            raise IndexError(f'sweep index {index} out of range')
+
+        axis_indices = []
+        remainder = index
+        for size in reversed(self._shape):
+            remainder, i = divmod(remainder, size)
+            axis_indices.append(i)
+        axis_indices.reverse()
+
+        return self._overrides(index, axis_indices[:-1])
+
+    def __getitem__(self, index: int) -> LayeredConfig:
+        return LayeredConfig(self.base, self.overrides(index))
+
+    def __iter__(self):
+        '''
+        Yields (index, config) tuples, where config is a LayeredConfig of the
+        base config & the variant overrides
+        '''
+
+        ranges = [range(size) for size in self._shape]
+        for index, axis_indices in enumerate(itertools.product(*ranges)):
+            overrides = self._overrides(index, axis_indices[:-1])
+            yield index, LayeredConfig(self.base, overrides)
+
+    def write(self, out_dir, template: str='config_{index}.yaml', clobber: bool=False) -> list:
+        '''
+        Write all variants to yaml files in a single pass over the sweep
+
+        out_dir: str, Path
+            The directory to write the variant configs to
+        template: str
+            The file name template of each variant, formatted with its index.
+            Defaults to config_{index}.yaml
+        clobber: bool
+            Whether to overwrite the files if they already exist
+
+        returns:
+        outfiles: list of Paths
+            The written files, in index order
+        '''
+
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+
+        outfiles = []
+        for index, config in self:
+            outfile = out_dir / template.format(index=index)
+            write_yaml(config, outfile, clobber=clobber)
+            outfiles.append(outfile)
+
+        return outfiles
+
 def check_req_params(config, params, defaults):
     '''
     Ensure that certain required parameters have their values set to
@@ -138,34 +657,175 @@ def parse_config(config: dict, req: list=None, opt: dict=None, name: str=None, a
 
     if (config is not None) and (not isinstance(config, dict)):
         raise TypeError('config must be a dict')
-    if (req is not None)  and (not isinstance(req, list)):
-        raise TypeError('req must be a list')
-    if (opt is not None) and (not isinstance(opt, dict)):
-        raise TypeError('opt must be a dict!')
 
-    if name is None:
-        name = ''
-    else:
-        name = name + ' '
+    schema = ConfigSchema(
+        req=req,
+        opt=opt,
+        name=name,
+        allow_unregistered=allow_unregistered,
+        set_defaults=set_defaults
+        )
+
+    return schema.parse(config)
+
+class ConfigSchema(object):
+    '''
+    A precompiled version of the req / opt field registration used by
+    parse_config(). The registered fields are interpreted once at
+    construction, so parsing many configs of the same type (e.g. one per
+    object) only pays for set lookups and the actual type checks
+
+    e.g.:
+    schema = ConfigSchema(req=['a', ('b', int)], opt={'c': (float, 1.)})
+    config = schema.parse({'a': 'foo', 'b': 2})
+    configs = schema.parse_many(object_configs)
+
+    Nested configs are supported by registering another ConfigSchema as the
+    type of a field, either as a req tuple ('name', ConfigSchema(...)) or as
+    an opt entry {'name': ConfigSchema(...)}. A registered sub-config must be
+    a dict, which is parsed by the sub-schema. An optional sub-config that is
+    not present is set to the sub-schema defaults if set_defaults is True,
+    unless the sub-schema has req fields, in which case it is left unset
+    '''
 
-    if req is None:
-        req = []
-    if opt is None:
-        opt = {}
+    def __init__(self, req: list=None, opt: dict=None, name: str=None, allow_unregistered: bool=False, set_defaults: bool=True):
+        '''
+        req: list of str or tuples
+            A list of required field names, or tuples in the format of ('name', type)
+        opt: dict
+            A dictionary in the format of {'name': default_value} or {'name': (type, default_value)}
+        name: str
+            Name of config type, for extra print info
+        allow_unregistered: bool
+            Set to allow fields not registered as a req or optional field
+        set_defaults: bool
+            Whether to explicitly set all optional fields to their registered default if they are not present in the config
+        '''
 
-    # ensure all req fields are present
-    check_req_fields(config, req, name=name)
+        if (req is not None)  and (not isinstance(req, list)):
+            raise TypeError('req must be a list')
+        if (opt is not None) and (not isinstance(opt, dict)):
+            raise TypeError('opt must be a dict!')
 
-    # now check for fields not in either
-    if allow_unregistered is False:
-        for field in config:
-            if (not field in req) and (not field in opt):
-                raise ValueError(f'{field} not a valid field for {name}config!')
+        if req is None:
+            req = []
+        if opt is None:
+            opt = {}
 
-    # set defaults for any optional field not present in config
-    if set_defaults is True:
+        self.name = name
+        self.allow_unregistered = allow_unregistered
+        self.set_defaults = set_defaults
+
+        # matches the error message prefix of parse_config()
+        self._prefix = '' if name is None else name + ' '
+
+        # list of (field, type or None, sub-schema or None)
+        self._req = []
+        for entry in req:
+            if isinstance(entry, str):
+                field = entry
+                field_type = None
+            elif isinstance(entry, tuple):
+                if len(entry) != 2:
+                    raise ValueError('req tuple must be in the format of (name, type)')
+                field = entry[0]
+                field_type = entry[1]
+            else:
+                raise TypeError('req entries must be a str or tuple')
+
+            self._req.append((field, *self._split_type(field, field_type)))
+
+        # list of (field, registered value); the registered values are only
+        # checked when a default is actually used, as in parse_config()
+        self._defaults = []
+        self._opt_schemas = {}
         for field, value in opt.items():
-            if field not in config:
+            if isinstance(value, ConfigSchema):
+                self._opt_schemas[field] = self._name_sub_schema(field, value)
+            self._defaults.append((field, value))
+
+        self.fields = frozenset(
+            [entry[0] for entry in self._req] + list(opt.keys())
+            )
+
+        return
+
+    def _split_type(self, field, field_type):
+        '''
+        Returns the (type, sub-schema) pair for a registered req field type
+        '''
+
+        if isinstance(field_type, ConfigSchema):
+            return dict, self._name_sub_schema(field, field_type)
+
+        return field_type, None
+
+    def _name_sub_schema(self, field, schema):
+        '''
+        Sub-schemas without their own name are named after the parent field
+        '''
+
+        if schema.name is not None:
+            return schema
+
+        sub_schema = ConfigSchema.__new__(ConfigSchema)
+        sub_schema.__dict__.update(schema.__dict__)
+        sub_schema.name = f'{self._prefix}{field}'
+        sub_schema._prefix = sub_schema.name + ' '
+
+        return sub_schema
+
+    def parse(self, config: dict) -> dict:
+        '''
+        Check the config against the registered fields and set any missing
+        defaults, raising the same errors as parse_config(). As with
+        parse_config(), the config is updated in place and returned
+
+        config: dict
+            A configuration dictionary to parse
+        '''
+
+        if not isinstance(config, dict):
+            raise TypeError('config must be a dict')
+
+        prefix = self._prefix
+
+        # ensure all req fields are present
+        for field, field_type, sub_schema in self._req:
+            if not field in config:
+                raise ValueError(f'{prefix}config must have field {field}')
+            if field_type is not None:
+                if not isinstance(config[field], field_type):
+                    raise TypeError(f'{prefix}config[{field}] must be a {field_type}')
+            if sub_schema is not None:
+                sub_schema.parse(config[field])
+
+        # now check for fields not in either
+        if self.allow_unregistered is False:
+            if not self.fields.issuperset(config.keys()):
+                for field in config:
+                    if not field in self.fields:
+                        raise ValueError(f'{field} not a valid field for {prefix}config!')
+
+        for field, sub_schema in self._opt_schemas.items():
+            if field in config:
+                if not isinstance(config[field], dict):
+                    raise TypeError(f'{prefix}config[{field}] must be a {dict}')
+                sub_schema.parse(config[field])
+
+        # set defaults for any optional field not present in config
+        if self.set_defaults is True:
+            for field, value in self._defaults:
+                if field in config:
+                    continue
+
+                if field in self._opt_schemas:
+                    sub_schema = self._opt_schemas[field]
+                    # a sub-config with req fields has no default of its own
+                    if len(sub_schema._req) == 0:
+                        config[field] = sub_schema.parse({})
+                    continue
+
                 if isinstance(value, tuple):
                     if len(value) != 2:
                         raise ValueError('opt tuple must be in the format of (type, default_value)')
@@ -173,14 +833,26 @@ def parse_config(config: dict, req: list=None, opt: dict=None, name: str=None, a
                     default = value[1]
 
                     if not isinstance(default, field_type):
-                        raise TypeError(f'{name}config[{field}] must be a {field_type}')
+                        raise TypeError(f'{prefix}config[{field}] must be a {field_type}')
                 else:
-                    field_type = None
                     default = value
 
-                if field_type is not None:
-                    if not isinstance(default, field_type):
-                        raise TypeError(f'{name}config[{field}] registered default must be a {field_type}')
                 config[field] = default
 
-    return config
+        return config
+
+    def parse_many(self, configs: list) -> list:
+        '''
+        Parse each of a list of configs, e.g. one per object. Returns the list
+        of parsed configs
+
+        configs: list of dicts
+            The configuration dictionaries to parse
+        '''
+
+        parse = self.parse
+
+        return [parse(config) for config in configs]
+
+    def __repr__(self):
+        return f'ConfigSchema(name={self.name!r}, fields={list(self.fields)})'
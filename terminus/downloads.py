@@ -2,14 +2,387 @@
 This file contains utility functions for downloading files & extracting archives from remote sources
 '''
 
+import io
+import os
+import contextlib
+import gzip
+import json
+import fnmatch
+import tarfile
+import zipfile
+import time
+import uuid
+import shutil
+import random
+import sqlite3
+import hashlib
+import asyncio
+import threading
+from dataclasses import dataclass
+from urllib.parse import urlsplit
 from pathlib import Path
 import requests
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
 
-def download_file(url: str, output_dir: Path, vb: bool = True) -> Path:
+from terminus.logging import LogPrint
+from terminus.paths import reflink
+
+# appended to the file name of in-progress downloads
+PART_SUFFIX = '.part'
+
+# tracks the progress of each segment of an in-progress segmented download
+SEGMENTS_SUFFIX = '.segments'
+
+# segmented downloads are not split into segments smaller than this
+MIN_SEGMENT_SIZE = 2**20
+
+CHUNK_SIZE = 2**16
+
+# transient errors that a download is resumed after
+_RESUMABLE_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    )
+
+def _url_filename(url: str) -> str:
+    '''
+    The local file name of a URL: the basename of its path, without any
+    query string or fragment
+    '''
+
+    return Path(urlsplit(url).path).name
+
+def _content_range_total(content_range: str | None) -> int | None:
+    '''
+    Parse the total size from a Content-Range header, e.g. 'bytes 0-99/1000'
+    or 'bytes */1000'. Returns None if it is missing or unknown
+    '''
+
+    if content_range is None:
+        return None
+
+    total = content_range.rsplit('/', 1)[-1].strip()
+    if not total.isdigit():
+        return None
+
+    return int(total)
+
+def _content_range_start(content_range: str | None) -> int | None:
+    '''
+    Parse the first byte position from a Content-Range header
+    '''
+
+    if content_range is None:
+        return None
+
+    try:
+        byte_range = content_range.split()[1].split('/')[0]
+        return int(byte_range.split('-')[0])
+    except (IndexError, ValueError):
+        return None
+
+def _download_part(
+        url: str,
+        part_file: Path,
+        timeout: float | None = None,
+        vb: bool = True,
+        session: requests.Session | None = None
+        ) -> tuple[int, int | None]:
+    '''
+    Download url into part_file, resuming from the end of an existing
+    part_file with an HTTP Range request. Falls back to a full download if
+    the server does not honor the range.
+
+    Returns
+    -------
+    tuple[int, int | None]
+        The size of the part file & the expected total size (None if the
+        server did not report it).
+    '''
+
+    start = part_file.stat().st_size if part_file.exists() else 0
+
+    # compressed transfer encodings would make the byte ranges & sizes
+    # refer to a different representation than the one written to disk
+    headers = {'Accept-Encoding': 'identity'}
+    if start > 0:
+        headers['Range'] = f'bytes={start}-'
+
+    get = requests.get if session is None else session.get
+
+    with get(url, stream=True, headers=headers, timeout=timeout) as r:
+        if (r.status_code == 416) and (start > 0):
+            total_size = _content_range_total(r.headers.get('content-range'))
+            if total_size == start:
+                # the part file was already complete
+                return start, total_size
+
+            # otherwise the part file is not a prefix of the remote file
+            part_file.unlink()
+            return _download_part(
+                url, part_file, timeout=timeout, vb=vb, session=session
+                )
+
+        r.raise_for_status()
+
+        content_range = r.headers.get('content-range')
+        if (r.status_code == 206) and (_content_range_start(content_range) == start):
+            total_size = _content_range_total(content_range)
+            mode = 'ab'
+            if vb is True:
+                print(f'Resuming download at {start / 1024:,.2f} KB')
+        else:
+            # range not supported; start over
+            start = 0
+            total_size = int(r.headers.get('content-length', 0)) or None
+            mode = 'wb'
+
+        downloaded_size = start
+        lprint = LogPrint(None, vb)
+
+        with part_file.open(mode) as f:
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+                downloaded_size += len(chunk)
+                if vb and total_size:
+                    lprint.progress(
+                        _progress_msg(downloaded_size, total_size)
+                        )
+
+        # always shows the final state
+        lprint.flush()
+
+    return downloaded_size, total_size
+
+def _progress_msg(downloaded_size: int, total_size: int) -> str:
+    percent_complete = (downloaded_size / total_size) * 100
+
+    return (
+        f'Downloaded {downloaded_size / 1024:,.2f} KB of '
+        f'{total_size / 1024:,.2f} KB ({percent_complete:.2f}%)'
+        )
+
+def _probe_range_support(
+        url: str,
+        session: requests.Session,
+        timeout: float | None = None
+        ) -> int | None:
+    '''
+    Check whether the server honors byte range requests for url with a
+    request for its first byte. Returns the total size of the file if so,
+    and None otherwise
+    '''
+
+    headers = {'Accept-Encoding': 'identity', 'Range': 'bytes=0-0'}
+    with session.get(url, stream=True, headers=headers, timeout=timeout) as r:
+        r.raise_for_status()
+        if r.status_code != 206:
+            return None
+
+        return _content_range_total(r.headers.get('content-range'))
+
+def _read_segments(segments_file: Path, total_size: int) -> list | None:
+    '''
+    Read the [start, end, ndone] progress of each segment of a previous
+    segmented download, if it was for a file of the same total size
+    '''
+
+    try:
+        with segments_file.open('r') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if state.get('total_size') != total_size:
+        return None
+
+    return state.get('segments')
+
+def _write_segments(segments_file: Path, total_size: int, segments: list):
+    tmp_file = segments_file.with_name(segments_file.name + '.tmp')
+    with tmp_file.open('w') as f:
+        json.dump({'total_size': total_size, 'segments': segments}, f)
+    os.replace(tmp_file, segments_file)
+
+    return
+
+def _download_segments(
+        url: str,
+        part_file: Path,
+        nsegments: int,
+        timeout: float | None = None,
+        vb: bool = True
+        ) -> tuple[int, int | None]:
+    '''
+    Download url into part_file by concurrently fetching nsegments byte
+    ranges into a preallocated file. The progress of each segment is stored
+    in a {part_file}.segments file so that an interrupted download can be
+    resumed. Falls back to a single stream with _download_part() if the
+    server does not support range requests.
+
+    Returns
+    -------
+    tuple[int, int | None]
+        The number of bytes downloaded & the expected total size.
+    '''
+
+    segments_file = part_file.with_name(part_file.name + SEGMENTS_SUFFIX)
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(nsegments, 1))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    with session:
+        total_size = _probe_range_support(url, session, timeout=timeout)
+
+        segments = None
+        if total_size is not None:
+            if part_file.exists() and (part_file.stat().st_size == total_size):
+                segments = _read_segments(segments_file, total_size)
+
+        if segments is None:
+            # any existing part file is either from a single stream or is not
+            # resumable, so start over
+            segments_file.unlink(missing_ok=True)
+            if total_size is None:
+                part_file.unlink(missing_ok=True)
+                return _download_part(url, part_file, timeout=timeout, vb=vb)
+
+            nsegments = max(min(nsegments, total_size // MIN_SEGMENT_SIZE), 1)
+            bounds = [(k * total_size) // nsegments for k in range(nsegments+1)]
+            segments = [
+                [bounds[k], bounds[k+1], 0] for k in range(nsegments)
+                ]
+
+            with part_file.open('wb') as f:
+                if hasattr(os, 'posix_fallocate'):
+                    try:
+                        os.posix_fallocate(f.fileno(), 0, total_size)
+                    except OSError:
+                        f.truncate(total_size)
+                else:
+                    f.truncate(total_size)
+
+        _write_segments(segments_file, total_size, segments)
+
+        lock = threading.Lock()
+        failed = threading.Event()
+        progress = {'downloaded_size': sum(seg[2] for seg in segments)}
+
+        fd = os.open(part_file, os.O_WRONLY)
+        lprint = LogPrint(None, vb)
+
+        def fetch(segment):
+            start, end, ndone = segment
+            if start + ndone >= end:
+                return
+
+            headers = {
+                'Accept-Encoding': 'identity',
+                'Range': f'bytes={start+ndone}-{end-1}'
+                }
+            with session.get(
+                    url, stream=True, headers=headers, timeout=timeout
+                    ) as r:
+                r.raise_for_status()
+                content_range = r.headers.get('content-range')
+                if (r.status_code != 206) or \
+                   (_content_range_start(content_range) != start+ndone):
+                    raise IOError(f'Server did not honor the range request for {url}')
+
+                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                    if failed.is_set():
+                        return
+                    # don't write past the segment if the server over-sends
+                    chunk = chunk[:end - (start + segment[2])]
+                    os.pwrite(fd, chunk, start + segment[2])
+                    with lock:
+                        segment[2] += len(chunk)
+                        progress['downloaded_size'] += len(chunk)
+                        downloaded_size = progress['downloaded_size']
+                    if vb:
+                        lprint.progress(
+                            _progress_msg(downloaded_size, total_size)
+                            )
+                    if start + segment[2] >= end:
+                        break
+
+            with lock:
+                _write_segments(segments_file, total_size, segments)
+
+            return
+
+        try:
+            with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+                futures = [executor.submit(fetch, seg) for seg in segments]
+                wait(futures, return_when=FIRST_EXCEPTION)
+                for future in futures:
+                    if future.done() and (future.exception() is not None):
+                        # stop the remaining segments before re-raising
+                        failed.set()
+                        raise future.exception()
+        finally:
+            os.close(fd)
+            lprint.flush()
+            with lock:
+                _write_segments(segments_file, total_size, segments)
+
+    downloaded_size = sum(seg[2] for seg in segments)
+    if downloaded_size == total_size:
+        segments_file.unlink()
+
+    return downloaded_size, total_size
+
+def _complete_part(
+        url: str,
+        part_file: Path,
+        local_filename: Path,
+        downloaded_size: int,
+        total_size: int | None
+        ) -> None:
+    '''
+    Atomically move a finished part file into place, if its size matches the
+    size reported by the server
+    '''
+
+    if (total_size is not None) and (downloaded_size != total_size):
+        raise IOError(
+            f'Downloaded {downloaded_size} bytes of {url} but expected '
+            f'{total_size}; the partial download is kept at {part_file}'
+            )
+
+    os.replace(part_file, local_filename)
+
+    return
+
+def download_file(
+        url: str,
+        output_dir: Path,
+        vb: bool = True,
+        retries: int = 3,
+        timeout: float | None = 60,
+        nsegments: int = 1,
+        cache: 'DownloadCache | None' = None,
+        filename: str | None = None,
+        sha256: str | None = None,
+        verify: bool = False
+        ) -> Path:
     '''
     Downloads a file from a given URL and saves it to the specified output 
     directory, with an optional verbose flag to show download progress.
+
+    The file is downloaded to a temporary {filename}.part file, which is only
+    renamed to the final file name once it is complete & its size matches
+    the size reported by the server. An existing part file (e.g. from an
+    interrupted run) is resumed using an HTTP Range request if the server
+    supports it, as are transfers that fail due to a network error.
+
+    For large files, set nsegments > 1 to split the file into byte ranges
+    that are downloaded concurrently into a preallocated part file. This
+    falls back to a single stream if the server does not support range
+    requests.
     
     Parameters
     ----------
@@ -19,6 +392,26 @@ def download_file(url: str, output_dir: Path, vb: bool = True) -> Path:
         The directory where the file should be saved.
     vb: bool
         Whether to print download status updates to the terminal.
+    retries: int
+        The number of times to resume the download after a network error.
+        Defaults to 3.
+    timeout: float, None
+        The connection & read timeout in seconds for each request. Defaults
+        to 60; set to None to wait indefinitely.
+    nsegments: int
+        The number of byte ranges to download concurrently. Defaults to 1,
+        i.e. a single stream.
+    cache: DownloadCache, None
+        A shared download cache to satisfy the download from, if desired.
+        See DownloadCache.fetch().
+    filename: str, None
+        The name of the downloaded file. Defaults to the basename of the URL.
+    sha256: str, None
+        The expected checksum of the file, if known. A mismatch raises an
+        IOError & the download is discarded.
+    verify: bool
+        Whether to re-hash a cached copy before using it. Only used with a
+        cache.
 
     Returns
     -------
@@ -27,38 +420,61 @@ def download_file(url: str, output_dir: Path, vb: bool = True) -> Path:
     '''
 
     output_dir = Path(output_dir)
-    local_filename = output_dir / Path(url).name
+    if filename is None:
+        filename = _url_filename(url)
+    local_filename = output_dir / filename
+    part_file = local_filename.with_name(local_filename.name + PART_SUFFIX)
+    segments_file = part_file.with_name(part_file.name + SEGMENTS_SUFFIX)
+
+    # checked before the cache, so that an existing file is never replaced
+    if local_filename.exists():
+        print(f'File already exists and will be skipped: {local_filename}')
+        return local_filename
+
+    if cache is not None:
+        return cache.fetch(
+            url, output_dir, filename=filename, sha256=sha256, verify=verify,
+            vb=vb, retries=retries, timeout=timeout, nsegments=nsegments
+            )
 
     if output_dir.is_dir() is False:
-        output_dir.mkdir(parents=True)
+        output_dir.mkdir(parents=True, exist_ok=True)
 
     print(f'Downloading to {local_filename}...')
 
-    if local_filename.exists():
-        print(f'File already exists and will be skipped: {local_filename}')
-        return local_filename
+    for attempt in range(retries+1):
+        try:
+            # a preallocated part file can only be resumed by segment
+            if (nsegments > 1) or segments_file.exists():
+                downloaded_size, total_size = _download_segments(
+                    url, part_file, nsegments, timeout=timeout, vb=vb
+                    )
+            else:
+                downloaded_size, total_size = _download_part(
+                    url, part_file, timeout=timeout, vb=vb
+                    )
+            break
+        except _RESUMABLE_ERRORS as e:
+            if attempt == retries:
+                raise
+            if vb:
+                print(f'\nDownload of {url} interrupted ({e}); retrying...')
+            time.sleep(2**attempt)
 
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        total_size = int(r.headers.get('content-length', 0))
-        downloaded_size = 0
-        chunk_size = 8192
+    if sha256 is not None:
+        checksum = hash_file(part_file)
+        if checksum != sha256.lower():
+            part_file.unlink()
+            segments_file.unlink(missing_ok=True)
+            raise IOError(
+                f'Checksum of {url} is {checksum} but expected {sha256}'
+                )
 
-        with local_filename.open('wb') as f:
-            for chunk in r.iter_content(chunk_size=chunk_size):
-                f.write(chunk)
-                downloaded_size += len(chunk)
-                if vb and total_size > 0:
-                    percent_complete = (downloaded_size / total_size) * 100
-                    print(
-                        f'Downloaded {downloaded_size / 1024:,.2f} KB of '
-                        f'{total_size / 1024:,.2f} KB '
-                        f'({percent_complete:.2f}%)', end='\r'
-                        )
+    _complete_part(url, part_file, local_filename, downloaded_size, total_size)
 
     if vb:
         print(
-            f'\nDownload complete: {downloaded_size / 1024:,.2f} KB downloaded.'
+            f'Download complete: {downloaded_size / 1024:,.2f} KB downloaded.'
             )
 
     return local_filename
@@ -67,7 +483,12 @@ def download_files(
         file_urls: list[str],
         output_dir: str | Path,
         max_workers: int = 4,
-        vb: bool = True
+        vb: bool = True,
+        nsegments: int = 1,
+        cache: 'DownloadCache | None' = None,
+        filenames: list[str | None] | None = None,
+        sha256s: list[str | None] | None = None,
+        verify: bool = False
         ) -> None:
     '''
     Download a list of files concurrently to the specified output directory.
@@ -82,14 +503,37 @@ def download_files(
         The maximum number of concurrent downloads, if necessary
     vb: bool
         Whether to print download status updates to the terminal. Defaults to True.
+    nsegments: int
+        The number of byte ranges to download concurrently for each file.
+        Defaults to 1; see download_file().
+    cache: DownloadCache, None
+        A shared download cache to satisfy the downloads from, if desired.
+    filenames: list[str | None], None
+        The name of each downloaded file, in the same order as file_urls.
+        Defaults to the basenames of the URLs.
+    sha256s: list[str | None], None
+        The expected checksum of each file, if known, in the same order as
+        file_urls.
+    verify: bool
+        Whether to re-hash cached copies before using them. Only used with a
+        cache.
     '''
 
+    if filenames is None:
+        filenames = [None] * len(file_urls)
+    if sha256s is None:
+        sha256s = [None] * len(file_urls)
+    if not (len(filenames) == len(sha256s) == len(file_urls)):
+        raise ValueError('filenames & sha256s must be the length of file_urls')
+
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_url = {
-            executor.submit(
-                download_file, url, output_dir, vb=vb
-                ): url for url in file_urls
-            }
+        future_to_url = {}
+        for url, filename, sha256 in zip(file_urls, filenames, sha256s):
+            future = executor.submit(
+                download_file, url, output_dir, vb=vb, nsegments=nsegments,
+                cache=cache, filename=filename, sha256=sha256, verify=verify
+                )
+            future_to_url[future] = url
         for future in future_to_url:
             try:
                 future.result()
@@ -99,3 +543,873 @@ def download_files(
                 print(f'Failed to download {future_to_url[future]}: {e}')
 
     return
+
+# HTTP status codes that are worth retrying
+_RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+@dataclass
+class DownloadResult:
+    '''
+    The outcome of downloading a single URL with download_many()
+
+    url: str
+        The requested URL
+    path: Path
+        The local path of the file, if it was downloaded or already existed
+    status: str
+        One of 'downloaded', 'skipped' (already existed) or 'failed'
+    nbytes: int
+        The number of bytes downloaded
+    elapsed: float
+        The wall time spent on the URL, in seconds
+    attempts: int
+        The number of attempts made
+    error: str
+        The error message of the last failed attempt, if any
+    '''
+
+    url: str
+    path: Path | None = None
+    status: str = 'failed'
+    nbytes: int = 0
+    elapsed: float = 0.
+    attempts: int = 0
+    error: str | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.status != 'failed'
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, _RESUMABLE_ERRORS):
+        return True
+    if isinstance(error, requests.exceptions.HTTPError):
+        response = error.response
+        return (response is not None) and \
+            (response.status_code in _RETRY_STATUS_CODES)
+
+    return False
+
+async def download_many_async(
+        file_urls: list[str],
+        output_dir: str | Path,
+        max_concurrency: int = 32,
+        max_per_host: int = 8,
+        retries: int = 3,
+        backoff: float = 0.5,
+        timeout: float | None = 60,
+        vb: bool = True
+        ) -> list[DownloadResult]:
+    '''
+    Coroutine version of download_many(), for use inside a running event loop.
+    See download_many() for details.
+    '''
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    # blocking transfers run in a pool sized to the concurrency limit, with
+    # one pooled session per host so connections are reused across files
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=max_concurrency)
+    sessions = {}
+    host_limits = {}
+    limit = asyncio.Semaphore(max_concurrency)
+
+    progress = {'ndone': 0, 'nfailed': 0, 'nbytes': 0, 'last_print': 0.}
+    nurls = len(file_urls)
+    start_time = time.perf_counter()
+
+    def report(final=False):
+        now = time.perf_counter()
+        # at most a few updates per second, from the event loop thread only
+        if (final is False) and (now - progress['last_print'] < 0.5):
+            return
+        progress['last_print'] = now
+        elapsed = now - start_time
+        print(
+            f'Downloaded {progress["ndone"]:,} of {nurls:,} files '
+            f'({progress["nbytes"] / 1024**2:,.2f} MB, '
+            f'{progress["ndone"] / max(elapsed, 1e-9):,.1f} files/s, '
+            f'{progress["nfailed"]:,} failed)',
+            end='\n' if final else '\r'
+            )
+
+        return
+
+    def fetch(url, session, local_filename):
+        part_file = local_filename.with_name(local_filename.name + PART_SUFFIX)
+        downloaded_size, total_size = _download_part(
+            url, part_file, timeout=timeout, vb=False, session=session
+            )
+        _complete_part(
+            url, part_file, local_filename, downloaded_size, total_size
+            )
+
+        return downloaded_size
+
+    async def download(url):
+        result = DownloadResult(url=url)
+        local_filename = output_dir / _url_filename(url)
+        host = urlsplit(url).netloc
+
+        if host not in sessions:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=max_per_host
+                )
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            sessions[host] = session
+            host_limits[host] = asyncio.Semaphore(max_per_host)
+
+        t0 = time.perf_counter()
+
+        if local_filename.exists():
+            result.path = local_filename
+            result.status = 'skipped'
+        else:
+            for attempt in range(retries+1):
+                result.attempts += 1
+                try:
+                    # the host slot is taken first, so tasks queued on a busy
+                    # host don't hold global slots other hosts could use
+                    async with host_limits[host], limit:
+                        result.nbytes = await loop.run_in_executor(
+                            executor, fetch, url, sessions[host], local_filename
+                            )
+                    result.path = local_filename
+                    result.status = 'downloaded'
+                    result.error = None
+                    break
+                except Exception as e:
+                    result.error = f'{type(e).__name__}: {e}'
+                    if (attempt == retries) or (not _is_retryable(e)):
+                        break
+                    # exponential backoff with jitter, outside of the limits
+                    await asyncio.sleep(
+                        backoff * 2**attempt * (1 + random.random())
+                        )
+
+        result.elapsed = time.perf_counter() - t0
+
+        progress['ndone'] += 1
+        progress['nbytes'] += result.nbytes
+        if result.ok is False:
+            progress['nfailed'] += 1
+        if vb is True:
+            report()
+
+        return result
+
+    try:
+        results = await asyncio.gather(*[download(url) for url in file_urls])
+    finally:
+        executor.shutdown(wait=True)
+        for session in sessions.values():
+            session.close()
+
+    if vb is True:
+        report(final=True)
+
+    return list(results)
+
+def download_many(
+        file_urls: list[str],
+        output_dir: str | Path,
+        max_concurrency: int = 32,
+        max_per_host: int = 8,
+        retries: int = 3,
+        backoff: float = 0.5,
+        timeout: float | None = 60,
+        vb: bool = True
+        ) -> list[DownloadResult]:
+    '''
+    Download many (typically small) files to the specified output directory
+    with an asyncio-driven engine. Compared to download_files(), connections
+    are pooled & reused per host, concurrency is bounded both overall and
+    per host, transient failures are retried with exponential backoff, and
+    progress is reported as a single aggregate line. Failures are returned
+    rather than printed. Files are written atomically, as in download_file().
+
+    Parameters
+    ----------
+    file_urls : list[str]
+        A list of URLs to download.
+    output_dir : str, Path
+        The directory where the files should be saved.
+    max_concurrency : int
+        The maximum number of concurrent downloads overall. Defaults to 32.
+    max_per_host : int
+        The maximum number of concurrent downloads (and pooled connections)
+        per host. Defaults to 8.
+    retries : int
+        The number of retries for connection errors, timeouts & retryable
+        HTTP status codes (e.g. 429, 503). Defaults to 3.
+    backoff : float
+        The base delay in seconds of the exponential backoff between retries.
+        Defaults to 0.5.
+    timeout : float, None
+        The connection & read timeout in seconds for each request. Defaults
+        to 60.
+    vb: bool
+        Whether to print aggregate progress to the terminal. Defaults to True.
+
+    Returns
+    -------
+    list[DownloadResult]
+        The result of each URL, in the same order as file_urls.
+    '''
+
+    return asyncio.run(download_many_async(
+        file_urls,
+        output_dir,
+        max_concurrency=max_concurrency,
+        max_per_host=max_per_host,
+        retries=retries,
+        backoff=backoff,
+        timeout=timeout,
+        vb=vb
+        ))
+
+def hash_file(filename: str | Path, algorithm: str = 'sha256') -> str:
+    '''
+    Compute the hex digest of a file, reading it in blocks
+
+    Parameters
+    ----------
+    filename : str, Path
+        The file to hash.
+    algorithm : str
+        Any algorithm supported by hashlib. Defaults to sha256.
+    '''
+
+    h = hashlib.new(algorithm)
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            h.update(block)
+
+    return h.hexdigest()
+
+# a full DownloadCache is evicted down to this fraction of its max_size
+EVICT_FRACTION = 0.9
+
+class DownloadCache(object):
+    '''
+    A local, content-addressed cache of downloaded files that can be shared
+    across projects on the same machine. Files are stored once per sha256
+    checksum under {root}/objects, and a sqlite manifest maps each URL to
+    its checksum & tracks the last access time of each object. Cached files
+    are placed in an output directory with a reflink or hardlink where the
+    filesystem allows, and a copy otherwise, so repeated setups need no
+    network access at all.
+
+    e.g.:
+    cache = DownloadCache(max_size=200 * 1024**3)
+    download_files(urls, 'data/', cache=cache)
+
+    Cached objects are made read-only, as hardlinked files share them. If
+    max_size is set, the least recently used objects are evicted once the
+    cache grows beyond it, down to EVICT_FRACTION of it; files already
+    placed in output directories are unaffected.
+    '''
+
+    _LINK_MODES = ('auto', 'reflink', 'hardlink', 'symlink', 'copy')
+
+    def __init__(
+            self,
+            root: str | Path | None = None,
+            max_size: int | None = None,
+            link: str = 'auto'
+            ):
+        '''
+        Parameters
+        ----------
+        root : str, Path, None
+            The cache directory. Defaults to $TERMINUS_CACHE_DIR, or
+            ~/.cache/terminus/downloads if unset.
+        max_size : int, None
+            The maximum total size of the cached objects in bytes. Defaults to
+            None, i.e. no eviction.
+        link : str
+            How to place cached files in an output directory; one of 'auto'
+            (reflink, then hardlink, then copy), 'reflink', 'hardlink',
+            'symlink' or 'copy'. Defaults to 'auto'.
+        '''
+
+        if root is None:
+            root = os.environ.get(
+                'TERMINUS_CACHE_DIR',
+                Path.home() / '.cache' / 'terminus' / 'downloads'
+                )
+
+        if link not in self._LINK_MODES:
+            raise ValueError(f'link must be one of {self._LINK_MODES}')
+
+        self.root = Path(root)
+        self.max_size = max_size
+        self.link = link
+
+        self.objects_dir = self.root / 'objects'
+        self.tmp_dir = self.root / 'tmp'
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+
+        self.manifest_file = self.root / 'manifest.sqlite'
+        with self._connect() as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS urls '
+                '(url TEXT PRIMARY KEY, sha256 TEXT NOT NULL)'
+                )
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS objects '
+                '(sha256 TEXT PRIMARY KEY, size INTEGER NOT NULL, '
+                'last_access REAL NOT NULL)'
+                )
+
+        return
+
+    @contextlib.contextmanager
+    def _connect(self):
+        '''
+        A manifest connection in a transaction, committed (or rolled back)
+        & closed on exit. A new connection per call keeps the cache safe to
+        share across threads, and sqlite handles locking across processes
+        '''
+
+        db = sqlite3.connect(self.manifest_file, timeout=60)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+        return
+
+    def object_file(self, sha256: str) -> Path:
+        '''
+        The cache path of the object with the given checksum
+        '''
+        return self.objects_dir / sha256[:2] / sha256
+
+    def lookup(self, url: str) -> str | None:
+        '''
+        Return the sha256 checksum of the cached object for url, if any
+        '''
+
+        with self._connect() as db:
+            row = db.execute(
+                'SELECT sha256 FROM urls WHERE url = ?', (url,)
+                ).fetchone()
+
+        return None if row is None else row[0]
+
+    @property
+    def size(self) -> int:
+        '''
+        The total size of the cached objects in bytes
+        '''
+
+        with self._connect() as db:
+            return db.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM objects'
+                ).fetchone()[0]
+
+    def _has_object(self, sha256: str) -> bool:
+        with self._connect() as db:
+            row = db.execute(
+                'SELECT 1 FROM objects WHERE sha256 = ?', (sha256,)
+                ).fetchone()
+
+        return (row is not None) and self.object_file(sha256).exists()
+
+    def _touch(self, sha256: str) -> None:
+        with self._connect() as db:
+            db.execute(
+                'UPDATE objects SET last_access = ? WHERE sha256 = ?',
+                (time.time(), sha256)
+                )
+
+        return
+
+    def _forget(self, sha256: str) -> None:
+        with self._connect() as db:
+            db.execute('DELETE FROM urls WHERE sha256 = ?', (sha256,))
+            db.execute('DELETE FROM objects WHERE sha256 = ?', (sha256,))
+        self.object_file(sha256).unlink(missing_ok=True)
+
+        return
+
+    def add(self, url: str, filename: str | Path, sha256: str | None = None) -> str:
+        '''
+        Move a downloaded file into the cache & register it for url. Returns
+        its sha256 checksum
+
+        Parameters
+        ----------
+        url : str
+            The URL the file was downloaded from.
+        filename : str, Path
+            The downloaded file. It is moved into the cache.
+        sha256 : str, None
+            The expected checksum of the file, if known. A mismatch raises an
+            IOError & the file is discarded.
+        '''
+
+        filename = Path(filename)
+        checksum = hash_file(filename)
+
+        if (sha256 is not None) and (checksum != sha256.lower()):
+            filename.unlink()
+            raise IOError(
+                f'Checksum of {url} is {checksum} but expected {sha256}'
+                )
+
+        object_file = self.object_file(checksum)
+        object_file.parent.mkdir(exist_ok=True)
+        size = filename.stat().st_size
+        os.chmod(filename, 0o444)
+        os.replace(filename, object_file)
+
+        with self._connect() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO objects VALUES (?, ?, ?)',
+                (checksum, size, time.time())
+                )
+            db.execute(
+                'INSERT OR REPLACE INTO urls VALUES (?, ?)', (url, checksum)
+                )
+
+        if self.max_size is not None:
+            with self._connect() as db:
+                total = db.execute(
+                    'SELECT COALESCE(SUM(size), 0) FROM objects'
+                    ).fetchone()[0]
+            if total > self.max_size:
+                # down to a low-water mark, so that a full cache isn't
+                # evicted from on every add
+                self.evict(int(self.max_size * EVICT_FRACTION), keep=checksum)
+
+        return checksum
+
+    def evict(self, max_size: int, keep: str | None = None) -> int:
+        '''
+        Evict the least recently used objects until the cache is no larger
+        than max_size. Returns the number of bytes freed
+
+        Parameters
+        ----------
+        max_size : int
+            The target maximum size of the cache in bytes.
+        keep : str, None
+            The checksum of an object to never evict, e.g. one in use.
+        '''
+
+        with self._connect() as db:
+            rows = db.execute(
+                'SELECT sha256, size FROM objects ORDER BY last_access ASC'
+                ).fetchall()
+
+        total = sum(size for _, size in rows)
+        freed = 0
+        for sha256, size in rows:
+            if total - freed <= max_size:
+                break
+            if sha256 == keep:
+                continue
+            self._forget(sha256)
+            freed += size
+
+        return freed
+
+    def place(self, sha256: str, dest: str | Path) -> Path:
+        '''
+        Place the cached object with the given checksum at dest, using the
+        link mode of the cache. An existing dest is left as it is if it has
+        the same contents, and otherwise raises a FileExistsError rather than
+        being replaced
+        '''
+
+        src = self.object_file(sha256)
+        dest = Path(dest)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+
+        if dest.exists():
+            if os.path.samefile(src, dest) or (hash_file(dest) == sha256):
+                return dest
+            raise FileExistsError(
+                f'{dest} already exists & differs from the cached object {sha256}'
+                )
+        elif dest.is_symlink():
+            # a dangling link, e.g. to an evicted object, holds no data
+            dest.unlink()
+
+        if self.link == 'auto':
+            modes = ('reflink', 'hardlink', 'copy')
+        else:
+            modes = (self.link,)
+
+        for mode in modes:
+            try:
+                if mode == 'reflink':
+                    reflink(src, dest)
+                elif mode == 'hardlink':
+                    os.link(src, dest)
+                elif mode == 'symlink':
+                    dest.symlink_to(src)
+                else:
+                    shutil.copy2(src, dest)
+                    # copies don't share the object, so can be writable
+                    os.chmod(dest, 0o644)
+                break
+            except OSError:
+                if mode == modes[-1]:
+                    raise
+
+        return dest
+
+    def fetch(
+            self,
+            url: str,
+            output_dir: str | Path,
+            filename: str | None = None,
+            sha256: str | None = None,
+            verify: bool = False,
+            vb: bool = True,
+            **kwargs
+            ) -> Path:
+        '''
+        Place the file at url in output_dir, downloading it into the cache
+        first only if it is not already cached
+
+        Parameters
+        ----------
+        url : str
+            The URL of the file.
+        output_dir : str, Path
+            The directory where the file should be placed.
+        filename : str, None
+            The name of the placed file. Defaults to the basename of the URL;
+            set to avoid collisions between URLs with the same basename.
+        sha256 : str, None
+            The expected checksum of the file, if known. A cached object with
+            this checksum satisfies the request even if it was downloaded
+            from a different URL.
+        verify : bool
+            Whether to re-hash a cached object before using it, in case it
+            was corrupted on disk. Corrupt objects are downloaded again.
+        vb: bool
+            Whether to print download status updates to the terminal.
+        kwargs
+            Passed to download_file() on a cache miss, e.g. nsegments.
+
+        Returns
+        -------
+        Path
+            The local path of the placed file.
+        '''
+
+        output_dir = Path(output_dir)
+        if filename is None:
+            filename = _url_filename(url)
+        dest = output_dir / filename
+
+        if sha256 is not None:
+            sha256 = sha256.lower()
+            checksum = sha256 if self._has_object(sha256) else None
+        else:
+            checksum = self.lookup(url)
+            if (checksum is not None) and (not self._has_object(checksum)):
+                checksum = None
+
+        if (checksum is not None) and (verify is True):
+            if hash_file(self.object_file(checksum)) != checksum:
+                if vb is True:
+                    print(f'Cached copy of {url} is corrupt; downloading again')
+                self._forget(checksum)
+                checksum = None
+
+        if checksum is None:
+            # unique per call, so concurrent misses can't collide
+            download_dir = self.tmp_dir / uuid.uuid4().hex
+            try:
+                downloaded = download_file(
+                    url, download_dir, vb=vb, filename=filename, **kwargs
+                    )
+                checksum = self.add(url, downloaded, sha256=sha256)
+            finally:
+                shutil.rmtree(download_dir, ignore_errors=True)
+        else:
+            if vb is True:
+                print(f'Using cached copy of {url}')
+            with self._connect() as db:
+                db.execute(
+                    'INSERT OR REPLACE INTO urls VALUES (?, ?)', (url, checksum)
+                    )
+            self._touch(checksum)
+
+        return self.place(checksum, dest)
+
+# archive suffixes that can be extracted by download_and_extract()
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+ZIP_SUFFIXES = ('.zip',)
+GZIP_SUFFIXES = ('.gz',)
+
+class _HTTPRangeReader(io.RawIOBase):
+    '''
+    A read-only, seekable file object over a remote file that supports range
+    requests. Used to read only the central directory & selected members of a
+    remote zip archive, as zip archives can't be extracted from a stream
+    '''
+
+    def __init__(self, url: str, session: requests.Session, size: int, timeout: float | None = None):
+        super().__init__()
+        self.url = url
+        self.session = session
+        self.size = size
+        self.timeout = timeout
+        self._pos = 0
+
+        return
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self.size + offset
+        else:
+            raise ValueError(f'invalid whence ({whence})')
+
+        return self._pos
+
+    def readinto(self, b):
+        if self._pos >= self.size:
+            return 0
+
+        end = min(self._pos + len(b), self.size) - 1
+        headers = {
+            'Accept-Encoding': 'identity',
+            'Range': f'bytes={self._pos}-{end}'
+            }
+        r = self.session.get(self.url, headers=headers, timeout=self.timeout)
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise IOError(f'Server did not honor the range request for {self.url}')
+
+        n = len(r.content)
+        b[:n] = r.content
+        self._pos += n
+
+        return n
+
+def _archive_type(url: str) -> str:
+    name = _url_filename(url).lower()
+
+    if name.endswith(TAR_SUFFIXES):
+        return 'tar'
+    if name.endswith(ZIP_SUFFIXES):
+        return 'zip'
+    if name.endswith(GZIP_SUFFIXES):
+        return 'gzip'
+
+    raise ValueError(f'{name} is not a supported archive type')
+
+def _member_filter(members) -> callable:
+    '''
+    Turn a members selection (None, a callable, or a list of glob patterns)
+    into a callable that takes a member name
+    '''
+
+    if members is None:
+        return lambda name: True
+    if callable(members):
+        return members
+    if isinstance(members, str):
+        members = [members]
+
+    patterns = list(members)
+
+    return lambda name: any(fnmatch.fnmatch(name, p) for p in patterns)
+
+def _extract_tar_stream(fileobj, output_dir: Path, keep) -> list[Path]:
+    extracted = []
+    # stream mode reads each member once, in order, without seeking
+    with tarfile.open(fileobj=fileobj, mode='r|*') as tar:
+        for member in tar:
+            if not keep(member.name):
+                continue
+            if hasattr(tarfile, 'data_filter'):
+                # rejects absolute paths, links out of output_dir, etc.
+                tar.extract(member, output_dir, filter='data')
+            else:
+                tar.extract(member, output_dir)
+            if member.isfile():
+                extracted.append(output_dir / member.name)
+
+    return extracted
+
+def _extract_zip(fileobj, output_dir: Path, keep) -> list[Path]:
+    extracted = []
+    with zipfile.ZipFile(fileobj) as zf:
+        for member in zf.infolist():
+            if member.is_dir() or (not keep(member.filename)):
+                continue
+            extracted.append(Path(zf.extract(member, output_dir)))
+
+    return extracted
+
+def download_and_extract(
+        url: str,
+        output_dir: str | Path,
+        members=None,
+        timeout: float | None = 60,
+        vb: bool = True
+        ) -> list[Path]:
+    '''
+    Download an archive and extract it to the specified output directory
+    while it downloads, without ever writing the archive itself to disk.
+
+    Tar archives (optionally gzip, bzip2 or xz compressed) are decompressed &
+    extracted straight from the HTTP response stream, and .gz files are
+    decompressed to a file of the same name without the suffix. Zip archives
+    can't be read as a stream, so if the server supports range requests only
+    the central directory & selected members are fetched; otherwise the
+    archive is downloaded to a temporary file first.
+
+    Parameters
+    ----------
+    url : str
+        The URL of the archive to download.
+    output_dir : str, Path
+        The directory where the archive contents should be extracted.
+    members : callable, list[str], None
+        The members to extract, as a list of glob patterns on the member
+        names or a callable that takes a member name & returns whether to
+        extract it. Defaults to None, i.e. all members.
+    timeout : float, None
+        The connection & read timeout in seconds for each request. Defaults
+        to 60.
+    vb: bool
+        Whether to print status updates to the terminal.
+
+    Returns
+    -------
+    list[Path]
+        The local paths of the extracted files.
+    '''
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    archive_type = _archive_type(url)
+    keep = _member_filter(members)
+
+    if vb is True:
+        print(f'Downloading & extracting {url} to {output_dir}...')
+
+    headers = {'Accept-Encoding': 'identity'}
+
+    with requests.Session() as session:
+        if archive_type == 'zip':
+            total_size = _probe_range_support(url, session, timeout=timeout)
+            if total_size is not None:
+                raw = _HTTPRangeReader(url, session, total_size, timeout=timeout)
+                with io.BufferedReader(raw, buffer_size=2**20) as f:
+                    extracted = _extract_zip(f, output_dir, keep)
+            else:
+                tmp_dir = output_dir / f'.{uuid.uuid4().hex}'
+                try:
+                    archive = download_file(
+                        url, tmp_dir, vb=False, timeout=timeout
+                        )
+                    extracted = _extract_zip(archive, output_dir, keep)
+                finally:
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+        else:
+            with session.get(
+                    url, stream=True, headers=headers, timeout=timeout
+                    ) as r:
+                r.raise_for_status()
+                # undo any Content-Encoding the server applied anyway; the
+                # compression of the archive itself is left to tarfile/gzip
+                r.raw.decode_content = True
+                if archive_type == 'tar':
+                    extracted = _extract_tar_stream(r.raw, output_dir, keep)
+                else:
+                    name = _url_filename(url)[:-len('.gz')]
+                    if keep(name):
+                        outfile = output_dir / name
+                        part_file = outfile.with_name(outfile.name + PART_SUFFIX)
+                        with gzip.GzipFile(fileobj=r.raw) as gz, \
+                             part_file.open('wb') as f:
+                            shutil.copyfileobj(gz, f, length=2**20)
+                        os.replace(part_file, outfile)
+                        extracted = [outfile]
+                    else:
+                        extracted = []
+
+    if vb is True:
+        print(f'Extracted {len(extracted)} files from {url}')
+
+    return extracted
+
+def download_and_extract_files(
+        archive_urls: list[str],
+        output_dir: str | Path,
+        members=None,
+        max_workers: int = 4,
+        timeout: float | None = 60,
+        vb: bool = True
+        ) -> dict[str, list[Path]]:
+    '''
+    Download and extract a list of archives concurrently with
+    download_and_extract(). Decompression releases the GIL, so threads
+    extract the archives in parallel.
+
+    Parameters
+    ----------
+    archive_urls : list[str]
+        A list of archive URLs to download & extract.
+    output_dir : str, Path
+        The directory where the archive contents should be extracted.
+    members : callable, list[str], None
+        The members to extract from each archive; see download_and_extract().
+    max_workers : int
+        The maximum number of archives to process concurrently.
+    timeout : float, None
+        The connection & read timeout in seconds for each request.
+    vb: bool
+        Whether to print status updates to the terminal. Defaults to True.
+
+    Returns
+    -------
+    dict[str, list[Path]]
+        The extracted files of each archive that succeeded, keyed by URL.
+    '''
+
+    extracted = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_url = {
+            executor.submit(
+                download_and_extract, url, output_dir, members=members,
+                timeout=timeout, vb=vb
+                ): url for url in archive_urls
+            }
+        for future in future_to_url:
+            try:
+                extracted[future_to_url[future]] = future.result()
+            except Exception as e:
+                print(f'Failed to extract {future_to_url[future]}: {e}')
+
+    return extracted
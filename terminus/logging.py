@@ -1,15 +1,51 @@
 import logging
+import logging.handlers
+import multiprocessing
+import multiprocessing.util
+import contextlib
+import functools
+import threading
+import cProfile
+import atexit
+import weakref
+import json
+import glob
+import time
 import os
 import sys
 
+def _flush_logprint(ref):
+    '''
+    atexit hook for buffered LogPrints; holds a weak reference so that the
+    LogPrint can still be garbage collected
+    '''
+
+    lprint = ref()
+    if lprint is not None:
+        lprint.flush()
+
+    return
+
 class LogPrint(object):
     '''
     This class is used in place of the standard python print for simultaneous printing and logging depending on the desired verbosity
+
+    For chatty loops, set buffered=True to collect console output & write it
+    in batches, and use progress() for status updates that only need to be
+    seen at a human rate. Either way, every message still goes to the log
     '''
 
-    def __init__(self, log, vb):
+    def __init__(self, log, vb, buffered=False, flush_interval=1., max_rate=4.):
         '''
         Requires a logging obj and verbosity level
+
+        buffered: bool
+            Set to buffer console output & write it at most every
+            flush_interval seconds (and on flush(), warnings & exit)
+        flush_interval: float
+            The maximum seconds console output is held in buffered mode
+        max_rate: float
+            The maximum number of progress() updates printed per second
         '''
 
         # Must be either a Logger object or None
@@ -20,6 +56,57 @@ class LogPrint(object):
 
         self.log = log
         self.vb = vb
+        self.buffered = buffered
+        self.flush_interval = flush_interval
+        self.max_rate = max_rate
+
+        self._buffer = []
+        self._buffer_size = 0
+        self._last_flush = time.monotonic()
+        self._last_progress = None
+        self._pending_progress = None
+        # whether the last console line was a progress update ending in \r
+        self._progress_open = False
+        self._lock = threading.Lock()
+        # flushes held output flush_interval seconds after it was buffered,
+        # even if no further messages arrive
+        self._timer = None
+
+        if buffered is True:
+            atexit.register(_flush_logprint, weakref.ref(self))
+
+        return
+
+    def _console(self, msg, end='\n'):
+        '''
+        Write a message to stdout, through the buffer if buffered
+        '''
+
+        if self._progress_open is True:
+            # end the progress line rather than overwriting it
+            self._progress_open = False
+            msg = f'\n{msg}'
+
+        if self.buffered is False:
+            print(msg, end=end)
+            return
+
+        timer = None
+        with self._lock:
+            self._buffer.append(f'{msg}{end}')
+            self._buffer_size += 1
+            due = (time.monotonic() - self._last_flush >= self.flush_interval) \
+                or (self._buffer_size >= 10000)
+            if (due is False) and (self._timer is None):
+                timer = self._timer = threading.Timer(
+                    self.flush_interval, self._write_buffer
+                    )
+
+        if due:
+            self.flush()
+        elif timer is not None:
+            timer.daemon = True
+            timer.start()
 
         return
 
@@ -35,7 +122,88 @@ class LogPrint(object):
         if self.log is not None:
             self.log.info(msg)
         if self.vb is True:
-            print(msg)
+            self._console(msg)
+
+        return
+
+    def progress(self, msg, final=False):
+        '''
+        Report progress, e.g. 'Processed 1000 of 1e6 objects'. Every update
+        is logged, but at most max_rate updates per second are printed, each
+        overwriting the last on the same line. The final update is always
+        printed, either when passed with final=True or on flush()
+
+        e.g.:
+        for i, obj in enumerate(objs):
+            ...
+            lprint.progress(f'Processed {i+1} of {len(objs)}')
+        lprint.progress(f'Processed {len(objs)} objects', final=True)
+
+        msg: str
+            The progress message
+        final: bool
+            Whether this is the last update, which is always printed & ends
+            the progress line
+        '''
+
+        if self.log is not None:
+            self.log.info(msg)
+        if self.vb is not True:
+            return
+
+        now = time.monotonic()
+        with self._lock:
+            if (final is False) and (self._last_progress is not None) and \
+               (now - self._last_progress < 1. / self.max_rate):
+                self._pending_progress = msg
+                return
+            self._pending_progress = None
+            self._last_progress = None if final else now
+            self._progress_open = not final
+
+        # progress lines are already throttled, so bypass the buffer
+        self._write_buffer()
+        sys.stdout.write(f'{msg}\n' if final else f'{msg}\r')
+        sys.stdout.flush()
+
+        return
+
+    def _write_buffer(self):
+        with self._lock:
+            buffer = self._buffer
+            self._buffer = []
+            self._buffer_size = 0
+            self._last_flush = time.monotonic()
+            timer = self._timer
+            self._timer = None
+
+        if timer is not None and timer is not threading.current_thread():
+            timer.cancel()
+
+        if len(buffer) > 0:
+            sys.stdout.write(''.join(buffer))
+            sys.stdout.flush()
+
+        return
+
+    def flush(self):
+        '''
+        Write out any buffered console output & the last progress update
+        '''
+
+        with self._lock:
+            pending = self._pending_progress
+            progress_open = self._progress_open
+            self._pending_progress = None
+            self._last_progress = None
+            self._progress_open = False
+
+        self._write_buffer()
+        if pending is not None:
+            sys.stdout.write(f'{pending}\n')
+        elif progress_open is True:
+            sys.stdout.write('\n')
+        sys.stdout.flush()
 
         return
 
@@ -50,17 +218,41 @@ class LogPrint(object):
     def warning(self, msg):
         self.log.warning(msg)
         if self.vb is True:
-            print(msg)
+            self._console(msg)
+            # don't hold back warnings
+            if self.buffered is True:
+                self.flush()
 
         return
 
+# handlers added to the root logger by Logger, keyed by absolute log file
+# path, so that constructing a Logger more than once doesn't duplicate them
+_HANDLERS = {}
+
 class Logger(object):
 
-    def __init__(self, logfile, logdir=None):
+    def __init__(self, logfile, logdir=None, queue=False, start_method=None):
+        '''
+        logfile: str
+            The name of the log file
+        logdir: str
+            The directory of the log file. Defaults to the current directory
+        queue: bool
+            Set to only enqueue log records on the calling thread (and in any
+            forked worker processes), while a single listener thread in this
+            process does all of the file writes. Keeps logging off the hot
+            path & prevents interleaved output from multiple processes. Use
+            the queue attribute with setup_worker_logging() for workers that
+            are not forked
+        start_method: str
+            The multiprocessing start method of the workers, if not the
+            platform default, as the queue must be created in the same context
+        '''
+
         if logdir is None:
             logdir = './'
 
-        self.logfile = os.path.join(logdir, logfile)
+        self.logfile = os.path.abspath(os.path.join(logdir, logfile))
 
         # only works for newer versions of python
         # log = logging.basicConfig(filename=logfile, level=logging.DEBUG)
@@ -69,15 +261,90 @@ class Logger(object):
         log = logging.getLogger()
         log.setLevel(logging.INFO)
         # log.setLevel(logging.ERROR)
-        handler = logging.FileHandler(self.logfile, 'w', 'utf-8')
-        handler.setFormatter(logging.Formatter('%(name)s %(message)s'))
-        log.addHandler(handler)
+
+        if self.logfile not in _HANDLERS:
+            handler = logging.FileHandler(self.logfile, 'w', 'utf-8')
+            handler.setFormatter(logging.Formatter('%(name)s %(message)s'))
+
+            if queue is True:
+                log_queue = multiprocessing.get_context(start_method).Queue(-1)
+                listener = logging.handlers.QueueListener(
+                    log_queue, handler, respect_handler_level=True
+                    )
+                listener.start()
+                root_handler = logging.handlers.QueueHandler(log_queue)
+                atexit.register(_remove_handlers, self.logfile, os.getpid())
+            else:
+                log_queue = None
+                listener = None
+                root_handler = handler
+
+            log.addHandler(root_handler)
+            _HANDLERS[self.logfile] = {
+                'root_handler': root_handler,
+                'file_handler': handler,
+                'listener': listener,
+                'queue': log_queue,
+                'pid': os.getpid(),
+                }
 
         self.log = log
+        self.queue = _HANDLERS[self.logfile]['queue']
+
+        return
+
+    def close(self):
+        '''
+        Remove this log file's handler from the root logger, writing out any
+        queued records first
+        '''
+
+        _remove_handlers(self.logfile, os.getpid())
 
         return
 
-def setup_logger(logfile, logdir=None):
+def _remove_handlers(logfile, pid):
+    '''
+    Remove the handlers of logfile from the root logger. Only done in the
+    process that created them, as forked workers inherit the registry
+    (and atexit hooks) but must not stop the parent's queue listener
+    '''
+
+    if (logfile not in _HANDLERS) or (_HANDLERS[logfile]['pid'] != pid):
+        return
+
+    handlers = _HANDLERS.pop(logfile)
+    logging.getLogger().removeHandler(handlers['root_handler'])
+    if handlers['listener'] is not None:
+        # flushes the queue before returning
+        handlers['listener'].stop()
+    handlers['file_handler'].close()
+
+    return
+
+def setup_worker_logging(log_queue, level=logging.INFO):
+    '''
+    Route all logging in a worker process to the queue of a Logger created
+    with queue=True in the parent, e.g. as a Pool or ProcessPoolExecutor
+    initializer. Only needed for workers that are not forked, as forked
+    workers already inherit the queue handler
+
+    log_queue: multiprocessing.Queue
+        The queue attribute of the parent's Logger
+    level: int
+        The logging level of the worker
+    '''
+
+    log = logging.getLogger()
+    for handler in list(log.handlers):
+        log.removeHandler(handler)
+
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+    log.setLevel(level)
+
+    return
+
+def setup_logger(logfile, logdir=None, queue=False, start_method=None):
     '''
     Utility function if you just want the log and not the Logger object
     '''
@@ -86,6 +353,442 @@ def setup_logger(logfile, logdir=None):
         if not os.path.exists(logdir):
             os.makedirs(logdir)
 
-    logger = Logger(logfile, logdir=logdir)
+    logger = Logger(
+        logfile, logdir=logdir, queue=queue, start_method=start_method
+        )
 
     return logger.log
+
+# -----------------------------------------------------------------------------
+# Timing & profiling instrumentation. Disabled by default, in which case the
+# timers & counters below do (almost) nothing, so they can be left in
+# production code
+
+_TIMING = {
+    'enabled': False,
+    'profile': False,
+    'trace_dir': None,
+    # {name: [count, total, min, max]} of the timers in this process
+    'timers': {},
+    # {name: total} of the counters in this process
+    'counters': {},
+    # {name: cProfile.Profile} of the profiled regions in this process
+    'profiles': {},
+    # buffered JSON-lines trace events, and the pid that owns the buffer
+    'events': [],
+    'pid': None,
+    }
+
+_TIMING_LOCK = threading.Lock()
+
+# held while a profile_region() is being profiled
+_PROFILE_LOCK = threading.Lock()
+
+# trace events are written out once this many are buffered
+_TRACE_BUFFER_SIZE = 10000
+
+def enable_timing(trace_dir=None, profile=False):
+    '''
+    Enable the timers, counters & profiled regions
+
+    trace_dir: str
+        A directory to write a JSON-lines trace of all timer & counter events
+        to, one file per process, e.g. to aggregate worker processes with
+        collect_timing_stats(). cProfile stats of profiled regions are also
+        written there
+    profile: bool
+        Whether to run cProfile in profile_region() blocks
+    '''
+
+    if trace_dir is not None:
+        os.makedirs(trace_dir, exist_ok=True)
+
+    _TIMING['enabled'] = True
+    _TIMING['profile'] = profile
+    _TIMING['trace_dir'] = trace_dir
+
+    return
+
+def disable_timing():
+    '''
+    Disable the instrumentation, writing out any buffered trace events
+    '''
+
+    flush_timing()
+    _TIMING['enabled'] = False
+    _TIMING['profile'] = False
+
+    return
+
+def reset_timing():
+    '''
+    Clear the statistics collected in this process
+    '''
+
+    with _TIMING_LOCK:
+        _TIMING['timers'].clear()
+        _TIMING['counters'].clear()
+        _TIMING['profiles'].clear()
+        _TIMING['events'].clear()
+
+    return
+
+def _check_process():
+    '''
+    Start fresh statistics in a new process, as forked workers would
+    otherwise inherit (and so double count) those of their parent, & make
+    sure its trace is written out when it exits. Forked multiprocessing
+    workers skip atexit hooks, but run Finalize callbacks
+    '''
+
+    pid = os.getpid()
+    if _TIMING['pid'] == pid:
+        return
+
+    with _TIMING_LOCK:
+        if _TIMING['pid'] == pid:
+            return
+        _TIMING['timers'] = {}
+        _TIMING['counters'] = {}
+        _TIMING['events'] = []
+        _TIMING['profiles'] = {}
+        _TIMING['pid'] = pid
+
+    multiprocessing.util.Finalize(None, flush_timing, exitpriority=10)
+    atexit.register(flush_timing)
+
+    return
+
+def _record(event):
+    _TIMING['events'].append(event)
+    if len(_TIMING['events']) >= _TRACE_BUFFER_SIZE:
+        flush_timing()
+
+    return
+
+def flush_timing():
+    '''
+    Write out the buffered trace events & profiles of this process, if a
+    trace_dir was set
+    '''
+
+    trace_dir = _TIMING['trace_dir']
+    if (trace_dir is None) or (_TIMING['pid'] != os.getpid()):
+        return
+
+    with _TIMING_LOCK:
+        events = _TIMING['events']
+        _TIMING['events'] = []
+
+    if len(events) > 0:
+        trace_file = os.path.join(trace_dir, f'trace-{os.getpid()}.jsonl')
+        with open(trace_file, 'a') as f:
+            f.write(''.join(json.dumps(event) + '\n' for event in events))
+
+    for name, profiler in list(_TIMING['profiles'].items()):
+        safe_name = ''.join(c if c.isalnum() else '_' for c in name)
+        profiler.dump_stats(
+            os.path.join(trace_dir, f'profile-{safe_name}-{os.getpid()}.prof')
+            )
+
+    return
+
+def _add_time(name, start, elapsed):
+    _check_process()
+
+    with _TIMING_LOCK:
+        stats = _TIMING['timers'].get(name)
+        if stats is None:
+            _TIMING['timers'][name] = [1, elapsed, elapsed, elapsed]
+        else:
+            stats[0] += 1
+            stats[1] += elapsed
+            if elapsed < stats[2]:
+                stats[2] = elapsed
+            if elapsed > stats[3]:
+                stats[3] = elapsed
+
+    if _TIMING['trace_dir'] is not None:
+        _record({
+            'type': 'timer', 'name': name, 'start': start,
+            'elapsed': elapsed, 'pid': os.getpid()
+            })
+
+    return
+
+def _timed(name, func):
+    '''
+    Wrap func in a timer. Whether timing is enabled is checked on each call,
+    so functions decorated at import time can be timed later
+    '''
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _TIMING['enabled'] is False:
+            return func(*args, **kwargs)
+
+        start = time.time()
+        t0 = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _add_time(name, start, time.perf_counter() - t0)
+
+    return wrapper
+
+class _NullTimer(object):
+    '''
+    Returned by timer() when timing is disabled
+    '''
+
+    __slots__ = ('name',)
+
+    def __init__(self, name=None):
+        self.name = name
+
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def __call__(self, func):
+        return _timed(self.name, func)
+
+# shared, stateless disabled timers, so disabled timing allocates nothing
+_NULL_TIMERS = {}
+
+class _Timer(_NullTimer):
+
+    __slots__ = ('start', 't0')
+
+    def __enter__(self):
+        self.start = time.time()
+        self.t0 = time.perf_counter()
+
+        return self
+
+    def __exit__(self, *args):
+        _add_time(self.name, self.start, time.perf_counter() - self.t0)
+
+        return False
+
+def timer(name):
+    '''
+    A named timer, to use as a context manager or decorator. The statistics
+    of all timers with the same name are aggregated
+
+    e.g.:
+    with timer('psf_fit'):
+        ...
+
+    @timer('measure')
+    def measure(obj):
+        ...
+
+    name: str
+        The name of the timed region
+    '''
+
+    if _TIMING['enabled'] is False:
+        null_timer = _NULL_TIMERS.get(name)
+        if null_timer is None:
+            null_timer = _NULL_TIMERS[name] = _NullTimer(name)
+        return null_timer
+
+    return _Timer(name)
+
+def count(name, n=1):
+    '''
+    Increment a named counter, e.g. of objects processed or failed fits
+
+    name: str
+        The name of the counter
+    n: int, float
+        The amount to increment by
+    '''
+
+    if _TIMING['enabled'] is False:
+        return
+
+    _check_process()
+
+    with _TIMING_LOCK:
+        _TIMING['counters'][name] = _TIMING['counters'].get(name, 0) + n
+
+    if _TIMING['trace_dir'] is not None:
+        _record({'type': 'counter', 'name': name, 'n': n, 'pid': os.getpid()})
+
+    return
+
+@contextlib.contextmanager
+def profile_region(name):
+    '''
+    Time a region like timer(), and also run cProfile over it if profiling
+    was enabled with enable_timing(profile=True). As only one profiler can
+    run at a time, regions nested in (or running in other threads during) a
+    profiled region are only timed. Profiles of the same name
+    are accumulated, and can be inspected with pstats.Stats(profiler) via
+    get_profile(), or from the .prof files written to the trace_dir
+
+    name: str
+        The name of the profiled region
+    '''
+
+    if _TIMING['enabled'] is False:
+        yield
+        return
+
+    if _TIMING['profile'] is False:
+        with timer(name):
+            yield
+        return
+
+    _check_process()
+
+    # only one profiler can be active per process (and from python 3.12 a
+    # second one raises), so only the outermost active region is profiled;
+    # nested regions & regions entered by other threads meanwhile are timed
+    if not _PROFILE_LOCK.acquire(blocking=False):
+        with timer(name):
+            yield
+        return
+
+    try:
+        profiler = _TIMING['profiles'].get(name)
+        if profiler is None:
+            profiler = _TIMING['profiles'][name] = cProfile.Profile()
+
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiling tool, e.g. an outer cProfile run, is active
+            profiler = None
+
+        with timer(name):
+            try:
+                yield
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+    finally:
+        _PROFILE_LOCK.release()
+
+    return
+
+def get_profile(name):
+    '''
+    Return the accumulated cProfile.Profile of a profiled region in this
+    process, or None
+    '''
+    return _TIMING['profiles'].get(name)
+
+def timing_stats():
+    '''
+    Return a picklable snapshot of the timer & counter statistics of this
+    process, e.g. to return from a worker & combine with merge_timing_stats()
+    '''
+
+    _check_process()
+
+    with _TIMING_LOCK:
+        return {
+            'timers': {
+                name: list(stats) for name, stats in _TIMING['timers'].items()
+                },
+            'counters': dict(_TIMING['counters']),
+            }
+
+def merge_timing_stats(*snapshots):
+    '''
+    Combine snapshots from timing_stats() (e.g. one per worker process) into
+    a single snapshot
+    '''
+
+    merged = {'timers': {}, 'counters': {}}
+    for snapshot in snapshots:
+        for name, (n, total, tmin, tmax) in snapshot['timers'].items():
+            stats = merged['timers'].get(name)
+            if stats is None:
+                merged['timers'][name] = [n, total, tmin, tmax]
+            else:
+                stats[0] += n
+                stats[1] += total
+                stats[2] = min(stats[2], tmin)
+                stats[3] = max(stats[3], tmax)
+        for name, n in snapshot['counters'].items():
+            merged['counters'][name] = merged['counters'].get(name, 0) + n
+
+    return merged
+
+def collect_timing_stats(trace_dir):
+    '''
+    Aggregate the JSON-lines traces of all processes in trace_dir into a
+    single snapshot, as from timing_stats()
+
+    trace_dir: str
+        The trace_dir passed to enable_timing()
+    '''
+
+    flush_timing()
+
+    merged = {'timers': {}, 'counters': {}}
+    for trace_file in sorted(glob.glob(os.path.join(trace_dir, 'trace-*.jsonl'))):
+        with open(trace_file, 'r') as f:
+            for line in f:
+                event = json.loads(line)
+                name = event['name']
+                if event['type'] == 'timer':
+                    elapsed = event['elapsed']
+                    stats = merged['timers'].get(name)
+                    if stats is None:
+                        merged['timers'][name] = [1, elapsed, elapsed, elapsed]
+                    else:
+                        stats[0] += 1
+                        stats[1] += elapsed
+                        stats[2] = min(stats[2], elapsed)
+                        stats[3] = max(stats[3], elapsed)
+                else:
+                    merged['counters'][name] = \
+                        merged['counters'].get(name, 0) + event['n']
+
+    return merged
+
+def timing_table(stats=None):
+    '''
+    Format timer & counter statistics as a summary table, sorted by total
+    time. e.g. lprint(timing_table())
+
+    stats: dict
+        A snapshot as returned by timing_stats(), merge_timing_stats() or
+        collect_timing_stats(). Defaults to the stats of this process
+    '''
+
+    if stats is None:
+        stats = timing_stats()
+
+    timers = sorted(
+        stats['timers'].items(), key=lambda item: item[1][1], reverse=True
+        )
+    width = max([len(name) for name in stats['timers']] +
+                [len(name) for name in stats['counters']] + [6])
+
+    lines = [
+        f'{"timer":<{width}} {"count":>10} {"total [s]":>12} '
+        f'{"mean [s]":>12} {"min [s]":>12} {"max [s]":>12}'
+        ]
+    for name, (n, total, tmin, tmax) in timers:
+        lines.append(
+            f'{name:<{width}} {n:>10d} {total:>12.4f} {total / n:>12.4g} '
+            f'{tmin:>12.4g} {tmax:>12.4g}'
+            )
+
+    if len(stats['counters']) > 0:
+        lines.append('')
+        lines.append(f'{"counter":<{width}} {"total":>10}')
+        for name, n in sorted(stats['counters'].items()):
+            lines.append(f'{name:<{width}} {n:>10}')
+
+    return '\n'.join(lines)
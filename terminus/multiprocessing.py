@@ -1,8 +1,31 @@
+import os
+import json
+import codecs
+import uuid
+import shlex
+import random
+import socket
+import threading
+import asyncio
+import heapq
+import atexit
+import weakref
+import tempfile
+import itertools
 import subprocess
 import sys
+import time
+import traceback
+import multiprocessing
+from dataclasses import dataclass, field
+from collections import deque
+from pathlib import Path
+from multiprocessing import shared_memory, resource_tracker
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import numpy as np
 
 from terminus.logging import LogPrint
+from terminus.seeds import generate_seed
 
 import pdb
 
@@ -33,7 +56,91 @@ def decode(msg: (str | bytes | None)):
         print(f'Warning: message={msg} is not a string or bytes')
         return msg
 
-def run_command(cmd: str, logprint: LogPrint=None, silent: bool=False):
+class _LineSplitter(object):
+    '''
+    Splits output read in arbitrary blocks into lines. Bytes are decoded
+    incrementally (invalid utf-8 is replaced), so a multi-byte character cut
+    by a block boundary is never split, and the pieces of the current line
+    are only joined once it ends. A line longer than max_partial characters
+    is passed on in pieces, so that memory stays bounded even for output
+    without newlines, e.g. \r progress updates
+    '''
+
+    def __init__(self, max_partial: int=2**16):
+        self.max_partial = max_partial
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        # the pieces of the current, not yet terminated line
+        self._partial = []
+        self._npartial = 0
+
+        return
+
+    def feed(self, block: bytes) -> list[str]:
+        '''
+        Add a block of output & return the lines it completed, if any
+        '''
+
+        text = self._decoder.decode(block)
+        end = text.rfind('\n')
+
+        if end < 0:
+            self._partial.append(text)
+            self._npartial += len(text)
+            if self._npartial < self.max_partial:
+                return []
+            complete = ''.join(self._partial)
+            self._partial = []
+            self._npartial = 0
+        else:
+            self._partial.append(text[:end])
+            complete = ''.join(self._partial)
+            self._partial = [text[end+1:]]
+            self._npartial = len(text) - end - 1
+
+        return complete.split('\n')
+
+    def close(self) -> list[str]:
+        '''
+        Return the final, unterminated line, if any
+        '''
+
+        self._partial.append(self._decoder.decode(b'', final=True))
+        rest = ''.join(self._partial)
+        self._partial = []
+        self._npartial = 0
+
+        return [rest] if len(rest) > 0 else []
+
+def run_command(
+        cmd: str,
+        logprint: LogPrint=None,
+        silent: bool=False,
+        buffered: bool=False,
+        block_size: int=2**16,
+        tail_lines: int=100,
+        tee_file: str=None
+        ):
+    '''
+    Run a command, passing its combined stdout & stderr to logprint. Raises a
+    CalledProcessError with the output tail if the command fails
+
+    cmd: str
+        The command to run
+    logprint: LogPrint
+        Where to send the output. Defaults to print
+    silent: bool
+        Set to suppress all output
+    buffered: bool
+        If True, read the output in blocks of up to block_size bytes & pass
+        each block's complete lines to logprint in a single call, instead of
+        one call per line. Much cheaper for very verbose commands
+    block_size: int
+        The maximum number of bytes read at a time in buffered mode
+    tail_lines: int
+        The number of final output lines kept in memory for error reports
+    tee_file: str, Path
+        A file to also write the full output to, if desired
+    '''
 
     if logprint is None:
         # Just remap to print then
@@ -43,48 +150,295 @@ def run_command(cmd: str, logprint: LogPrint=None, silent: bool=False):
     kwargs = {
         'stdout':subprocess.PIPE,
         'stderr':subprocess.STDOUT,
-        'bufsize':1
         }
 
-    with subprocess.Popen(*args, **kwargs) as process:
-        try:
-            # for line in iter(process.stdout.readline, b''):
-            for line in iter(process.stdout.readline, b''):
+    # only the last lines are kept, so memory is bounded for any output size
+    tail = deque(maxlen=tail_lines)
+    tee = open(tee_file, 'wb') if tee_file is not None else None
+
+    try:
+        with subprocess.Popen(*args, **kwargs) as process:
+            try:
+                if buffered is True:
+                    fd = process.stdout.fileno()
+                    splitter = _LineSplitter(max_partial=block_size)
+                    # os.read() returns whatever is available, up to block_size
+                    for block in iter(lambda: os.read(fd, block_size), b''):
+                        if tee is not None:
+                            tee.write(block)
+                        lines = splitter.feed(block)
+                        if len(lines) == 0:
+                            continue
+                        tail.extend(lines)
+                        if silent is False:
+                            logprint('\n'.join(lines))
+                    for line in splitter.close():
+                        tail.append(line)
+                        if silent is False:
+                            logprint(line)
+                else:
+                    for line in iter(process.stdout.readline, b''):
+                        if tee is not None:
+                            tee.write(line)
+                        line = decode(line).replace('\n', '')
+                        tail.append(line)
+                        if silent is False:
+                            logprint(line)
+
+                rc = process.wait()
+
+            except Exception as e:
+                process.kill()
                 if silent is False:
-                    logprint(decode(line).replace('\n', ''))
+                    logprint('')
+                    logprint('.....................ERROR....................')
+                    logprint('')
 
-            stdout, stderr = process.communicate()
+                    logprint('\n'.join(tail))
 
-        except:
-            if silent is False:
-                logprint('')
-                logprint('.....................ERROR....................')
-                logprint('')
-
-                logprint('\n'+decode(stderr))
-
-            rc = process.poll()
-            raise subprocess.CalledProcessError(
-                rc,
-                process.args,
-                output=stdout,
-                stderr=stderr
-                )
+                raise subprocess.CalledProcessError(
+                    process.wait(),
+                    process.args,
+                    output='\n'.join(tail)
+                    ) from e
+    finally:
+        if tee is not None:
+            tee.close()
+
+    if rc:
+        if silent is False:
+            # the full output was already passed to logprint
+            logprint(f'\nCommand failed with return code {rc}')
+        raise subprocess.CalledProcessError(
+            rc,
+            process.args,
+            output='\n'.join(tail)
+            )
+
+    return rc
+
+@dataclass
+class CommandResult:
+    '''
+    The outcome of a single command run by run_commands()
+
+    cmd: str, list
+        The command as passed
+    prefix: str
+        The prefix of its output lines
+    returncode: int
+        The return code, or None if the command was not started
+    elapsed: float
+        The wall time of the command, in seconds
+    tail: list[str]
+        The last lines of its combined stdout & stderr
+    error: str
+        The error message if the command could not be started
+    cancelled: bool
+        Whether the command was cancelled or terminated in fail-fast mode
+        due to the failure of another command
+    '''
+
+    cmd: str | list
+    prefix: str
+    returncode: int | None = None
+    elapsed: float = 0.
+    tail: list = field(default_factory=list)
+    error: str | None = None
+    cancelled: bool = False
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0
+
+async def run_commands_async(
+        cmds: list,
+        max_concurrency: int=4,
+        logprint: LogPrint=None,
+        silent: bool=False,
+        fail_fast: bool=False,
+        prefixes: list=None,
+        tail_lines: int=50,
+        env: dict=None
+        ) -> list[CommandResult]:
+    '''
+    Coroutine version of run_commands(), for use inside a running event loop.
+    See run_commands() for details
+    '''
+
+    if logprint is None:
+        # Just remap to print then
+        logprint = print
+
+    if max_concurrency < 1:
+        raise ValueError('max_concurrency must be >= 1')
+
+    if prefixes is None:
+        width = len(str(len(cmds) - 1))
+        prefixes = [f'{i:0{width}d}' for i in range(len(cmds))]
+    elif len(prefixes) != len(cmds):
+        raise ValueError('prefixes must have the same length as cmds')
+
+    limit = asyncio.Semaphore(max_concurrency)
+    processes = set()
+    failed = asyncio.Event()
 
-        rc = process.poll()
+    def fail():
+        failed.set()
+        for other in list(processes):
+            other.terminate()
 
-        if rc:
-            stdout, stderr = process.communicate()
+        return
+
+    def emit(lines, result, tail, tag):
+        for line in lines:
+            tail.append(line)
             if silent is False:
-                logprint('\n'+decode(stderr))
-            raise subprocess.CalledProcessError(
-                rc,
-                process.args,
-                output=stdout,
-                stderr=stderr
-                )
+                logprint(f'[{result.prefix}{tag}] {line}')
 
-    return rc
+        return
+
+    async def pipe(stream, result, tail, tag, block_size=2**16):
+        # read in blocks & split the lines here, as StreamReader's line
+        # iteration raises on lines longer than its 64 KiB limit
+        splitter = _LineSplitter(max_partial=block_size)
+        while True:
+            block = await stream.read(block_size)
+            if len(block) == 0:
+                break
+            emit(splitter.feed(block), result, tail, tag)
+        emit(splitter.close(), result, tail, tag)
+
+        return
+
+    async def run(cmd, prefix):
+        result = CommandResult(cmd=cmd, prefix=prefix)
+        tail = deque(maxlen=tail_lines)
+
+        async with limit:
+            if failed.is_set():
+                result.cancelled = True
+                return result
+
+            args = shlex.split(cmd) if isinstance(cmd, str) else list(cmd)
+            t0 = time.perf_counter()
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *args,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                    env=env
+                    )
+            except OSError as e:
+                result.error = f'{type(e).__name__}: {e}'
+                if silent is False:
+                    logprint(f'[{prefix}] failed to start: {result.error}')
+                if (fail_fast is True) and (not failed.is_set()):
+                    fail()
+                return result
+
+            processes.add(process)
+            try:
+                try:
+                    await asyncio.gather(
+                        pipe(process.stdout, result, tail, ''),
+                        pipe(process.stderr, result, tail, ':err'),
+                        )
+                except BaseException:
+                    # don't leave the child running if its output can't be
+                    # read (or the run was cancelled)
+                    if process.returncode is None:
+                        process.kill()
+                    await process.wait()
+                    raise
+                result.returncode = await process.wait()
+            finally:
+                processes.discard(process)
+                result.elapsed = time.perf_counter() - t0
+                result.tail = list(tail)
+
+        if result.returncode != 0:
+            if failed.is_set():
+                # terminated due to the failure of another command
+                result.cancelled = True
+            else:
+                if silent is False:
+                    logprint(f'[{prefix}] exited with return code {result.returncode}')
+                if fail_fast is True:
+                    fail()
+
+        return result
+
+    results = await asyncio.gather(*[
+        run(cmd, prefix) for cmd, prefix in zip(cmds, prefixes)
+        ])
+
+    return list(results)
+
+def run_commands(
+        cmds: list,
+        max_concurrency: int=4,
+        logprint: LogPrint=None,
+        silent: bool=False,
+        fail_fast: bool=False,
+        prefixes: list=None,
+        tail_lines: int=50,
+        env: dict=None
+        ) -> list[CommandResult]:
+    '''
+    Run many external commands concurrently, e.g. SExtractor or SWarp calls.
+    The stdout & stderr of all commands are read asynchronously & passed to
+    logprint line by line from a single thread, each line prefixed with its
+    command's prefix (and ':err' for stderr), so output never interleaves
+    within a line
+
+    cmds: list of str or lists
+        The commands to run. Strings are split with shlex
+    max_concurrency: int
+        The maximum number of commands running at once
+    logprint: LogPrint
+        Where to send the output lines. Defaults to print
+    silent: bool
+        Set to suppress all output
+    fail_fast: bool
+        If True, the first failing command terminates the running commands &
+        cancels those not yet started, and a CalledProcessError is raised for
+        it. If False, all commands are run & their results returned
+    prefixes: list of str
+        The output prefix of each command. Defaults to the command index
+    tail_lines: int
+        The number of final output lines kept in each result
+    env: dict
+        The environment of the commands, if not the current one
+
+    returns:
+    results: list of CommandResult
+        The result of each command, in the same order as cmds
+    '''
+
+    results = asyncio.run(run_commands_async(
+        cmds,
+        max_concurrency=max_concurrency,
+        logprint=logprint,
+        silent=silent,
+        fail_fast=fail_fast,
+        prefixes=prefixes,
+        tail_lines=tail_lines,
+        env=env
+        ))
+
+    if fail_fast is True:
+        for result in results:
+            if (result.ok is False) and (result.cancelled is False):
+                # only the command that triggered the failure is reported
+                # 127 is the shell convention for a command not found
+                raise subprocess.CalledProcessError(
+                    result.returncode if result.returncode is not None else 127,
+                    result.cmd,
+                    output='\n'.join(result.tail)
+                    )
+
+    return results
 
 def setup_batches(nobjs: int, ncores: int):
     '''
@@ -107,3 +461,1109 @@ def setup_batches(nobjs: int, ncores: int):
         start += batch_len[i]
 
     return batch_indices
+
+def setup_weighted_batches(costs, ncores: int, method: str='lpt'):
+    '''
+    Create list of batch indices for each core, balancing the total
+    estimated cost of each batch rather than the number of objects
+
+    costs: list, np.ndarray
+        The estimated cost (e.g. runtime, size, or number of exposures) of
+        each object
+    ncores: int
+        The number of batches to create
+    method: str
+        The scheduling method; one of:
+          - 'lpt': longest processing time first, i.e. assign the most
+            expensive remaining object to the least-loaded batch. Gives the
+            best balance
+          - 'greedy': assign each object in order to the least-loaded batch
+          - 'contiguous': split into contiguous index ranges of roughly equal
+            total cost, as returned by setup_batches()
+
+    returns:
+    batch_indices: list
+        A list of np.ndarrays of object indices for each core ('lpt' and
+        'greedy'; each sorted), or of ranges ('contiguous')
+    '''
+
+    if ncores < 1:
+        raise ValueError('ncores must be >= 1')
+
+    costs = np.asarray(costs, dtype=float)
+    if costs.ndim != 1:
+        raise ValueError('costs must be 1-dimensional')
+    if np.any(costs < 0) or (not np.all(np.isfinite(costs))):
+        raise ValueError('costs must be finite and non-negative')
+
+    nobjs = len(costs)
+
+    if method == 'contiguous':
+        # cut the cumulative cost into ncores equal pieces, placing each
+        # object on the side of the cut that its cost midpoint falls on
+        cumulative = np.cumsum(costs)
+        total = cumulative[-1] if nobjs > 0 else 0.
+        targets = total * np.arange(1, ncores) / ncores
+        cuts = np.searchsorted(cumulative - costs / 2, targets, side='right')
+        bounds = np.concatenate([[0], cuts, [nobjs]])
+
+        return [
+            range(int(bounds[i]), int(bounds[i+1])) for i in range(ncores)
+            ]
+
+    if method == 'lpt':
+        # stable, so equal costs keep their original order
+        order = np.argsort(-costs, kind='stable')
+    elif method == 'greedy':
+        order = np.arange(nobjs)
+    else:
+        raise ValueError(f'method must be one of lpt, greedy, or contiguous; got {method}')
+
+    # min-heap of (load, core)
+    loads = [(0., core) for core in range(ncores)]
+    assignment = np.empty(nobjs, dtype=int)
+    for i in order:
+        load, core = loads[0]
+        assignment[i] = core
+        heapq.heapreplace(loads, (load + costs[i], core))
+
+    # indices are returned sorted within each batch, for locality
+    sorted_objs = np.argsort(assignment, kind='stable')
+    counts = np.bincount(assignment, minlength=ncores)
+
+    return np.split(sorted_objs, np.cumsum(counts)[:-1])
+
+def setup_chunks(nobjs: int, ncores: int, chunks_per_core: int=4, chunksize: int=None, costs=None):
+    '''
+    Create list of small contiguous chunks of indices for dynamic dispatch,
+    e.g. with Pool.imap_unordered(), where each worker pulls a new chunk as
+    soon as it finishes its last one. This balances the load without needing
+    cost estimates, at the price of more task overhead
+
+    nobjs: int
+        The number of objects
+    ncores: int
+        The number of workers
+    chunks_per_core: int
+        The number of chunks per worker, if chunksize is not set. More chunks
+        balance better, but with more overhead
+    chunksize: int
+        The number of objects per chunk, if desired
+    costs: list, np.ndarray
+        The estimated cost of each object, if available. If passed, the
+        chunks are returned in order of decreasing total cost so that the
+        most expensive chunks are dispatched first
+
+    returns:
+    chunks: list of ranges
+    '''
+
+    if ncores < 1:
+        raise ValueError('ncores must be >= 1')
+
+    if chunksize is None:
+        chunksize = max(nobjs // (ncores * chunks_per_core), 1)
+    elif chunksize < 1:
+        raise ValueError('chunksize must be >= 1')
+
+    chunks = [
+        range(start, min(start + chunksize, nobjs))
+        for start in range(0, nobjs, chunksize)
+        ]
+
+    if costs is not None:
+        costs = np.asarray(costs, dtype=float)
+        if len(costs) != nobjs:
+            raise ValueError('costs must have length nobjs')
+        starts = np.array([chunk.start for chunk in chunks], dtype=int)
+        chunk_costs = np.add.reduceat(costs, starts) if nobjs > 0 else []
+        order = np.argsort(-np.asarray(chunk_costs), kind='stable')
+        chunks = [chunks[i] for i in order]
+
+    return chunks
+
+def batch_costs(batch_indices, costs) -> np.ndarray:
+    '''
+    Return the total cost of each batch, e.g. to compare the balance of
+    different batching schemes. The max is the expected makespan
+
+    batch_indices: list
+        A list of index ranges or arrays, as returned by setup_batches() or
+        setup_weighted_batches()
+    costs: list, np.ndarray
+        The estimated cost of each object
+    '''
+
+    costs = np.asarray(costs, dtype=float)
+
+    return np.array([
+        costs[np.asarray(batch, dtype=int)].sum() for batch in batch_indices
+        ])
+
+class TaskError(Exception):
+    '''
+    Raised by parallel_map() & parallel_imap() when a task fails, with the
+    index of the task & the traceback from the worker process
+    '''
+
+    def __init__(self, index, error, remote_traceback):
+        self.index = index
+        self.error = error
+        self.remote_traceback = remote_traceback
+
+        super().__init__(
+            f'Task {index} failed with {error}\n\n'
+            f'Worker traceback:\n{remote_traceback}'
+            )
+
+        return
+
+    def __reduce__(self):
+        return (TaskError, (self.index, self.error, self.remote_traceback))
+
+def _run_chunk(func, start, tasks, master_seed, seed_bounds, pass_seed, args, kwargs):
+    '''
+    Run func on a chunk of tasks starting at task index start. Each task is
+    seeded by its index alone, so results don't depend on the chunking
+    '''
+
+    results = []
+    for i, task in enumerate(tasks, start=start):
+        try:
+            if pass_seed is True:
+                seed = generate_seed(i, master_seed, seed_bounds=seed_bounds)
+                results.append(func(task, *args, seed=seed, **kwargs))
+            else:
+                results.append(func(task, *args, **kwargs))
+        except Exception as e:
+            raise TaskError(i, repr(e), traceback.format_exc()) from None
+
+    return start, results
+
+def parallel_imap(
+        func,
+        tasks,
+        ncores: int=None,
+        master_seed: int=None,
+        chunksize: int=None,
+        ordered: bool=True,
+        args: tuple=(),
+        kwargs: dict=None,
+        pass_seed: bool=True,
+        seed_bounds: tuple=(0, 2**32-1),
+        max_inflight: int=None,
+        start_method: str=None
+        ):
+    '''
+    Lazily map func over tasks with a pool of worker processes, yielding the
+    results as they become available
+
+    Each task is called as func(task, *args, seed=seed, **kwargs), where seed
+    is the seed of the task's index as given by generate_seeds(ntasks,
+    master_seed). Results are therefore identical for any ncores & chunksize.
+    If a task raises, a TaskError with the task index & the worker traceback
+    is raised & the remaining tasks are cancelled
+
+    func: callable
+        The function to apply. Must be picklable (e.g. defined at module level)
+    tasks: iterable
+        The task inputs. Consumed lazily, so it may be a generator
+    ncores: int
+        The number of worker processes. Defaults to the number of cpus. If 1,
+        the tasks are run in the calling process (e.g. for use with pdb)
+    master_seed: int
+        The master seed for the task seeds. If not set, one is generated from
+        the current time, so set this for reproducible results
+    chunksize: int
+        The number of tasks sent to a worker at a time. Defaults to ~4 chunks
+        per worker if the number of tasks is known, and 1 otherwise
+    ordered: bool
+        If True, yield results in task order. If False, yield (index, result)
+        tuples as soon as each chunk completes
+    args: tuple
+        Extra positional args for func
+    kwargs: dict
+        Extra keyword args for func
+    pass_seed: bool
+        Whether to pass the seed kwarg to func
+    seed_bounds: tuple of ints
+        The min & max values for the seeds, as in generate_seeds()
+    max_inflight: int
+        The maximum number of chunks submitted but not yet yielded, which
+        bounds memory use for large task lists. Defaults to 4*ncores
+    start_method: str
+        The multiprocessing start method ('fork', 'spawn', 'forkserver'), if
+        not the platform default
+    '''
+
+    if kwargs is None:
+        kwargs = {}
+    if ncores is None:
+        ncores = multiprocessing.cpu_count()
+    if ncores < 1:
+        raise ValueError('ncores must be >= 1')
+
+    if master_seed is None:
+        # local time in microseconds, as in generate_seeds()
+        master_seed = int(time.time()*1e6)
+
+    if chunksize is None:
+        try:
+            chunksize = max(len(tasks) // (ncores * 4), 1)
+        except TypeError:
+            chunksize = 1
+    if chunksize < 1:
+        raise ValueError('chunksize must be >= 1')
+
+    if max_inflight is None:
+        max_inflight = 4 * ncores
+
+    task_iter = iter(tasks)
+
+    def next_chunks():
+        start = 0
+        while True:
+            chunk = list(itertools.islice(task_iter, chunksize))
+            if len(chunk) == 0:
+                return
+            yield start, chunk
+            start += len(chunk)
+
+    chunk_args = (master_seed, seed_bounds, pass_seed, args, kwargs)
+
+    if ncores == 1:
+        for start, chunk in next_chunks():
+            _, results = _run_chunk(func, start, chunk, *chunk_args)
+            for i, result in enumerate(results, start=start):
+                yield result if ordered else (i, result)
+        return
+
+    mp_context = None
+    if start_method is not None:
+        mp_context = multiprocessing.get_context(start_method)
+
+    executor = ProcessPoolExecutor(max_workers=ncores, mp_context=mp_context)
+    try:
+        chunks = next_chunks()
+        pending = deque()
+
+        def submit():
+            for start, chunk in itertools.islice(chunks, max_inflight - len(pending)):
+                pending.append(
+                    executor.submit(_run_chunk, func, start, chunk, *chunk_args)
+                    )
+
+        submit()
+        while len(pending) > 0:
+            if ordered is True:
+                # the oldest chunk is next in task order
+                future = pending.popleft()
+                _, results = future.result()
+                submit()
+                yield from results
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+                submit()
+                for future in done:
+                    start, results = future.result()
+                    yield from enumerate(results, start=start)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    return
+
+def parallel_map(func, tasks, ncores: int=None, master_seed: int=None, chunksize: int=None, **kwargs) -> list:
+    '''
+    Map func over tasks with a pool of worker processes & return the list of
+    results in task order. See parallel_imap() for the full set of options
+
+    e.g.:
+    def simulate(obj, seed=None):
+        rng = np.random.default_rng(seed)
+        ...
+    results = parallel_map(simulate, objs, ncores=16, master_seed=42)
+
+    func: callable
+        The function to apply, called as func(task, seed=seed)
+    tasks: iterable
+        The task inputs
+    ncores: int
+        The number of worker processes. Defaults to the number of cpus
+    master_seed: int
+        The master seed for the task seeds, as in generate_seeds()
+    chunksize: int
+        The number of tasks sent to a worker at a time
+    '''
+
+    return list(parallel_imap(
+        func,
+        tasks,
+        ncores=ncores,
+        master_seed=master_seed,
+        chunksize=chunksize,
+        ordered=True,
+        **kwargs
+        ))
+
+# segments attached to in this process, keyed by name, so that repeated
+# attaches (e.g. once per task) reuse the same mapping
+_ATTACHED = {}
+
+class SharedArray(object):
+    '''
+    A picklable handle to a numpy array in shared memory (or a memory-mapped
+    file), as created by SharedData.array(). Pass the handle to worker
+    processes instead of the array; attach() returns a view of the shared
+    data in any process without copying it
+    '''
+
+    def __init__(self, name: str, shape: tuple, dtype, backend: str='shm',
+                 tracker_pid: int=None):
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.backend = backend
+        # the pid of the owner's resource tracker, see _attach_shm()
+        self.tracker_pid = tracker_pid
+
+        return
+
+    def __getstate__(self):
+        return {
+            'name': self.name,
+            'shape': self.shape,
+            'dtype': self.dtype.str,
+            'backend': self.backend,
+            'tracker_pid': self.tracker_pid,
+            }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+        return
+
+    @property
+    def nbytes(self) -> int:
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def attach(self, readonly: bool=False) -> np.ndarray:
+        '''
+        Return a view of the shared array. The mapping is cached for the
+        lifetime of the process, so this is cheap to call once per task
+
+        readonly: bool
+            Whether to return a read-only view
+        '''
+
+        if self.name not in _ATTACHED:
+            if self.backend == 'shm':
+                _ATTACHED[self.name] = _attach_shm(self.name, self.tracker_pid)
+            else:
+                _ATTACHED[self.name] = np.memmap(
+                    self.name, dtype=np.uint8, mode='r+'
+                    )
+
+        segment = _ATTACHED[self.name]
+
+        if self.backend == 'shm':
+            # unlike np.ndarray(buffer=...), frombuffer holds an export of the
+            # segment's buffer, so the segment can't be unmapped under the view
+            count = int(np.prod(self.shape))
+            array = np.frombuffer(
+                segment.buf, dtype=self.dtype, count=count
+                ).reshape(self.shape)
+        else:
+            array = np.ndarray(self.shape, dtype=self.dtype, buffer=segment)
+        if readonly is True:
+            array.flags.writeable = False
+
+        return array
+
+    def __repr__(self):
+        return f'SharedArray(name={self.name!r}, shape={self.shape}, dtype={self.dtype})'
+
+class SharedTable(object):
+    '''
+    A picklable handle to an astropy Table whose columns are in shared
+    memory, as created by SharedData.table(). attach() rebuilds the Table
+    from views of the shared columns without copying them
+    '''
+
+    def __init__(self, columns: dict, masks: dict, units: dict, meta: dict):
+        self.columns = columns
+        self.masks = masks
+        self.units = units
+        self.meta = meta
+
+        return
+
+    def attach(self, readonly: bool=False):
+        '''
+        Return a Table of views of the shared columns
+
+        readonly: bool
+            Whether the column data should be read-only
+        '''
+
+        # only needed for tables, so not imported for every worker
+        from astropy.table import Table, Column, MaskedColumn
+
+        table = Table(meta=self.meta)
+        for name, handle in self.columns.items():
+            data = handle.attach(readonly=readonly)
+            if name in self.masks:
+                mask = self.masks[name].attach(readonly=readonly)
+                col = MaskedColumn(
+                    data=data, mask=mask, name=name, unit=self.units[name],
+                    copy=False
+                    )
+            else:
+                col = Column(
+                    data=data, name=name, unit=self.units[name], copy=False
+                    )
+            table.add_column(col, copy=False)
+
+        return table
+
+def _attach_shm(name: str, tracker_pid: int=None) -> shared_memory.SharedMemory:
+    '''
+    Attach to an existing shared memory segment without leaving it registered
+    with a resource tracker of this process' own, which would otherwise
+    unlink the segment when the (worker) process exits
+    '''
+
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+
+    # processes started by multiprocessing (with any start method) inherit
+    # the connection to their parent's tracker, which keeps one registration
+    # per segment; unregistering there would drop the owner's registration,
+    # so that the owner's unlink() errors & a crashed owner leaks the segment.
+    # Only a tracker this process started itself must be unregistered from
+    tracker = resource_tracker._resource_tracker
+    own_tracker = tracker._fd is None or (
+        tracker._pid is not None and tracker._pid != tracker_pid
+        )
+
+    shm = shared_memory.SharedMemory(name=name)
+    if own_tracker is True:
+        try:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        except Exception:
+            pass
+
+    return shm
+
+def _release_segments(segments: list) -> None:
+    '''
+    Close & unlink the owned segments; safe to call more than once
+    '''
+
+    while len(segments) > 0:
+        backend, name, segment = segments.pop()
+        _ATTACHED.pop(name, None)
+        # unlinked first, as close() raises a BufferError while views of the
+        # segment are still alive (e.g. a results array read back after the
+        # with block); the memory is then freed with the last view
+        try:
+            if backend == 'shm':
+                segment.unlink()
+            else:
+                os.unlink(name)
+        except FileNotFoundError:
+            pass
+
+        if backend == 'shm':
+            try:
+                segment.close()
+            except BufferError:
+                # views are still alive; drop the segment's own references so
+                # that it doesn't retry (& warn) when garbage collected, & the
+                # mapping is freed along with the last view
+                segment._buf = None
+                segment._mmap = None
+        del segment
+
+    return
+
+class SharedData(object):
+    '''
+    Owns numpy arrays & astropy Tables placed in shared memory for worker
+    processes, so each worker attaches to a single copy of the data instead
+    of receiving a pickled copy of its own
+
+    e.g.:
+    with SharedData() as shared:
+        images = shared.array(image_stack)
+        catalog = shared.table(catalog)
+        results = parallel_map(
+            measure, range(len(catalog)), kwargs={'images': images, 'catalog': catalog}
+            )
+
+    def measure(i, seed=None, images=None, catalog=None):
+        images = images.attach(readonly=True)
+        catalog = catalog.attach(readonly=True)
+        ...
+
+    Only the owning process unlinks the segments: on leaving the context,
+    on close(), when the SharedData is garbage collected, or at interpreter
+    exit. Worker processes never unlink them, so a crashing worker can't
+    remove data still in use, and the segments of a crashed owner are
+    removed by its resource tracker (shm backend only). The 'memmap' backend
+    places the data in memory-mapped files instead (e.g. if /dev/shm is
+    small), in dir or the system temp dir
+    '''
+
+    def __init__(self, backend: str='shm', dir: str=None):
+        '''
+        backend: str
+            Either 'shm' for multiprocessing.shared_memory or 'memmap' for
+            memory-mapped files
+        dir: str
+            The directory for the 'memmap' backend files. Defaults to the
+            system temp dir
+        '''
+
+        if backend not in ('shm', 'memmap'):
+            raise ValueError('backend must be either shm or memmap')
+
+        self.backend = backend
+        self.dir = dir
+
+        self._segments = []
+        self._finalizer = weakref.finalize(
+            self, _release_segments, self._segments
+            )
+        atexit.register(self._finalizer)
+
+        return
+
+    def empty(self, shape, dtype=float) -> SharedArray:
+        '''
+        Allocate a new, uninitialized shared array, e.g. for workers to
+        write their results into
+
+        shape: int, tuple
+            The array shape
+        dtype: np.dtype
+            The array dtype
+        '''
+
+        shape = (shape,) if np.isscalar(shape) else tuple(shape)
+        dtype = np.dtype(dtype)
+        nbytes = max(int(np.prod(shape)) * dtype.itemsize, 1)
+
+        if self.backend == 'shm':
+            segment = shared_memory.SharedMemory(create=True, size=nbytes)
+            name = segment.name
+        else:
+            dir = self.dir if self.dir is not None else tempfile.gettempdir()
+            name = os.path.join(dir, f'terminus_{uuid.uuid4().hex}.mmap')
+            segment = np.memmap(name, dtype=np.uint8, mode='w+', shape=(nbytes,))
+
+        self._segments.append((self.backend, name, segment))
+        _ATTACHED[name] = segment
+
+        tracker_pid = None
+        if self.backend == 'shm':
+            tracker_pid = resource_tracker._resource_tracker._pid
+
+        return SharedArray(
+            name, shape, dtype, backend=self.backend, tracker_pid=tracker_pid
+            )
+
+    def array(self, array) -> SharedArray:
+        '''
+        Copy an array into shared memory & return its handle
+
+        array: np.ndarray
+            The array to share. Object arrays are not supported
+        '''
+
+        array = np.asarray(array)
+        if array.dtype.hasobject:
+            raise TypeError('object arrays can not be placed in shared memory')
+
+        handle = self.empty(array.shape, array.dtype)
+        handle.attach()[...] = array
+
+        return handle
+
+    def table(self, table) -> SharedTable:
+        '''
+        Copy the columns of an astropy Table into shared memory & return its
+        handle. Masked columns share their data & mask separately
+
+        table: astropy.table.Table
+            The table to share
+        '''
+
+        columns, masks, units = {}, {}, {}
+        for name in table.colnames:
+            col = table[name]
+            mask = getattr(col, 'mask', None)
+            if (mask is not None) and np.any(mask):
+                columns[name] = self.array(np.ma.getdata(col))
+                masks[name] = self.array(np.ma.getmaskarray(col))
+            else:
+                columns[name] = self.array(np.asarray(col))
+            units[name] = getattr(col, 'unit', None)
+
+        return SharedTable(columns, masks, units, dict(table.meta))
+
+    @property
+    def nbytes(self) -> int:
+        '''
+        The total size of the owned segments
+        '''
+
+        total = 0
+        for backend, name, segment in self._segments:
+            total += segment.size
+
+        return total
+
+    def close(self) -> None:
+        '''
+        Release all of the shared segments. Handles must not be attached to
+        afterwards
+        '''
+
+        self._finalizer()
+
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+        return
+
+@dataclass
+class QueueTask:
+    '''
+    A task claimed from a FileTaskQueue
+
+    id: str
+        The unique task id
+    data: any
+        The (json-serializable) task payload
+    attempts: int
+        The number of times the task has been claimed, including this one
+    worker: str
+        The id of the worker holding the lease
+    '''
+
+    id: str
+    data: object
+    attempts: int = 0
+    worker: str | None = None
+
+class FileTaskQueue(object):
+    '''
+    A task queue that lives entirely in a shared directory, so that workers
+    on any number of nodes can pull tasks without any external services.
+    Each task is a json file that moves between the pending/, claimed/,
+    done/ and failed/ subdirectories with atomic renames; a worker owns a
+    task if its rename from pending/ succeeded. A claimed task has a lease
+    file with an expiry time that the worker renews while it works, and
+    tasks whose lease expired (e.g. their node died) are requeued by any
+    worker. Lease expiries assume reasonably synchronized node clocks
+
+    e.g.:
+    # once, on any node
+    queue = FileTaskQueue('/scratch/run/queue')
+    queue.put_chunks(nobjs, chunksize=100)
+
+    # on every node / process
+    def work(chunk):
+        return process_objects(range(chunk['start'], chunk['stop']))
+
+    run_queue_worker(FileTaskQueue('/scratch/run/queue'), work)
+    '''
+
+    _STATES = ('pending', 'claimed', 'done', 'failed')
+
+    # suffix of the tmp/ files of tasks being moved out of claimed/
+    _MOVING = '.moving'
+
+    def __init__(self, root: str, lease: float=600., max_attempts: int=3):
+        '''
+        root: str, Path
+            The shared queue directory. Created if it does not exist
+        lease: float
+            The lease duration in seconds. Workers must renew the leases of
+            their tasks more often than this
+        max_attempts: int
+            The number of times a task is tried (including after expired
+            leases) before it is moved to failed/
+        '''
+
+        self.root = Path(root)
+        self.lease = lease
+        self.max_attempts = max_attempts
+
+        for state in self._STATES + ('tmp',):
+            (self.root / state).mkdir(parents=True, exist_ok=True)
+
+        return
+
+    def _path(self, state: str, task_id: str, suffix: str='.json') -> Path:
+        return self.root / state / f'{task_id}{suffix}'
+
+    def _write(self, path: Path, payload: dict) -> None:
+        '''
+        Atomically write a json payload, as a rename within a filesystem is
+        atomic
+        '''
+
+        tmp_file = self.root / 'tmp' / f'{uuid.uuid4().hex}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(payload, f)
+        os.replace(tmp_file, path)
+
+        return
+
+    def _read(self, path: Path) -> dict:
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def put(self, tasks: list, ids: list=None) -> list:
+        '''
+        Add tasks to the queue. Returns the task ids
+
+        tasks: list
+            The json-serializable task payloads
+        ids: list of str
+            The task ids, if desired. Defaults to a zero-padded task index
+            plus a random suffix, so that ids from separate calls never collide
+        '''
+
+        tasks = list(tasks)
+        if ids is None:
+            suffix = uuid.uuid4().hex[:8]
+            width = len(str(max(len(tasks) - 1, 0)))
+            ids = [f'{i:0{width}d}-{suffix}' for i in range(len(tasks))]
+        elif len(ids) != len(tasks):
+            raise ValueError('ids must have the same length as tasks')
+
+        for task_id, data in zip(ids, tasks):
+            self._write(
+                self._path('pending', task_id),
+                {'id': task_id, 'data': data, 'attempts': 0}
+                )
+
+        return list(ids)
+
+    def put_chunks(self, nobjs: int, chunksize: int) -> list:
+        '''
+        Add tasks of contiguous object index chunks, as {'start': int,
+        'stop': int} payloads. Returns the task ids
+
+        nobjs: int
+            The total number of objects
+        chunksize: int
+            The number of objects per task
+        '''
+
+        if chunksize < 1:
+            raise ValueError('chunksize must be >= 1')
+
+        chunks = [
+            {'start': start, 'stop': min(start + chunksize, nobjs)}
+            for start in range(0, nobjs, chunksize)
+            ]
+
+        return self.put(chunks)
+
+    def claim(self, worker: str=None) -> QueueTask | None:
+        '''
+        Claim the next pending task, or return None if there are none
+
+        worker: str
+            The id of the claiming worker. Defaults to {hostname}-{pid}
+        '''
+
+        if worker is None:
+            worker = f'{socket.gethostname()}-{os.getpid()}'
+
+        candidates = sorted(
+            entry.name for entry in os.scandir(self.root / 'pending')
+            if entry.name.endswith('.json')
+            )
+        if len(candidates) == 0:
+            return None
+
+        # start at a random offset so that concurrent workers rarely race
+        # for the same file
+        offset = random.randrange(len(candidates))
+        for name in candidates[offset:] + candidates[:offset]:
+            task_id = name[:-len('.json')]
+            claimed_file = self._path('claimed', task_id)
+            try:
+                os.rename(self._path('pending', task_id), claimed_file)
+            except FileNotFoundError:
+                # another worker got it first
+                continue
+
+            self._write_lease(task_id, worker)
+            payload = self._read(claimed_file)
+
+            return QueueTask(
+                id=task_id,
+                data=payload['data'],
+                attempts=payload['attempts'] + 1,
+                worker=worker
+                )
+
+        return None
+
+    def _write_lease(self, task_id: str, worker: str) -> None:
+        self._write(
+            self._path('claimed', task_id, '.lease'),
+            {'worker': worker, 'expires': time.time() + self.lease}
+            )
+
+        return
+
+    def _holds_lease(self, task: QueueTask) -> bool:
+        try:
+            lease = self._read(self._path('claimed', task.id, '.lease'))
+        except (FileNotFoundError, ValueError):
+            return False
+
+        return lease.get('worker') == task.worker
+
+    def renew(self, task: QueueTask) -> bool:
+        '''
+        Extend the lease of a claimed task. Returns False if the lease was
+        lost, e.g. because it expired & the task was requeued
+        '''
+
+        if (not self._holds_lease(task)) or \
+           (not self._path('claimed', task.id).exists()):
+            return False
+
+        self._write_lease(task.id, task.worker)
+
+        return True
+
+    def _release(self, task: QueueTask, state: str, extra: dict) -> bool:
+        if not self._holds_lease(task):
+            return False
+
+        # moved out of claimed/ (& the lease removed) before the task is
+        # published to its new state, so that a worker claiming it straight
+        # away can't have its claim removed by this cleanup. As in
+        # requeue_expired(), only one worker can win the rename
+        tmp_file = self.root / 'tmp' / f'{task.id}.{uuid.uuid4().hex}{self._MOVING}'
+        try:
+            os.rename(self._path('claimed', task.id), tmp_file)
+        except FileNotFoundError:
+            return False
+
+        self._path('claimed', task.id, '.lease').unlink(missing_ok=True)
+
+        payload = self._read(tmp_file)
+        payload.update(extra)
+        payload['attempts'] = task.attempts
+        payload['worker'] = task.worker
+        self._write(self._path(state, task.id), payload)
+        tmp_file.unlink()
+
+        return True
+
+    def complete(self, task: QueueTask, result=None) -> bool:
+        '''
+        Mark a claimed task as done, storing its (json-serializable) result
+        if passed. Returns False if the lease was lost, in which case the
+        task may be run again elsewhere
+        '''
+
+        return self._release(task, 'done', {'result': result})
+
+    def fail(self, task: QueueTask, error: str=None) -> bool:
+        '''
+        Mark a claimed task as failed. It is requeued if it has attempts
+        left, and moved to failed/ otherwise. Returns False if the lease was
+        lost
+        '''
+
+        if task.attempts < self.max_attempts:
+            return self._release(task, 'pending', {'error': error})
+
+        return self._release(task, 'failed', {'error': error})
+
+    def requeue_expired(self) -> int:
+        '''
+        Requeue all claimed tasks whose lease has expired, or move them to
+        failed/ if they have no attempts left. Safe to call from any number
+        of workers at once. Returns the number of tasks requeued or failed
+        '''
+
+        now = time.time()
+        nrequeued = 0
+
+        for entry in os.scandir(self.root / 'claimed'):
+            if not entry.name.endswith('.json'):
+                continue
+            task_id = entry.name[:-len('.json')]
+            lease_file = self._path('claimed', task_id, '.lease')
+
+            try:
+                expires = self._read(lease_file)['expires']
+            except FileNotFoundError:
+                # a claim that has not written its lease yet, or a worker
+                # that died in between; the rename set the file's ctime
+                try:
+                    expires = entry.stat().st_ctime + self.lease
+                except FileNotFoundError:
+                    continue
+            except (ValueError, KeyError):
+                continue
+
+            if expires > now:
+                continue
+
+            # only one worker can win the rename out of claimed/
+            tmp_file = self.root / 'tmp' / f'{task_id}.{uuid.uuid4().hex}{self._MOVING}'
+            try:
+                os.rename(entry.path, tmp_file)
+            except FileNotFoundError:
+                continue
+
+            lease_file.unlink(missing_ok=True)
+            payload = self._read(tmp_file)
+            payload['attempts'] += 1
+            payload['error'] = 'lease expired'
+            state = 'pending' if payload['attempts'] < self.max_attempts else 'failed'
+            self._write(self._path(state, task_id), payload)
+            tmp_file.unlink()
+            nrequeued += 1
+
+        return nrequeued
+
+    def counts(self) -> dict:
+        '''
+        The number of tasks in each state. Tasks being moved out of claimed/
+        are still counted as claimed
+        '''
+
+        counts = {
+            state: sum(
+                1 for entry in os.scandir(self.root / state)
+                if entry.name.endswith('.json')
+                ) for state in self._STATES
+            }
+        counts['claimed'] += sum(
+            1 for entry in os.scandir(self.root / 'tmp')
+            if entry.name.endswith(self._MOVING)
+            )
+
+        return counts
+
+    def is_finished(self) -> bool:
+        '''
+        Whether there are no pending or claimed tasks left
+        '''
+
+        counts = self.counts()
+
+        return (counts['pending'] == 0) and (counts['claimed'] == 0)
+
+    def results(self):
+        '''
+        Yield (task id, result) tuples of the done tasks, sorted by id
+        '''
+
+        names = sorted(
+            entry.name for entry in os.scandir(self.root / 'done')
+            if entry.name.endswith('.json')
+            )
+        for name in names:
+            payload = self._read(self.root / 'done' / name)
+            yield payload['id'], payload.get('result')
+
+def run_queue_worker(
+        queue: FileTaskQueue,
+        func,
+        worker: str=None,
+        wait_for_claimed: bool=True,
+        poll_interval: float=5.,
+        logprint: LogPrint=None
+        ) -> int:
+    '''
+    Claim & run tasks from a FileTaskQueue until none are left, renewing the
+    lease of the current task from a background thread. Returns the number
+    of tasks this worker completed
+
+    queue: FileTaskQueue
+        The shared task queue
+    func: callable
+        Called as func(task.data); its return value is stored as the result
+    worker: str
+        The id of this worker. Defaults to {hostname}-{pid}
+    wait_for_claimed: bool
+        If True, keep polling while other workers still hold tasks, so that
+        tasks requeued after a lease expires are picked up. If False, stop
+        as soon as there are no pending tasks
+    poll_interval: float
+        The seconds between polls while waiting on claimed tasks
+    logprint: LogPrint
+        Where to report task failures. Defaults to print
+    '''
+
+    if logprint is None:
+        logprint = print
+    if worker is None:
+        worker = f'{socket.gethostname()}-{os.getpid()}'
+
+    ncompleted = 0
+    current = {'task': None}
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(queue.lease / 3):
+            task = current['task']
+            if task is not None:
+                queue.renew(task)
+
+        return
+
+    keeper = threading.Thread(target=heartbeat, daemon=True)
+    keeper.start()
+
+    try:
+        while True:
+            queue.requeue_expired()
+            task = queue.claim(worker)
+
+            if task is None:
+                if (wait_for_claimed is True) and (not queue.is_finished()):
+                    time.sleep(poll_interval)
+                    continue
+                break
+
+            current['task'] = task
+            try:
+                result = func(task.data)
+            except Exception:
+                current['task'] = None
+                logprint(f'Task {task.id} failed on {worker}:\n{traceback.format_exc()}')
+                queue.fail(task, error=traceback.format_exc())
+                continue
+
+            current['task'] = None
+            if queue.complete(task, result=result):
+                ncompleted += 1
+            else:
+                logprint(f'Lost the lease of task {task.id} on {worker}; result discarded')
+    finally:
+        stop.set()
+        keeper.join()
+
+    return ncompleted
@@ -1,29 +1,350 @@
 import os
+import re
+import time
+import uuid
+import pickle
+import errno
 import shutil
+import threading
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-def rm_tree(path):
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows; reflinks are then skipped
+    fcntl = None
+
+# whether the platform supports opening, scanning & deleting directory
+# entries relative to an open directory fd
+_RM_DIR_FD = (
+    {os.open, os.rmdir, os.unlink} <= os.supports_dir_fd and
+    os.scandir in os.supports_fd and
+    hasattr(os, 'O_DIRECTORY') and hasattr(os, 'O_NOFOLLOW')
+    )
+
+_RM_OPEN_FLAGS = os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0) | \
+    getattr(os, 'O_NOFOLLOW', 0) | getattr(os, 'O_CLOEXEC', 0)
+
+class _RmNode(object):
+    '''
+    A directory being removed by _TreeRemover. It is removed itself once its
+    own scan & the removal of all of its subdirectories are done
+    '''
+
+    __slots__ = ('parent', 'parent_fd', 'name', 'stat', 'fd', 'pending')
+
+    def __init__(self, parent, parent_fd, name, stat):
+        self.parent = parent
+        self.parent_fd = parent_fd
+        self.name = name
+        self.stat = stat
+        self.fd = None
+        # its own scan, plus its subdirectories not yet removed
+        self.pending = 1
+
+        return
+
+class _TreeRemover(object):
+    '''
+    Removes a directory tree with fd-relative operations, as in the fd-based
+    shutil.rmtree(): each directory is opened relative to its parent's fd
+    with O_NOFOLLOW & checked to be the directory that was scanned, so that
+    symlinks (or directories swapped for them) are never followed. Each
+    thread removes subtrees depth first, but hands subdirectories off to idle
+    threads, so deep & wide trees are both split across the pool, while the
+    number of open fds stays bounded by the pool size times the tree depth
+    '''
+
+    def __init__(self, nthreads: int | None):
+        self.pool = ThreadPoolExecutor(max_workers=nthreads)
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.finished = threading.Event()
+        self.error = None
+        self.open_fds = set()
+
+        return
+
+    def run(self, path: str) -> None:
+        parent_fd = os.open(
+            os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY
+            )
+        try:
+            name = os.path.basename(os.path.abspath(path))
+            root = _RmNode(None, parent_fd, name, os.lstat(name, dir_fd=parent_fd))
+            self._remove(root)
+            self.finished.wait()
+        finally:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            for fd in self.open_fds:
+                os.close(fd)
+            os.close(parent_fd)
+
+        if self.error is not None:
+            raise self.error
+
+        return
+
+    def _handoff(self, node: _RmNode) -> bool:
+        '''
+        Queue the removal of a subdirectory if some thread is idle
+        '''
+
+        with self.lock:
+            if self.queued >= self.pool._max_workers:
+                return False
+            self.queued += 1
+
+        self.pool.submit(self._run_queued, node)
+
+        return True
+
+    def _run_queued(self, node: _RmNode) -> None:
+        with self.lock:
+            self.queued -= 1
+        self._remove(node)
+
+        return
+
+    def _remove(self, node: _RmNode) -> None:
+        try:
+            if self.error is not None:
+                return
+
+            fd = os.open(node.name, _RM_OPEN_FLAGS, dir_fd=node.parent_fd)
+            with self.lock:
+                self.open_fds.add(fd)
+            node.fd = fd
+
+            if not os.path.samestat(node.stat, os.fstat(fd)):
+                raise OSError(f'{node.name} changed during removal; not removing it')
+
+            with os.scandir(fd) as it:
+                entries = list(it)
+
+            for entry in entries:
+                if self.error is not None:
+                    return
+                if entry.is_dir(follow_symlinks=False):
+                    child = _RmNode(
+                        node, fd, entry.name, entry.stat(follow_symlinks=False)
+                        )
+                    with self.lock:
+                        node.pending += 1
+                    if not self._handoff(child):
+                        self._remove(child)
+                else:
+                    os.unlink(entry.name, dir_fd=fd)
+
+            self._finish(node)
+
+        except BaseException as e:
+            with self.lock:
+                if self.error is None:
+                    self.error = e
+            self.finished.set()
+
+        return
+
+    def _finish(self, node: _RmNode) -> None:
+        '''
+        Mark a scan or subdirectory of node as done, removing node (& then
+        any of its ancestors) once nothing of it is left
+        '''
+
+        while node is not None:
+            with self.lock:
+                node.pending -= 1
+                if node.pending > 0:
+                    return
+                self.open_fds.discard(node.fd)
+
+            os.close(node.fd)
+            os.rmdir(node.name, dir_fd=node.parent_fd)
+            node = node.parent
+
+        # the root is gone
+        self.finished.set()
+
+        return
+
+def _rm_tree(path: str, nthreads: int | None) -> None:
+    if _RM_DIR_FD is False:
+        # e.g. on Windows, where shutil.rmtree doesn't follow symlinks either
+        shutil.rmtree(path)
+        return
+
+    _TreeRemover(nthreads).run(path)
+
+    return
+
+def rm_tree(path, nthreads=None, background=False):
     '''
-    Recursive directory removal using pathlib
+    Recursive directory removal. Subtrees are removed in parallel by a pool
+    of threads, opening & deleting entries relative to their parent
+    directory's fd where the platform supports it. Symlinks are removed, but
+    never followed
 
     path: str, pathlib.Path
         The directory path to recursively delete
+    nthreads: int
+        The number of deleting threads. Defaults to the ThreadPoolExecutor
+        default
+    background: bool
+        Whether to rename the directory aside (to a hidden sibling) & delete
+        it in a background thread, returning immediately. The path is then
+        free to be reused straight away
+
+    returns:
+    future: concurrent.futures.Future, None
+        The deletion's future if background is True; its result() waits for
+        the deletion to finish & re-raises any error. Otherwise None
     '''
 
     path = Path(path)
-    for child in path.glob('*'):
-        if child.is_file():
-            child.unlink()
-        else:
-            rm_tree(child)
 
-    path.rmdir()
+    if path.is_symlink():
+        raise OSError(f'{path} is a symbolic link; not removing its target')
+    if not path.exists():
+        raise FileNotFoundError(f'{path} does not exist')
+    if not path.is_dir():
+        raise NotADirectoryError(f'{path} is not a directory')
+
+    if background is False:
+        _rm_tree(str(path), nthreads)
+        return None
+
+    trash = path.with_name(f'.{path.name}.deleting-{uuid.uuid4().hex[:8]}')
+    os.rename(path, trash)
+
+    # executor threads are joined at interpreter exit, so the deletion is
+    # not cut short, & any error is kept on the future rather than lost
+    executor = ThreadPoolExecutor(
+        max_workers=1, thread_name_prefix=f'rm_tree-{path.name}'
+        )
+    future = executor.submit(_rm_tree, str(trash), nthreads)
+    executor.shutdown(wait=False)
+
+    return future
+
+# ioctl request number of FICLONE (linux/fs.h), used for copy-on-write clones
+_FICLONE = 0x40049409
+
+# errors raised by copy_file_range() when the kernel or filesystem can't do
+# the copy, in which case we fall back to a regular copy
+_COPY_RANGE_ERRNOS = {
+    errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EPERM
+    }
+
+def _clone(src_fd: int, dst_fd: int) -> None:
+    '''
+    Make the file open at dst_fd a copy-on-write clone of the one at src_fd.
+    Raises OSError if the filesystem (or platform) does not support it
+    '''
+
+    if fcntl is None:
+        raise OSError('reflinks are not supported on this platform')
+
+    fcntl.ioctl(dst_fd, _FICLONE, src_fd)
 
     return
 
-def copy_tree(src, dst, overwrite=False, raise_existing_error=True):
+def reflink(src: str | Path, dst: str | Path) -> None:
     '''
-    Recursive directory copy, with optional overwrite
+    Make a copy-on-write clone of src at dst, which shares the data of src
+    until either is modified. Raises OSError if the filesystem (or platform)
+    does not support it, in which case dst is not created
+
+    src: str, Path
+        The file to clone
+    dst: str, Path
+        The path of the clone
+    '''
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            _clone(fsrc.fileno(), fdst.fileno())
+        except OSError:
+            fdst.close()
+            os.unlink(dst)
+            raise
+
+    return
+
+def _copy_file(src: str, dst: str) -> None:
+    '''
+    Copy the contents of src to dst, using a reflink or copy_file_range()
+    where the platform & filesystem support it so that the data is never
+    copied through userspace
+    '''
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+
+        try:
+            _clone(src_fd, dst_fd)
+            return
+        except OSError:
+            pass
+
+        if hasattr(os, 'copy_file_range'):
+            copied = 0
+            try:
+                while True:
+                    n = os.copy_file_range(src_fd, dst_fd, 2**30)
+                    if n == 0:
+                        return
+                    copied += n
+            except OSError as e:
+                if copied > 0 or e.errno not in _COPY_RANGE_ERRNOS:
+                    raise
+
+        shutil.copyfileobj(fsrc, fdst, 2**20)
+
+    return
+
+def _copy_tree_file(src: str, dst: str, overwrite: bool,
+                    raise_existing_error: bool, update: bool) -> int:
+    '''
+    Copy a single file for copy_tree(). Returns the number of bytes copied,
+    or None if the file was skipped
+    '''
+
+    src_stat = os.stat(src)
+
+    try:
+        dst_stat = os.stat(dst)
+    except FileNotFoundError:
+        dst_stat = None
+
+    if dst_stat is not None:
+        # like rsync, files are unchanged if their size & mtime (to the
+        # second) match
+        unchanged = (
+            dst_stat.st_size == src_stat.st_size and
+            int(dst_stat.st_mtime) == int(src_stat.st_mtime)
+            )
+        if update is True and unchanged:
+            return None
+        if overwrite is False and update is False:
+            if raise_existing_error is True:
+                raise FileExistsError(
+                    f'{dst} already exists and overwrite=False'
+                )
+            return None
+
+    _copy_file(src, dst)
+    shutil.copystat(src, dst)
+
+    return src_stat.st_size
+
+def copy_tree(src, dst, overwrite=False, raise_existing_error=True,
+              update=False, nthreads=None):
+    '''
+    Recursive directory copy, with optional overwrite. Files are copied in
+    parallel by a pool of threads, using reflinks or copy_file_range() where
+    available, and keep their permissions & mtimes (as with shutil.copy2)
 
     Parameters
     ----------
@@ -35,33 +356,421 @@ def copy_tree(src, dst, overwrite=False, raise_existing_error=True):
         Whether to overwrite files in the destination directory
     raise_existing_error: bool
         Whether to raise an error if the destination file already exists and
-        overwrite is False
+        overwrite is False. If False, existing files are skipped
+    update: bool
+        Whether to only copy files that are missing or differ from the
+        destination in size or mtime, like rsync. Changed files are
+        overwritten regardless of overwrite
+    nthreads: int
+        The number of copying threads. Defaults to the ThreadPoolExecutor
+        default
+
+    Returns
+    -------
+    stats: dict
+        The number of copied & skipped files, and the number of bytes copied
     '''
 
     src = Path(src)
     dst = Path(dst)
 
-    if not dst.exists():
-        dst.mkdir(parents=True)
-    
-    for item in src.iterdir():
-        src_item = item
-        dst_item = dst / item.name
-        
-        if src_item.is_dir():
-            copy_tree(
-                src_item, dst_item, overwrite=overwrite,
-                raise_existing_error=raise_existing_error
-                )
+    stats = {'copied': 0, 'skipped': 0, 'bytes': 0}
+
+    def collect(futures):
+        for future in futures:
+            nbytes = future.result()
+            if nbytes is None:
+                stats['skipped'] += 1
+            else:
+                stats['copied'] += 1
+                stats['bytes'] += nbytes
+
+        return
+
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        # bounds the number of queued copies, so that walking a huge tree
+        # doesn't build up millions of futures
+        max_pending = 8 * pool._max_workers
+        pending = set()
+
+        try:
+            stack = [(str(src), str(dst))]
+            while stack:
+                src_dir, dst_dir = stack.pop()
+                os.makedirs(dst_dir, exist_ok=True)
+
+                with os.scandir(src_dir) as it:
+                    for entry in it:
+                        dst_item = os.path.join(dst_dir, entry.name)
+                        if entry.is_dir():
+                            stack.append((entry.path, dst_item))
+                            continue
+
+                        pending.add(pool.submit(
+                            _copy_tree_file, entry.path, dst_item, overwrite,
+                            raise_existing_error, update
+                            ))
+                        if len(pending) >= max_pending:
+                            done, pending = wait(
+                                pending, return_when=FIRST_COMPLETED
+                                )
+                            collect(done)
+
+            collect(pending)
+
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            raise
+
+    return stats
+
+def _glob_to_regex(pattern: str) -> re.Pattern:
+    '''
+    Compile a glob pattern on relative posix paths, where * and ? don't
+    match across directories & ** matches any number of directories
+    '''
+
+    regex = ''
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+            continue
+        elif pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+            continue
+        elif c == '*':
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '[':
+            j = pattern.find(']', i + 2)
+            if j < 0:
+                regex += re.escape(c)
+            else:
+                chars = pattern[i+1:j]
+                if chars.startswith('!'):
+                    chars = '^' + chars[1:]
+                regex += f'[{chars}]'
+                i = j
         else:
-            if dst_item.exists():
-                if (overwrite is False) and (raise_existing_error is True):
-                    raise FileExistsError(
-                        f'{dst_item} already exists and overwrite=False'
-                    )
-            shutil.copy2(src_item, dst_item)
+            regex += re.escape(c)
+        i += 1
 
-    return
+    return re.compile(f'{regex}\\Z')
+
+def _scan_dir(path: str, scan_start: float) -> tuple:
+    '''
+    Scan a single directory for DirectoryIndex. Returns its mtime, a dict of
+    its files' (size, mtime) & a list of its subdirectory names
+    '''
+
+    mtime = os.stat(path).st_mtime
+    files = {}
+    subdirs = []
+
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                elif entry.is_dir():
+                    # symlinked directories aren't followed, to avoid cycles
+                    continue
+                else:
+                    stat = entry.stat()
+                    files[entry.name] = (stat.st_size, stat.st_mtime)
+            except FileNotFoundError:
+                # removed (or a broken symlink) since the directory was listed
+                continue
+
+    # a directory modified in the same timestamp tick as the scan may change
+    # again without its mtime changing, so it is always rescanned
+    if mtime >= scan_start - 1:
+        mtime = None
+
+    return mtime, files, subdirs
+
+class DirectoryIndex(object):
+    '''
+    An in-memory inventory of the files under a directory tree, with their
+    sizes & mtimes, that answers glob & pattern queries without touching the
+    filesystem. The tree is scanned once in parallel with os.scandir, and
+    refresh() only rescans the directories whose mtime changed, which costs
+    one stat per directory rather than one per file
+
+    e.g.:
+    index = DirectoryIndex(data_dir, snapshot='data_index.pkl')
+    for image in index.glob('**/*_cal.fits'):
+        ...
+
+    Note that the directory mtimes only track files being added, removed or
+    renamed; files modified in place keep their indexed size & mtime until
+    their directory is rescanned
+    '''
+
+    _SNAPSHOT_VERSION = 1
+
+    def __init__(self, root: str | Path, snapshot: str | Path | None = None,
+                 nthreads: int | None = None):
+        '''
+        root: str, Path
+            The root directory of the tree to index
+        snapshot: str, Path
+            A file to persist the index to. If it exists (and is of the same
+            root), the index is loaded from it & refreshed rather than
+            scanning the whole tree. Updated after each (re)scan
+        nthreads: int
+            The number of scanning threads. Defaults to the ThreadPoolExecutor
+            default
+        '''
+
+        self.root = Path(root).resolve()
+        self.snapshot = Path(snapshot) if snapshot is not None else None
+        self.nthreads = nthreads
+
+        # relative dir (posix, '' for the root) -> (mtime, files, subdirs)
+        self._dirs = {}
+        # relative dirs that couldn't be read in the last refresh
+        self.skipped = []
+
+        if self.snapshot is not None and self.snapshot.exists():
+            self._load_snapshot()
+
+        self.refresh()
+
+        return
+
+    def _load_snapshot(self) -> None:
+        # a corrupt, truncated or foreign snapshot can raise nearly anything
+        # from unpickling, & is treated as if there were none
+        try:
+            with open(self.snapshot, 'rb') as f:
+                data = pickle.load(f)
+        except Exception:
+            return
+
+        if isinstance(data, dict) and \
+           data.get('version') == self._SNAPSHOT_VERSION and \
+           data.get('root') == str(self.root) and \
+           isinstance(data.get('dirs'), dict):
+            self._dirs = data['dirs']
+
+        return
+
+    def save(self, snapshot: str | Path | None = None) -> None:
+        '''
+        Atomically write the index to the snapshot file
+
+        snapshot: str, Path
+            The file to write to. Defaults to the snapshot passed on creation
+        '''
+
+        if snapshot is None:
+            snapshot = self.snapshot
+        if snapshot is None:
+            raise ValueError('No snapshot file was passed')
+
+        snapshot = Path(snapshot)
+        data = {
+            'version': self._SNAPSHOT_VERSION,
+            'root': str(self.root),
+            'dirs': self._dirs,
+            }
+
+        tmp_file = snapshot.with_name(f'.{snapshot.name}.{uuid.uuid4().hex}.tmp')
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, snapshot)
+
+        return
+
+    def _check_dir(self, rel: str, scan_start: float) -> tuple:
+        '''
+        Return the (possibly cached) record of a directory, & whether it was
+        rescanned. Raises PermissionError if it can't be read
+        '''
+
+        path = self.root / rel if rel else self.root
+        cached = self._dirs.get(rel)
+
+        if cached is not None and cached[0] is not None:
+            try:
+                mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                return None, True
+            if mtime == cached[0]:
+                return cached, False
+
+        try:
+            return _scan_dir(path, scan_start), True
+        except (FileNotFoundError, NotADirectoryError):
+            return None, True
+
+    def refresh(self) -> int:
+        '''
+        Update the index, rescanning only new directories & those whose mtime
+        changed. Directories that can't be read are left out of the index
+        (along with their subtrees) & listed in skipped. Returns the number of
+        rescanned directories
+        '''
+
+        scan_start = time.time()
+        dirs = {}
+        skipped = []
+        nscanned = 0
+
+        with ThreadPoolExecutor(max_workers=self.nthreads) as pool:
+            pending = {pool.submit(self._check_dir, '', scan_start): ''}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    rel = pending.pop(future)
+                    try:
+                        record, scanned = future.result()
+                    except PermissionError:
+                        skipped.append(rel)
+                        continue
+                    nscanned += scanned
+                    if record is None:
+                        # removed since its parent was scanned
+                        continue
+                    dirs[rel] = record
+                    for name in record[2]:
+                        sub = f'{rel}/{name}' if rel else name
+                        pending[pool.submit(self._check_dir, sub, scan_start)] = sub
+
+        self._dirs = dirs
+        self.skipped = sorted(skipped)
+
+        if self.snapshot is not None and nscanned > 0:
+            self.save()
+
+        return nscanned
+
+    def _items(self, dirs=None):
+        '''
+        Yield the relative path & (size, mtime) of the indexed files, in all
+        or only the passed relative dirs
+        '''
+
+        if dirs is None:
+            dirs = self._dirs.keys()
+
+        for rel in dirs:
+            record = self._dirs.get(rel)
+            if record is None:
+                continue
+            prefix = f'{rel}/' if rel else ''
+            for name, stat in record[1].items():
+                yield f'{prefix}{name}', stat
+
+        return
+
+    def _paths(self, rels) -> list:
+        # sorting the strings is much cheaper than sorting Paths
+        root = str(self.root)
+
+        return [Path(root, rel) for rel in sorted(rels)]
+
+    def glob(self, pattern: str) -> list:
+        '''
+        Return the sorted paths of the indexed files matching a glob pattern
+        relative to the root, as with Path.glob(). ** matches any number of
+        directories
+        '''
+
+        regex = _glob_to_regex(pattern)
+
+        # a pattern without wildcards in its directory part only has to look
+        # in that one directory
+        parent, _, _ = pattern.rpartition('/')
+        if not any(c in parent for c in '*?['):
+            dirs = [parent]
+        else:
+            dirs = None
+
+        return self._paths(
+            rel for rel, _ in self._items(dirs) if regex.match(rel)
+            )
+
+    def find(self, pattern: str | re.Pattern) -> list:
+        '''
+        Return the sorted paths of the indexed files whose path relative to
+        the root matches a regular expression (with re.search)
+        '''
+
+        regex = re.compile(pattern)
+
+        return self._paths(
+            rel for rel, _ in self._items() if regex.search(rel)
+            )
+
+    def files(self, subdir: str | Path = '') -> list:
+        '''
+        Return the sorted paths of the indexed files directly in subdir,
+        relative to the root (defaults to the root itself)
+        '''
+
+        return self._paths(
+            rel for rel, _ in self._items([self._rel(subdir)])
+            )
+
+    def _rel(self, path: str | Path) -> str:
+        path = Path(path)
+        if path.is_absolute():
+            path = path.relative_to(self.root)
+
+        rel = path.as_posix()
+
+        return '' if rel == '.' else rel
+
+    def stat(self, path: str | Path) -> tuple:
+        '''
+        Return the indexed (size, mtime) of a file, by its absolute path or
+        its path relative to the root. Raises FileNotFoundError if it is not
+        in the index
+        '''
+
+        rel = self._rel(path)
+        parent, _, name = rel.rpartition('/')
+
+        try:
+            return self._dirs[parent][1][name]
+        except KeyError:
+            raise FileNotFoundError(f'{path} is not in the index of {self.root}')
+
+    def __contains__(self, path) -> bool:
+        try:
+            self.stat(path)
+        except (FileNotFoundError, ValueError):
+            return False
+
+        return True
+
+    def __len__(self):
+        return sum(len(record[1]) for record in self._dirs.values())
+
+    def __iter__(self):
+        for rel, _ in self._items():
+            yield self.root / rel
+
+    @property
+    def size(self) -> int:
+        '''
+        The total size of the indexed files in bytes
+        '''
+        return sum(stat[0] for _, stat in self._items())
+
+    def __repr__(self):
+        return (
+            f'DirectoryIndex(root={str(self.root)!r}, ndirs={len(self._dirs)}, '
+            f'nfiles={len(self)})'
+            )
 
 # -----------------------------------------------------------------------------
 # TODO: The following methods need to be refatored to use pathlib, as well as
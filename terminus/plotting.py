@@ -2,9 +2,14 @@
 A collection of helper methods and classes for simplified plotting calls
 '''
 
+import pickle
+import traceback
+import multiprocessing
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.colors as colors
+from matplotlib.figure import Figure
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 from pathlib import Path
 
@@ -18,6 +23,10 @@ class MidpointNormalize(colors.Normalize):
        array, norm=MidpointNormalize(midpoint=0.,vmin=-100, vmax=100)
        )
 
+    The midpoint is mapped to 0.5, and both sides share the same scale so
+    that the side furthest from the midpoint spans the full half of the
+    colormap. Masks of the input are kept, and float32 inputs stay float32
+
     Parameters
     ----------
     vmin : float
@@ -34,38 +43,598 @@ class MidpointNormalize(colors.Normalize):
         self.midpoint = midpoint
         colors.Normalize.__init__(self, vmin, vmax, clip)
 
+        # (vmin, vmax, midpoint) -> slope, recomputed if any of them change
+        self._slope_key = None
+        self._slope = None
+
         return
 
-    def __call__(self, value, clip=None):
+    def _get_slope(self) -> float:
+        '''
+        The normalized units per data unit, on both sides of the midpoint
+        '''
 
-        try:
-            normalized_min = max(
-                0,
-                1 / 2 * (
-                    1 - abs((self.midpoint - self.vmin) / (self.midpoint - self.vmax))
+        key = (self.vmin, self.vmax, self.midpoint)
+        if key != self._slope_key:
+            vmin, vmax, midpoint = (float(v) for v in key)
+            if not vmin <= midpoint <= vmax:
+                raise ValueError(
+                    'vmin, midpoint & vmax must be in ascending order; '
+                    f'got {vmin}, {midpoint}, {vmax}'
                     )
+            half_range = max(midpoint - vmin, vmax - midpoint)
+            self._slope = 0.5 / half_range if half_range > 0 else 0.
+            self._slope_key = key
+
+        return self._slope
+
+    def __call__(self, value, clip=None):
+
+        if clip is None:
+            clip = self.clip
+
+        # a (masked) float copy of value, keeping float32 as float32
+        result, is_scalar = self.process_value(value)
+        self.autoscale_None(result)
+
+        slope = self._get_slope()
+        data = result.data
+
+        # all in place on the copy, to avoid any full-size temporaries
+        np.subtract(data, self.midpoint, out=data)
+        np.multiply(data, slope, out=data)
+        np.add(data, 0.5, out=data)
+
+        if clip is True:
+            np.clip(
+                data,
+                0.5 - (self.midpoint - self.vmin) * slope,
+                0.5 + (self.vmax - self.midpoint) * slope,
+                out=data
                 )
-        except ZeroDivisionError:
-            normalized_min = self.midpoint-1
 
-        try:
-            normalized_max = min(
-                1,
-                1 / 2 * (
-                    1 + abs((self.vmax - self.midpoint) / (self.midpoint - self.vmin))
+        if is_scalar:
+            result = result[0]
+
+        return result
+
+    def inverse(self, value):
+
+        if not self.scaled():
+            raise ValueError('Not invertible until both vmin and vmax are set')
+
+        result, is_scalar = self.process_value(value)
+
+        slope = self._get_slope()
+        data = result.data
+
+        if slope == 0:
+            data.fill(self.midpoint)
+        else:
+            np.subtract(data, 0.5, out=data)
+            np.divide(data, slope, out=data)
+            np.add(data, self.midpoint, out=data)
+
+        if is_scalar:
+            result = result[0]
+
+        return result
+
+class DensityGrid(object):
+    '''
+    Accumulates a per-bin statistic of (x, y) points on a regular 2D grid,
+    one chunk of points at a time, so that catalogs larger than memory can be
+    binned. Used by density_scatter() to draw millions of points as an image
+
+    e.g.:
+    grid = DensityGrid(((0, 360), (-90, 90)), bins=(720, 360), statistic='mean')
+    for chunk in catalog_chunks:
+        grid.add(chunk['ra'], chunk['dec'], chunk['mag'])
+    image = grid.result()
+
+    Points outside the range, or with non-finite coordinates or values, are
+    dropped. Points on the upper edges fall in the last bins, as with
+    np.histogram2d
+
+    Parameters
+    ----------
+    range : tuple
+        The ((xmin, xmax), (ymin, ymax)) extent of the grid.
+    bins : int or tuple
+        The number of bins, either for both axes or as (nx, ny). Default is
+        512.
+    statistic : str or callable, optional
+        The statistic of the values in each bin; one of 'count', 'sum',
+        'mean', 'std', 'min' or 'max', which are accumulated chunk by chunk.
+        Any other reducer, e.g. np.median, is called on the array of values of
+        each bin, which keeps all of the binned values in memory until
+        result() is called. Default is 'count'.
+    '''
+
+    STATISTICS = ('count', 'sum', 'mean', 'std', 'min', 'max')
+
+    def __init__(self, range, bins=512, statistic='count'):
+        (xmin, xmax), (ymin, ymax) = range
+        if not (xmin < xmax and ymin < ymax):
+            raise ValueError(f'range must be increasing; got {range}')
+
+        if np.ndim(bins) == 0:
+            bins = (bins, bins)
+        nx, ny = (int(b) for b in bins)
+        if nx < 1 or ny < 1:
+            raise ValueError(f'bins must be >= 1; got {bins}')
+
+        if not callable(statistic) and statistic not in self.STATISTICS:
+            raise ValueError(
+                f'statistic must be one of {self.STATISTICS} or a callable; '
+                f'got {statistic}'
+                )
+
+        self.range = ((float(xmin), float(xmax)), (float(ymin), float(ymax)))
+        self.bins = (nx, ny)
+        self.statistic = statistic
+
+        nbins = nx * ny
+        self._counts = np.zeros(nbins, dtype=np.int64)
+        if statistic in ('sum', 'mean', 'std'):
+            self._sums = np.zeros(nbins)
+        if statistic == 'std':
+            self._sumsqs = np.zeros(nbins)
+        if statistic in ('min', 'max'):
+            self._extremes = np.full(nbins, np.nan)
+        if callable(statistic):
+            # (flat bin indices, values) of each chunk
+            self._chunks = []
+
+        return
+
+    def _bin_index(self, x, y) -> tuple:
+        '''
+        Return the flat bin index of the points that fall on the grid, and
+        the mask of those points
+        '''
+
+        (xmin, xmax), (ymin, ymax) = self.range
+        nx, ny = self.bins
+
+        x = np.asarray(x)
+        y = np.asarray(y)
+        if x.shape != y.shape:
+            raise ValueError(
+                f'x & y must have the same shape; got {x.shape} & {y.shape}'
+                )
+
+        # comparisons with nan are False, so this also drops non-finite points
+        keep = (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+
+        ix = ((x[keep] - xmin) * (nx / (xmax - xmin))).astype(np.intp)
+        iy = ((y[keep] - ymin) * (ny / (ymax - ymin))).astype(np.intp)
+        np.minimum(ix, nx - 1, out=ix)
+        np.minimum(iy, ny - 1, out=iy)
+
+        # row-major with y along the rows, as imshow expects
+        iy *= nx
+        iy += ix
+
+        return iy, keep
+
+    def add(self, x, y, values=None) -> None:
+        '''
+        Bin a chunk of points
+
+        Parameters
+        ----------
+        x, y : array-like
+            The point coordinates.
+        values : array-like, optional
+            The values of the points, required for every statistic but
+            'count'.
+        '''
+
+        if values is None and self.statistic != 'count':
+            raise ValueError(f'values are required for statistic={self.statistic}')
+
+        flat, keep = self._bin_index(x, y)
+        nbins = len(self._counts)
+
+        if self.statistic != 'count':
+            values = np.asarray(values, dtype=np.float64)
+            if values.shape != keep.shape:
+                raise ValueError(
+                    f'values must have the same shape as x & y; got '
+                    f'{values.shape} & {keep.shape}'
                     )
+            values = values[keep]
+            finite = np.isfinite(values)
+            if not finite.all():
+                flat = flat[finite]
+                values = values[finite]
+
+        self._counts += np.bincount(flat, minlength=nbins)
+
+        if self.statistic in ('sum', 'mean', 'std'):
+            self._sums += np.bincount(flat, weights=values, minlength=nbins)
+        if self.statistic == 'std':
+            self._sumsqs += np.bincount(flat, weights=values**2, minlength=nbins)
+        if self.statistic == 'min':
+            np.fmin.at(self._extremes, flat, values)
+        if self.statistic == 'max':
+            np.fmax.at(self._extremes, flat, values)
+        if callable(self.statistic):
+            self._chunks.append((flat, values))
+
+        return
+
+    def result(self) -> np.ma.MaskedArray:
+        '''
+        Return the (ny, nx) image of the statistic, with the empty bins
+        masked
+        '''
+
+        counts = self._counts
+        empty = counts == 0
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if self.statistic == 'count':
+                image = counts.astype(np.float64)
+            elif self.statistic == 'sum':
+                image = self._sums.copy()
+            elif self.statistic == 'mean':
+                image = self._sums / counts
+            elif self.statistic == 'std':
+                mean = self._sums / counts
+                var = self._sumsqs / counts - mean**2
+                image = np.sqrt(np.maximum(var, 0))
+            elif self.statistic in ('min', 'max'):
+                image = self._extremes.copy()
+            else:
+                image = np.full(len(counts), np.nan)
+                if len(self._chunks) > 0:
+                    flat = np.concatenate([c[0] for c in self._chunks])
+                    values = np.concatenate([c[1] for c in self._chunks])
+                    order = np.argsort(flat, kind='stable')
+                    flat, values = flat[order], values[order]
+                    occupied, starts = np.unique(flat, return_index=True)
+                    for i, group in zip(occupied, np.split(values, starts[1:])):
+                        image[i] = self.statistic(group)
+
+        nx, ny = self.bins
+
+        return np.ma.masked_array(image, mask=empty).reshape(ny, nx)
+
+def density_scatter(x, y=None, values=None, bins=None, range=None,
+                    statistic='count', ax=None, norm=None, cmap=None,
+                    **imshow_kwargs):
+    '''
+    A scatter plot of many points, drawn as an image of the points binned
+    on a pixel grid rather than as individual markers, so that the render
+    time & file size depend on the number of bins rather than of points
+
+    e.g.:
+    im = density_scatter(
+        cat['mag'], cat['color'], values=cat['resid'], statistic='mean',
+        norm=MidpointNormalize(vmin=-0.1, vmax=0.2), cmap='RdBu_r'
+        )
+    plt.colorbar(im)
+    plot(show, out_file='resid.png', overwrite=overwrite)
+
+    Parameters
+    ----------
+    x : array-like or iterable
+        The point x coordinates. If y is None, instead an iterable of (x, y)
+        or (x, y, values) chunks, e.g. read from a large catalog one chunk at
+        a time; range is then required.
+    y : array-like, optional
+        The point y coordinates.
+    values : array-like, optional
+        The point values, for statistics other than 'count'.
+    bins : int or tuple, optional
+        The number of bins, either for both axes or as (nx, ny). Default is
+        None; one bin per pixel of the axes at the figure dpi.
+    range : tuple, optional
+        The ((xmin, xmax), (ymin, ymax)) extent of the grid. Default is None;
+        the range of the points.
+    statistic : str or callable, optional
+        The statistic of each bin, as in DensityGrid. Default is 'count'.
+    ax : matplotlib.axes.Axes, optional
+        The axes to draw on. Default is None; the current axes.
+    norm : matplotlib.colors.Normalize, optional
+        The color normalization, e.g. a MidpointNormalize or LogNorm. Empty
+        bins are masked, so are left blank. Default is None.
+    cmap : str or matplotlib.colors.Colormap, optional
+        The colormap. Default is None.
+    imshow_kwargs : dict
+        Any other args for imshow().
+
+    Returns
+    -------
+    im : matplotlib.image.AxesImage
+        The image, e.g. for a colorbar.
+    '''
+
+    if ax is None:
+        ax = plt.gca()
+
+    if y is None:
+        if range is None:
+            raise ValueError('range must be set when passing chunks of points')
+        chunks = x
+    else:
+        if range is None:
+            x, y = np.asarray(x), np.asarray(y)
+            range = (
+                (np.nanmin(x), np.nanmax(x)), (np.nanmin(y), np.nanmax(y))
+                )
+        chunks = [(x, y, values)]
+
+    if bins is None:
+        bbox = ax.get_window_extent()
+        bins = (max(int(bbox.width), 1), max(int(bbox.height), 1))
+
+    grid = DensityGrid(range, bins=bins, statistic=statistic)
+    for chunk in chunks:
+        grid.add(*chunk)
+
+    (xmin, xmax), (ymin, ymax) = grid.range
+
+    imshow_kwargs.setdefault('aspect', 'auto')
+    imshow_kwargs.setdefault('interpolation', 'nearest')
+
+    return ax.imshow(
+        grid.result(), origin='lower', extent=(xmin, xmax, ymin, ymax),
+        norm=norm, cmap=cmap, **imshow_kwargs
+        )
+
+class RenderError(Exception):
+    '''
+    Raised by FigureRenderer.flush() when saving a figure failed, with the
+    output file & the traceback from the renderer process
+    '''
+
+    def __init__(self, out_file, error, remote_traceback):
+        self.out_file = out_file
+        self.error = error
+        self.remote_traceback = remote_traceback
+
+        super().__init__(
+            f'Rendering {out_file} failed with {error}\n\n'
+            f'Renderer traceback:\n{remote_traceback}'
+            )
+
+        return
+
+    def __reduce__(self):
+        return (RenderError, (self.out_file, self.error, self.remote_traceback))
+
+def _init_renderer():
+    # renderers never display anything, so use the non-interactive backend
+    plt.switch_backend('Agg')
+
+    return
+
+def _render(out_file, fig_bytes, func, args, kwargs, dpi, savefig_kwargs):
+    '''
+    Build (or unpickle) a figure in a renderer process & save it to out_file
+    '''
+
+    fig = None
+    try:
+        if fig_bytes is not None:
+            fig = pickle.loads(fig_bytes)
+        else:
+            fig = func(*args, **kwargs)
+            if not isinstance(fig, Figure):
+                fig = plt.gcf()
+        fig.savefig(out_file, dpi=dpi, **savefig_kwargs)
+    except Exception as e:
+        raise RenderError(out_file, repr(e), traceback.format_exc()) from None
+    finally:
+        if fig is not None:
+            plt.close(fig)
+        else:
+            plt.close('all')
+
+    return out_file
+
+class FigureRenderer(object):
+    '''
+    Saves figures in a pool of background processes with the Agg backend, so
+    that a loop producing many figures doesn't wait on rasterizing them.
+    Figures are handed over either as finished figures (pickled) or as a
+    plotting recipe, i.e. a picklable function that builds the figure in the
+    renderer, which avoids the pickling cost for figures with a lot of data
+
+    e.g.:
+    with FigureRenderer(ncores=4) as renderer:
+        for obj in objs:
+            plt.imshow(obj.image)
+            plot(False, out_file=f'{obj.id}.png', renderer=renderer)
+            # or, without building the figure here:
+            renderer.render(f'{obj.id}_psf.png', plot_psf, args=(obj.psf,))
+
+    At most max_pending figures are queued; beyond that, saving blocks until
+    a renderer is free. Failures are collected in errors & raised as a
+    RenderError by flush()
+    '''
+
+    def __init__(self, ncores: int = None, max_pending: int = None,
+                 start_method: str = None):
+        '''
+        ncores: int
+            The number of renderer processes. Defaults to the number of cpus
+        max_pending: int
+            The maximum number of queued or rendering figures. Defaults to
+            2*ncores
+        start_method: str
+            The multiprocessing start method ('fork', 'spawn', 'forkserver'),
+            if not the platform default
+        '''
+
+        if ncores is None:
+            ncores = multiprocessing.cpu_count()
+        if ncores < 1:
+            raise ValueError('ncores must be >= 1')
+        if max_pending is None:
+            max_pending = 2 * ncores
+        if max_pending < 1:
+            raise ValueError('max_pending must be >= 1')
+
+        self.ncores = ncores
+        self.max_pending = max_pending
+
+        mp_context = None
+        if start_method is not None:
+            mp_context = multiprocessing.get_context(start_method)
+
+        self._executor = ProcessPoolExecutor(
+            max_workers=ncores, mp_context=mp_context, initializer=_init_renderer
+            )
+
+        # future -> out_file, for the figures not yet collected
+        self._pending = {}
+
+        self.nsaved = 0
+        self.errors = []
+
+        return
+
+    def _check_out_file(self, out_file, overwrite: bool) -> str:
+        out_file = str(out_file)
+
+        if overwrite is False:
+            if Path(out_file).exists() or out_file in self._pending.values():
+                raise FileExistsError(
+                    f'{out_file} already exists and overwrite is set to False.'
                 )
-        except ZeroDivisionError:
-            normalized_max = self.midpoint+1
 
-        normalized_mid = 0.5
-        x = [self.vmin, self.midpoint, self.vmax]
-        y = [normalized_min, normalized_mid, normalized_max]
+        return out_file
+
+    def _collect(self, futures) -> None:
+        for future in futures:
+            out_file = self._pending.pop(future)
+            try:
+                future.result()
+                self.nsaved += 1
+            except RenderError as e:
+                self.errors.append(e)
+            except Exception as e:
+                # e.g. a BrokenProcessPool, or a task that failed to pickle
+                self.errors.append(RenderError(
+                    out_file, repr(e), ''.join(traceback.format_exception(e))
+                    ))
+
+        return
+
+    def _submit(self, out_file, fig_bytes, func, args, kwargs, dpi,
+                savefig_kwargs) -> None:
+        if len(self._pending) >= self.max_pending:
+            done, _ = wait(self._pending, return_when=FIRST_COMPLETED)
+            self._collect(done)
+
+        future = self._executor.submit(
+            _render, out_file, fig_bytes, func, args, kwargs, dpi,
+            savefig_kwargs
+            )
+        self._pending[future] = out_file
+
+        return
+
+    def savefig(self, fig, out_file, overwrite=False, dpi=300,
+                **savefig_kwargs) -> None:
+        '''
+        Queue a finished figure to be saved to out_file. The figure is pickled
+        straight away, so it can be closed or reused once this returns
+
+        fig: matplotlib.figure.Figure
+            The figure to save
+        out_file: str, Path
+            The output file
+        overwrite: bool
+            Whether to overwrite existing files. Default is False
+        dpi: int
+            The resolution of the plot. Default is 300
+        savefig_kwargs: dict
+            Any other args for Figure.savefig()
+        '''
+
+        out_file = self._check_out_file(out_file, overwrite)
+        fig_bytes = pickle.dumps(fig, protocol=pickle.HIGHEST_PROTOCOL)
+
+        self._submit(out_file, fig_bytes, None, (), {}, dpi, savefig_kwargs)
+
+        return
+
+    def render(self, out_file, func, args: tuple = (), kwargs: dict = None,
+               overwrite=False, dpi=300, **savefig_kwargs) -> None:
+        '''
+        Queue a plotting recipe to be run & saved to out_file by a renderer
+
+        out_file: str, Path
+            The output file
+        func: callable
+            Builds the figure when called as func(*args, **kwargs), either
+            returning it or drawing on the current figure. Must be picklable
+            (e.g. defined at module level)
+        args: tuple
+            Positional args for func
+        kwargs: dict
+            Keyword args for func
+        overwrite: bool
+            Whether to overwrite existing files. Default is False
+        dpi: int
+            The resolution of the plot. Default is 300
+        savefig_kwargs: dict
+            Any other args for Figure.savefig()
+        '''
 
-        return np.ma.masked_array(np.interp(value, x, y))
+        if kwargs is None:
+            kwargs = {}
 
+        out_file = self._check_out_file(out_file, overwrite)
 
-def plot(show, out_file=None, overwrite=False, dpi=300):
+        self._submit(out_file, None, func, args, kwargs, dpi, savefig_kwargs)
+
+        return
+
+    def flush(self, raise_errors: bool = True) -> int:
+        '''
+        Wait for all queued figures to be saved. Returns the number of figures
+        saved so far
+
+        raise_errors: bool
+            Whether to raise the first RenderError, if any figure failed. It
+            is then removed from errors, which keeps any other failures
+        '''
+
+        self._collect(list(self._pending))
+
+        if raise_errors is True and len(self.errors) > 0:
+            raise self.errors.pop(0)
+
+        return self.nsaved
+
+    def close(self, raise_errors: bool = True) -> None:
+        '''
+        Flush the queued figures & shut down the renderer processes
+        '''
+
+        try:
+            self.flush(raise_errors=raise_errors)
+        finally:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        # don't mask an exception raised in the with block
+        self.close(raise_errors=exc_type is None)
+
+        return False
+
+def plot(show, out_file=None, overwrite=False, dpi=300, renderer=None):
     '''
     Helper function to streamline plotting options
 
@@ -81,14 +650,20 @@ def plot(show, out_file=None, overwrite=False, dpi=300):
         plot will not be saved.
     dpi : int
         The resolution of the plot. Default is 300.
+    renderer : FigureRenderer, optional
+        If passed, the current figure is saved in the background by the
+        renderer, rather than waiting on it here. Default is None.
     '''
 
     if out_file is not None:
-        if overwrite is False and Path(out_file).exists():
-            raise FileExistsError(
-                f'{out_file} already exists and overwrite is set to False.'
-            )
-        plt.savefig(out_file, dpi=dpi)
+        if renderer is not None:
+            renderer.savefig(plt.gcf(), out_file, overwrite=overwrite, dpi=dpi)
+        else:
+            if overwrite is False and Path(out_file).exists():
+                raise FileExistsError(
+                    f'{out_file} already exists and overwrite is set to False.'
+                )
+            plt.savefig(out_file, dpi=dpi)
 
     if show is True:
         plt.show()
@@ -1,3 +1,4 @@
+import numpy as np
 from numpy.random import SeedSequence, default_rng
 import time
 
@@ -44,3 +45,26 @@ def generate_seeds(Nseeds, master_seed=None, seed_bounds=(0, 2**32-1),
         return seeds, master_seed
     else:
         return seeds
+
+def generate_seed(index, master_seed, seed_bounds=(0, 2**32-1)):
+    '''
+    generate the seed of the given index that generate_seeds() would
+    return for the same master seed, without generating all of the seeds
+    before it. Useful for assigning seeds to tasks lazily
+
+    index: int
+        The index of the desired seed
+    master_seed: int
+        The seed that initializes the SeedSequence
+    seed_bounds: tuple of ints
+        The min & max values for the seeds to be sampled from
+    '''
+
+    if (not isinstance(index, (int, np.integer))) or (index < 0):
+        raise ValueError('index must be a non-negative int!')
+
+    # equivalent to SeedSequence(master_seed).spawn(...)[index]
+    child_seed = SeedSequence(master_seed, spawn_key=(int(index),))
+    stream = default_rng(child_seed)
+
+    return int(stream.integers(seed_bounds[0], seed_bounds[1]))
@@ -0,0 +1,284 @@
+import re
+import json
+import threading
+import http.server
+
+import numpy as np
+import pytest
+
+from terminus import downloads
+from terminus.downloads import (
+    download_file, download_many, PART_SUFFIX, SEGMENTS_SUFFIX
+    )
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    '''
+    Serves the server's files from memory, honoring single byte ranges if
+    the server supports them. The statuses in the server's errors for a path
+    are returned first, one per request. A response starting at a (path, start) in the
+    server's drops is cut off after that many bytes, once, to simulate an
+    interrupted transfer
+    '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        return
+
+    def do_GET(self):
+        server = self.server
+        path = self.path.split('?')[0]
+        with server.lock:
+            server.requests.append((path, self.headers.get('Range')))
+            errors = server.errors.get(path)
+            status = errors.pop(0) if errors else None
+        if status is not None:
+            self.send_error(status)
+            return
+        if path not in server.files:
+            self.send_error(404)
+            return
+
+        content = server.files[path]
+        size = len(content)
+        start, end = 0, size
+
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range') or '')
+        if server.ranges and (match is not None):
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)) + 1, size)
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end-1}/{size}')
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Length', str(end - start))
+        self.end_headers()
+
+        with server.lock:
+            ndrop = server.drops.pop((path, start), None)
+        if ndrop is not None:
+            # send part of the body, then hang up
+            self.wfile.write(content[start:start+ndrop])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+
+        self.wfile.write(content[start:end])
+
+        return
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    httpd.daemon_threads = True
+    # clients hanging up on cancelled segments isn't an error
+    httpd.handle_error = lambda request, client_address: None
+    httpd.files = {}
+    httpd.requests = []
+    httpd.drops = {}
+    httpd.errors = {}
+    httpd.ranges = True
+    httpd.lock = threading.Lock()
+    httpd.url = f'http://127.0.0.1:{httpd.server_port}'
+
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+    thread.join()
+
+def _content(size, seed=0):
+    return np.random.default_rng(seed).bytes(size)
+
+def test_download_file(server, tmp_path):
+    content = _content(100_000)
+    server.files['/data.bin'] = content
+
+    filename = download_file(f'{server.url}/data.bin?v=1', tmp_path, vb=False)
+
+    assert filename == tmp_path / 'data.bin'
+    assert filename.read_bytes() == content
+    assert not (tmp_path / f'data.bin{PART_SUFFIX}').exists()
+
+def test_resumes_from_part_file(server, tmp_path):
+    content = _content(100_000)
+    server.files['/data.bin'] = content
+    (tmp_path / f'data.bin{PART_SUFFIX}').write_bytes(content[:30_000])
+
+    filename = download_file(f'{server.url}/data.bin', tmp_path, vb=False)
+
+    assert filename.read_bytes() == content
+    assert server.requests == [('/data.bin', 'bytes=30000-')]
+
+def test_restarts_without_range_support(server, tmp_path):
+    content = _content(100_000)
+    server.files['/data.bin'] = content
+    server.ranges = False
+    (tmp_path / f'data.bin{PART_SUFFIX}').write_bytes(b'stale' * 1000)
+
+    filename = download_file(f'{server.url}/data.bin', tmp_path, vb=False)
+
+    assert filename.read_bytes() == content
+
+def test_restarts_if_part_file_is_too_long(server, tmp_path):
+    content = _content(10_000)
+    server.files['/data.bin'] = content
+    (tmp_path / f'data.bin{PART_SUFFIX}').write_bytes(_content(20_000, seed=1))
+
+    filename = download_file(f'{server.url}/data.bin', tmp_path, vb=False)
+
+    assert filename.read_bytes() == content
+
+def test_resumes_after_interrupted_transfer(server, tmp_path):
+    content = _content(200_000)
+    server.files['/data.bin'] = content
+    # more than a few chunks, so some are written before the error
+    server.drops[('/data.bin', 0)] = 150_000
+
+    filename = download_file(
+        f'{server.url}/data.bin', tmp_path, vb=False, retries=2
+        )
+
+    assert filename.read_bytes() == content
+    assert len(server.requests) == 2
+    resumed_at = int(re.fullmatch(r'bytes=(\d+)-', server.requests[1][1]).group(1))
+    assert 0 < resumed_at <= 150_000
+
+def test_checksum_mismatch_discards_download(server, tmp_path):
+    server.files['/data.bin'] = _content(1000)
+
+    with pytest.raises(IOError):
+        download_file(
+            f'{server.url}/data.bin', tmp_path, vb=False, sha256='0' * 64
+            )
+
+    assert list(tmp_path.iterdir()) == []
+
+@pytest.fixture
+def small_segments(monkeypatch):
+    # so that small test files are still split into segments
+    monkeypatch.setattr(downloads, 'MIN_SEGMENT_SIZE', 1024)
+
+def _range_starts(server):
+    return sorted(
+        int(re.fullmatch(r'bytes=(\d+)-\d*', r).group(1))
+        for _, r in server.requests if r is not None
+        )
+
+def test_segmented_download(server, tmp_path, small_segments):
+    content = _content(400_003)
+    server.files['/data.bin'] = content
+
+    filename = download_file(
+        f'{server.url}/data.bin', tmp_path, vb=False, nsegments=4
+        )
+
+    assert filename.read_bytes() == content
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['data.bin']
+    # the 1 byte probe, then one request per segment
+    assert _range_starts(server) == [0, 0, 100_000, 200_001, 300_002]
+
+def test_segmented_download_resumes_segments(server, tmp_path, small_segments):
+    content = _content(400_000)
+    server.files['/data.bin'] = content
+
+    # a preallocated part file, with some of each segment done
+    segments = [
+        [0, 100_000, 100_000],
+        [100_000, 200_000, 20_000],
+        [200_000, 300_000, 0],
+        [300_000, 400_000, 99_999],
+        ]
+    data = bytearray(len(content))
+    for start, end, ndone in segments:
+        data[start:start+ndone] = content[start:start+ndone]
+    (tmp_path / f'data.bin{PART_SUFFIX}').write_bytes(data)
+    (tmp_path / f'data.bin{PART_SUFFIX}{SEGMENTS_SUFFIX}').write_text(
+        json.dumps({'total_size': len(content), 'segments': segments})
+        )
+
+    filename = download_file(
+        f'{server.url}/data.bin', tmp_path, vb=False, nsegments=4
+        )
+
+    assert filename.read_bytes() == content
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['data.bin']
+    # only the remainder of the unfinished segments is requested
+    assert _range_starts(server) == [0, 120_000, 200_000, 399_999]
+
+def test_segmented_download_resumes_after_interrupted_transfer(
+        server, tmp_path, small_segments):
+    content = _content(800_000)
+    server.files['/data.bin'] = content
+    server.drops[('/data.bin', 400_000)] = 300_000
+
+    filename = download_file(
+        f'{server.url}/data.bin', tmp_path, vb=False, nsegments=2, retries=2
+        )
+
+    assert filename.read_bytes() == content
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['data.bin']
+    # the interrupted segment is resumed from where it was cut off, rather
+    # than from its start
+    starts = [s for s in _range_starts(server) if s >= 400_000]
+    assert len(starts) == 2
+    assert 400_000 < starts[1] <= 700_000
+
+def test_segmented_download_without_range_support(server, tmp_path, small_segments):
+    content = _content(100_000)
+    server.files['/data.bin'] = content
+    server.ranges = False
+
+    filename = download_file(
+        f'{server.url}/data.bin', tmp_path, vb=False, nsegments=4
+        )
+
+    assert filename.read_bytes() == content
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['data.bin']
+
+def test_download_many(server, tmp_path):
+    contents = {f'/file{i}.bin': _content(1000 + i, seed=i) for i in range(20)}
+    server.files.update(contents)
+    urls = [f'{server.url}{path}' for path in contents]
+
+    results = download_many(
+        urls, tmp_path, max_concurrency=4, max_per_host=2, vb=False
+        )
+
+    assert [r.url for r in results] == urls
+    assert all(r.status == 'downloaded' for r in results)
+    for path, content in contents.items():
+        assert (tmp_path / path[1:]).read_bytes() == content
+
+    # files already in place are skipped without any request
+    nrequests = len(server.requests)
+    results = download_many(urls, tmp_path, vb=False)
+    assert all(r.status == 'skipped' for r in results)
+    assert len(server.requests) == nrequests
+
+def test_download_many_retries(server, tmp_path):
+    server.files['/flaky.bin'] = _content(1000)
+    server.errors['/flaky.bin'] = [503, 503]
+    server.files['/gone.bin'] = _content(1000)
+    server.errors['/gone.bin'] = [404]
+
+    flaky, gone = download_many(
+        [f'{server.url}/flaky.bin', f'{server.url}/gone.bin'], tmp_path,
+        retries=3, backoff=0.01, vb=False
+        )
+
+    assert flaky.ok and (flaky.attempts == 3)
+    assert (tmp_path / 'flaky.bin').read_bytes() == server.files['/flaky.bin']
+
+    # client errors aren't retried
+    assert (not gone.ok) and (gone.attempts == 1) and ('404' in gone.error)
+    assert not (tmp_path / 'gone.bin').exists()
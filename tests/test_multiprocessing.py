@@ -0,0 +1,143 @@
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+import pytest
+
+from terminus.multiprocessing import (
+    setup_batches, setup_weighted_batches, batch_costs, parallel_map,
+    SharedData
+    )
+
+METHODS = ['lpt', 'greedy', 'contiguous']
+
+def _skewed_costs(nobjs, seed=0):
+    # a few very expensive objects among many cheap ones, sorted so that
+    # contiguous index ranges are badly unbalanced
+    rng = np.random.default_rng(seed)
+    return np.sort(rng.pareto(1.5, nobjs) + 1)
+
+@pytest.mark.parametrize('method', METHODS)
+@pytest.mark.parametrize('nobjs, ncores', [(0, 3), (5, 8), (100, 7), (1000, 16)])
+def test_weighted_batches_cover_every_index_once(method, nobjs, ncores):
+    costs = _skewed_costs(nobjs)
+    batches = setup_weighted_batches(costs, ncores, method=method)
+
+    assert len(batches) == ncores
+    indices = np.concatenate([np.asarray(b, dtype=int) for b in batches])
+    assert np.array_equal(np.sort(indices), np.arange(nobjs))
+
+@pytest.mark.parametrize('nobjs, ncores', [(12, 4), (100, 10), (1000, 8)])
+def test_uniform_contiguous_batches_match_setup_batches(nobjs, ncores):
+    batches = setup_weighted_batches(np.ones(nobjs), ncores, method='contiguous')
+
+    assert batches == setup_batches(nobjs, ncores)
+
+@pytest.mark.parametrize('method', METHODS)
+@pytest.mark.parametrize('seed', range(5))
+def test_weighted_batches_balance_better_than_setup_batches(method, seed):
+    nobjs, ncores = 500, 8
+    costs = _skewed_costs(nobjs, seed=seed)
+
+    makespan = batch_costs(
+        setup_weighted_batches(costs, ncores, method=method), costs
+        ).max()
+    baseline = batch_costs(setup_batches(nobjs, ncores), costs).max()
+
+    assert makespan <= baseline
+
+@pytest.mark.parametrize('seed', range(5))
+def test_lpt_is_within_its_bound(seed):
+    nobjs, ncores = 500, 8
+    costs = _skewed_costs(nobjs, seed=seed)
+
+    makespan = batch_costs(
+        setup_weighted_batches(costs, ncores, method='lpt'), costs
+        ).max()
+    # no schedule can beat either the mean load or the largest object, and
+    # LPT is guaranteed within 4/3 of the optimum
+    lower_bound = max(costs.sum() / ncores, costs.max())
+
+    assert makespan <= 4 / 3 * lower_bound
+
+def test_weighted_batches_reject_bad_costs():
+    with pytest.raises(ValueError):
+        setup_weighted_batches([1., -1.], 2)
+    with pytest.raises(ValueError):
+        setup_weighted_batches([1., np.nan], 2)
+    with pytest.raises(ValueError):
+        setup_weighted_batches([1., 2.], 0)
+
+START_METHODS = ['fork', 'spawn', 'forkserver']
+
+def _scale_row(i, images=None, out=None):
+    images = images.attach(readonly=True)
+    out = out.attach()
+    out[i] = 2 * images[i]
+
+    return float(images[i].sum())
+
+def _table_row(i, catalog=None):
+    catalog = catalog.attach(readonly=True)
+    flux = catalog['flux']
+
+    return int(catalog['id'][i]), float(np.ma.getdata(flux)[i]), bool(flux.mask[i])
+
+def _segment_exists(handle):
+    if handle.backend == 'memmap':
+        return os.path.exists(handle.name)
+    try:
+        shared_memory.SharedMemory(name=handle.name).close()
+    except FileNotFoundError:
+        return False
+
+    return True
+
+@pytest.mark.parametrize('start_method', START_METHODS)
+@pytest.mark.parametrize('backend', ['shm', 'memmap'])
+def test_shared_arrays_across_workers(tmp_path, start_method, backend):
+    data = np.arange(40 * 5, dtype=float).reshape(40, 5)
+
+    with SharedData(backend=backend, dir=str(tmp_path)) as shared:
+        images = shared.array(data)
+        out = shared.empty(data.shape)
+        sums = parallel_map(
+            _scale_row, range(len(data)), ncores=2, chunksize=5,
+            pass_seed=False, start_method=start_method,
+            kwargs={'images': images, 'out': out}
+            )
+
+        # workers exiting must not remove the owner's segments
+        assert _segment_exists(images) and _segment_exists(out)
+        assert sums == list(data.sum(axis=1))
+        result = out.attach()
+        assert np.array_equal(result, 2 * data)
+
+    # released by the owner, while the views read back stay valid
+    assert not _segment_exists(images)
+    assert not _segment_exists(out)
+    assert np.array_equal(result, 2 * data)
+
+@pytest.mark.parametrize('start_method', START_METHODS)
+def test_shared_table_across_workers(start_method):
+    Table = pytest.importorskip('astropy.table').Table
+    flux = np.ma.masked_array(np.arange(10.), mask=[0, 1] * 5)
+    table = Table({'flux': flux, 'id': np.arange(10)})
+
+    with SharedData() as shared:
+        catalog = shared.table(table)
+        results = parallel_map(
+            _table_row, range(len(table)), ncores=2, chunksize=2,
+            pass_seed=False, start_method=start_method,
+            kwargs={'catalog': catalog}
+            )
+
+    assert results == [(i, float(i), i % 2 == 1) for i in range(10)]
+
+def test_shared_data_close_is_idempotent():
+    shared = SharedData()
+    handle = shared.array(np.ones(3))
+    shared.close()
+    shared.close()
+
+    assert not _segment_exists(handle)
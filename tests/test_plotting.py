@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from terminus.plotting import MidpointNormalize
+
+CASES = [
+    # vmin, vmax, midpoint
+    (-100., 100., 0.),
+    (-10., 100., 0.),
+    (-100., 10., 0.),
+    (2., 50., 5.),
+    (-3.5, -1., -2.),
+    ]
+
+def _interp_normalize(value, vmin, vmax, midpoint):
+    # the original np.interp mapping, for vmin < midpoint < vmax
+    normalized_min = max(
+        0, 1 / 2 * (1 - abs((midpoint - vmin) / (midpoint - vmax)))
+        )
+    normalized_max = min(
+        1, 1 / 2 * (1 + abs((vmax - midpoint) / (midpoint - vmin)))
+        )
+
+    return np.interp(
+        value, [vmin, midpoint, vmax], [normalized_min, 0.5, normalized_max]
+        )
+
+@pytest.mark.parametrize('vmin, vmax, midpoint', CASES)
+def test_matches_interp_mapping_within_range(vmin, vmax, midpoint):
+    value = np.linspace(vmin, vmax, 1001)
+    norm = MidpointNormalize(vmin=vmin, vmax=vmax, midpoint=midpoint)
+
+    np.testing.assert_allclose(
+        norm(value), _interp_normalize(value, vmin, vmax, midpoint),
+        rtol=1e-12, atol=1e-12
+        )
+
+@pytest.mark.parametrize('vmin, vmax, midpoint', CASES)
+def test_clip_matches_interp_mapping_outside_range(vmin, vmax, midpoint):
+    span = vmax - vmin
+    value = np.linspace(vmin - span, vmax + span, 1001)
+    norm = MidpointNormalize(vmin=vmin, vmax=vmax, midpoint=midpoint, clip=True)
+
+    np.testing.assert_allclose(
+        norm(value), _interp_normalize(value, vmin, vmax, midpoint),
+        rtol=1e-12, atol=1e-12
+        )
+
+@pytest.mark.parametrize('vmin, vmax, midpoint', CASES)
+def test_inverse_round_trips(vmin, vmax, midpoint):
+    value = np.linspace(vmin, vmax, 101)
+    norm = MidpointNormalize(vmin=vmin, vmax=vmax, midpoint=midpoint)
+
+    np.testing.assert_allclose(norm.inverse(norm(value)), value, atol=1e-9)
+
+def test_keeps_masks_and_float32():
+    value = np.ma.masked_array(
+        np.array([-2., 0., 1.], dtype=np.float32), mask=[False, True, False]
+        )
+    result = MidpointNormalize(vmin=-2., vmax=1., midpoint=0.)(value)
+
+    assert result.dtype == np.float32
+    assert np.array_equal(np.ma.getmaskarray(result), [False, True, False])
+    np.testing.assert_allclose(result.compressed(), [0., 0.75])
+
+def test_scalar_input():
+    norm = MidpointNormalize(vmin=-1., vmax=3., midpoint=1.)
+
+    assert np.ndim(norm(1.)) == 0
+    assert float(norm(1.)) == 0.5
+
+def test_rejects_midpoint_outside_range():
+    norm = MidpointNormalize(vmin=0., vmax=1., midpoint=2.)
+
+    with pytest.raises(ValueError):
+        norm(np.array([0.5]))
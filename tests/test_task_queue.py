@@ -0,0 +1,82 @@
+import multiprocessing
+
+from terminus.multiprocessing import FileTaskQueue, run_queue_worker
+
+def _marker_exists(marker):
+    try:
+        open(marker, 'r').close()
+    except FileNotFoundError:
+        return False
+
+    return True
+
+def _flaky_square(data):
+    # fails on the first attempt of every third task, so that tasks are
+    # requeued while other workers are claiming
+    marker = data['marker']
+    if (data['x'] % 3 == 0) and (not _marker_exists(marker)):
+        open(marker, 'w').close()
+        raise RuntimeError('first attempt fails')
+
+    return data['x']**2
+
+def _run_worker(root, index):
+    queue = FileTaskQueue(root, lease=30, max_attempts=3)
+    run_queue_worker(
+        queue, _flaky_square, worker=f'worker-{index}', poll_interval=0.05,
+        logprint=lambda msg: None
+        )
+
+    return
+
+def test_requeue_is_not_lost_to_a_concurrent_claim(tmp_path):
+    queue = FileTaskQueue(tmp_path / 'queue', max_attempts=3)
+    queue.put([{'x': 1}], ids=['task'])
+
+    first = queue.claim('a')
+    claims = []
+
+    # claim the task as soon as fail() publishes it back to pending/
+    write = queue._write
+    def write_then_claim(path, payload):
+        write(path, payload)
+        if path.parent.name == 'pending' and len(claims) == 0:
+            claims.append(queue.claim('b'))
+    queue._write = write_then_claim
+
+    assert queue.fail(first, error='boom') is True
+    queue._write = write
+
+    second = claims[0]
+    assert second is not None
+    assert queue.renew(second) is True
+    assert queue.complete(second, result=1) is True
+    assert queue.counts() == {'pending': 0, 'claimed': 0, 'done': 1, 'failed': 0}
+    assert list(queue.results()) == [('task', 1)]
+
+def test_workers_complete_every_task(tmp_path):
+    root = tmp_path / 'queue'
+    queue = FileTaskQueue(root, lease=30, max_attempts=3)
+    ntasks = 60
+    ids = queue.put(
+        [{'x': x, 'marker': str(tmp_path / f'marker-{x}')} for x in range(ntasks)],
+        ids=[f'{x:03d}' for x in range(ntasks)]
+        )
+
+    ctx = multiprocessing.get_context('spawn')
+    workers = [
+        ctx.Process(target=_run_worker, args=(str(root), i)) for i in range(4)
+        ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=120)
+        assert worker.exitcode == 0
+
+    assert queue.is_finished()
+    assert queue.counts() == {
+        'pending': 0, 'claimed': 0, 'done': ntasks, 'failed': 0
+        }
+    assert dict(queue.results()) == {
+        task_id: x**2 for x, task_id in enumerate(ids)
+        }